@@ -0,0 +1,68 @@
+"""
+Jonas Nockert (2020)
+
+Build time of the external (between-leaf) contacts as the grid grows, for the
+original pairwise generator and the grid-based one. Also checks that both give
+about the same number of contacts and distribution of contact distances.
+
+Usage: python benchmarks/external_contacts.py [max grid size] [max pairwise size]
+
+"""
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from graph import Graph  # noqa: E402
+
+
+def leaf_arrays(graph):
+    leaves = graph.tree.leaves()
+    sizes = np.array([leaf.rect.area() for leaf in leaves])
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    centers = np.array([leaf.center().as_tuple() for leaf in leaves], dtype=float)
+    return leaves, offsets, np.repeat(np.arange(len(leaves)), sizes), centers
+
+
+def benchmark(n, method, seed=1):
+    random.seed(seed)
+    np.random.seed(seed)
+    graph = Graph(n, n)
+    leaves, offsets, leaf_of, centers = leaf_arrays(graph)
+    generate = getattr(graph, f"external_contacts_{method}")
+
+    start = time.perf_counter()
+    src, dst = generate(leaves, offsets)
+    elapsed = time.perf_counter() - start
+
+    distances = np.sqrt(
+        np.sum((centers[leaf_of[src]] - centers[leaf_of[dst]]) ** 2, axis=1)
+    )
+    return len(leaves), elapsed, len(src), np.median(distances)
+
+
+def main(max_size=320, max_pairwise_size=100):
+    print(
+        "{:>6} {:>8} {:>10} {:>10} {:>12} {:>10}".format(
+            "grid", "leaves", "method", "time (s)", "contacts", "median d"
+        )
+    )
+    n = 20
+    while n <= max_size:
+        methods = ["grid"] if n > max_pairwise_size else ["pairwise", "grid"]
+        for method in methods:
+            n_leaves, elapsed, n_contacts, median_d = benchmark(n, method)
+            print(
+                "{:>6} {:>8} {:>10} {:>10.3f} {:>12} {:>10.2f}".format(
+                    f"{n}x{n}", n_leaves, method, elapsed, n_contacts, median_d
+                )
+            )
+        n *= 2
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,356 @@
+"""
+Jonas Nockert (2020)
+
+Scaling benchmarks of the main entry points: `BSP_Tree` construction,
+`Graph.adjacency_matrix`, stepping at low and high prevalence (with `Graph.step`
+and the array engines), `Graph.image` and `Graph.plot`.
+
+Every grid size runs in its own process with fixed seeds, so that its peak RSS
+is its own. Results (wall time, time per phase and peak RSS) are written as
+JSON and can be compared against an earlier run, flagging phases that got
+slower than the threshold.
+
+By default, sizes double from 30x30 for as long as the estimated size of the
+contact graph fits in a quarter of the available memory.
+
+Usage:
+    python benchmarks/suite.py [--sizes 30,60,120] [--repeat 3]
+        [--output results.json] [--baseline baseline.json] [--threshold 0.2]
+
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np  # noqa: E402
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+def available_bytes():
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class Phases:
+    """Times named phases and records the peak RSS after each."""
+
+    def __init__(self):
+        self.times = {}
+        self.rss = {}
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        yield
+        self.times[name] = time.perf_counter() - start
+        self.rss[name] = peak_rss_mb()
+
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def reset(graph):
+    """Make everyone susceptible again and restart the clock."""
+    from graph import NodeState
+    from timeseries import StatsBuffer
+
+    for node in graph.nodes:
+        node.state = NodeState.SUSCEPTIBLE
+        node.counter = 0
+    graph.census.counts = [0] * len(graph.census.counts)
+    graph.census.counts[NodeState.SUSCEPTIBLE.value] = len(graph.nodes)
+    graph.census.cumulative = 0
+    graph.t = 0
+    graph.stats = StatsBuffer()
+
+
+def infect_fraction(graph, fraction):
+    """Make a random `fraction` of the susceptible nodes infectious."""
+    susceptible = [node for node in graph.nodes if node.is_susceptible()]
+    for node in random.sample(susceptible, int(fraction * len(susceptible))):
+        node.infectious()
+
+
+def run_size(n, seed, steps, engines, implicit_cliques):
+    from bsp import BSP_Tree
+    from graph import Graph
+    from ensemble import make_engine
+
+    phases = Phases()
+    start = time.perf_counter()
+
+    seed_all(seed)
+    with phases("bsp"):
+        tree = BSP_Tree(n, n)
+    graph = Graph(n, n, tree=tree)
+    with phases("adjacency_matrix"):
+        graph.adjacency_matrix(implicit_cliques=implicit_cliques)
+
+    for engine in engines:
+        # Fresh node state for every engine, at low and then high prevalence.
+        for prevalence, fraction in (("low", None), ("high", 0.2)):
+            seed_all(seed + 1)
+            reset(graph)
+            if fraction is None:
+                graph.infect_random(n=1)
+            else:
+                infect_fraction(graph, fraction)
+            sim = make_engine(graph, engine)
+            with phases(f"step_{prevalence}[{engine}]"):
+                for _ in range(steps):
+                    sim.step()
+            if hasattr(sim, "sync_nodes"):
+                sim.sync_nodes()
+
+    with tempfile.TemporaryDirectory() as directory:
+        with phases("image"):
+            graph.image(show=False, filename=os.path.join(directory, "image.png"))
+        with phases("plot"):
+            graph.plot(show=False, filename=os.path.join(directory, "plot.png"))
+
+    return {
+        "size": f"{n}x{n}",
+        "n": n,
+        "nodes": len(graph.nodes),
+        "edges": graph.contacts.n_edges,
+        "explicit_edges": graph.contacts.n_explicit_edges,
+        "wall": time.perf_counter() - start,
+        "phases": phases.times,
+        "phase_rss_mb": phases.rss,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def default_sizes(implicit_cliques, memory_fraction=0.25, largest=3840):
+    """Grid sizes doubling from 30 while the contact graph would fit in
+    `memory_fraction` of the available memory.
+
+    The number of contacts is computed exactly for a 60x60 grid only and
+    extrapolated from there: contacts between leaves grow with the number of
+    leaf pairs (n^4) and those within leaves with the number of nodes (n^2).
+    """
+    from contacts import ContactGraph
+    from graph import Graph
+
+    seed_all(0)
+    graph = Graph(60, 60)
+    external = graph.expected_n_edges(implicit_cliques=True)
+    internal = graph.expected_n_edges() - external
+    n_leaves = graph.tree.n_leaves
+
+    available = available_bytes()
+    sizes = []
+    n = 30
+    while n <= largest:
+        scale = (n / 60) ** 2
+        n_edges = external * scale ** 2
+        if not implicit_cliques:
+            n_edges += internal * scale
+        n_cliques = int(n_leaves * scale) if implicit_cliques else None
+        estimate = ContactGraph.estimate_nbytes(
+            n * n, int(n_edges), n_cliques=n_cliques
+        )
+        if available is not None and estimate > memory_fraction * available:
+            break
+        sizes.append(n)
+        n *= 2
+    return sizes
+
+
+def fastest(runs):
+    """Combine repeated runs of a size: the minimum of each time, which is the
+    least noisy, and the largest peak RSS."""
+    result = dict(runs[0])
+    result["wall"] = min(run["wall"] for run in runs)
+    result["phases"] = {
+        phase: min(run["phases"][phase] for run in runs) for phase in result["phases"]
+    }
+    result["peak_rss_mb"] = max(run["peak_rss_mb"] for run in runs)
+    result["repeat"] = len(runs)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold, min_seconds):
+    """Phases slower than the baseline by more than `threshold` (relative) and
+    `min_seconds` (absolute), as (size, phase, baseline, current) tuples."""
+    previous = {result["size"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        if result["size"] not in previous:
+            continue
+        old = previous[result["size"]]
+        timings = dict(result["phases"], wall=result["wall"])
+        old_timings = dict(old["phases"], wall=old["wall"])
+        for phase, seconds in timings.items():
+            if phase not in old_timings:
+                continue
+            before = old_timings[phase]
+            if seconds > before * (1 + threshold) and seconds - before > min_seconds:
+                regressions.append((result["size"], phase, before, seconds))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    previous = {}
+    if baseline:
+        previous = {result["size"]: result for result in baseline["results"]}
+    print("{:>10} {:>22} {:>10} {:>10}".format("grid", "phase", "time (s)", "change"))
+    for result in results["results"]:
+        old = previous.get(result["size"], {}).get("phases", {})
+        for phase, seconds in result["phases"].items():
+            change = ""
+            if old.get(phase):
+                change = "{:+.0%}".format(seconds / old[phase] - 1)
+            print(
+                "{:>10} {:>22} {:>10.3f} {:>10}".format(
+                    result["size"], phase, seconds, change
+                )
+            )
+        print(
+            "{:>10} {:>22} {:>10.3f} {:>10}".format(
+                result["size"], "wall", result["wall"], ""
+            )
+        )
+        print(
+            "{:>10} {:>22} {:>10.1f}".format(
+                result["size"], "peak RSS (MB)", result["peak_rss_mb"]
+            )
+        )
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--sizes", help="comma-separated grid sizes, e.g. 30,60")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs per size, keeping the fastest"
+    )
+    parser.add_argument(
+        "--engines",
+        default="graph,frontier",
+        help="comma-separated engines to step with (see ensemble.make_engine)",
+    )
+    parser.add_argument("--explicit-cliques", action="store_true")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="flag phases more than this fraction slower than the baseline",
+    )
+    parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=0.05,
+        help="ignore slowdowns smaller than this, which are mostly noise",
+    )
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    engines = args.engines.split(",")
+    implicit_cliques = not args.explicit_cliques
+
+    if args.worker:
+        result = run_size(args.worker, args.seed, args.steps, engines, implicit_cliques)
+        json.dump(result, sys.stdout)
+        return 0
+
+    if args.sizes:
+        sizes = [int(n) for n in args.sizes.split(",")]
+    else:
+        sizes = default_sizes(implicit_cliques)
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "steps": args.steps,
+            "repeat": args.repeat,
+            "engines": engines,
+            "implicit_cliques": implicit_cliques,
+        },
+        "results": [],
+    }
+    for n in sizes:
+        print(f"Benchmarking {n}x{n}", file=sys.stderr)
+        worker = [sys.executable, os.path.abspath(__file__), "--worker", str(n)]
+        worker += ["--seed", str(args.seed), "--steps", str(args.steps)]
+        worker += ["--engines", args.engines]
+        if args.explicit_cliques:
+            worker.append("--explicit-cliques")
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.run(worker, capture_output=True, text=True)
+            if output.returncode != 0:
+                print(output.stderr, file=sys.stderr)
+                break
+            runs.append(json.loads(output.stdout))
+        if len(runs) < args.repeat:
+            print(f"Stopping at {n}x{n}", file=sys.stderr)
+            break
+        results["results"].append(fastest(runs))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        for size, phase, before, after in regressions:
+            print(
+                f"REGRESSION {size} {phase}: {before:.3f} s -> {after:.3f} s",
+                file=sys.stderr,
+            )
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,61 +3,308 @@ Jonas Nockert (2020)
 
 Binary Space partitioned tree representing social groups on overlapping levels.
 
+The tree is stored as flat arrays in pre-order (node 0 is the root):
+
+- `bounds`: (xmin, xmax, ymin, ymax) of each node, inclusive,
+- `parent`: index of the parent node, -1 for the root,
+- `children`: indices of the left and right child, -1 for leaves,
+- `levels`: depth of each node, 0 for the root,
+- `centers`: (x, y) center of each node, as `Rect.center`.
+
+Leaves are numbered in the order `leaves` returns them and `leaf_ids` maps
+leaf numbers to node indices. `raster` is a (height, width) array giving the
+leaf number of every pixel. The tree is split iteratively, so deep trees do
+not run into the recursion limit. `BSP_Node` objects are kept for code that
+works with single nodes and are created from the arrays.
+
+Leaf colors are stored as indices into the palettes of `COLORMAPS` and only
+turned into RGB colors when first drawn, so that seaborn (and with it
+matplotlib) is not imported by simulations that never draw anything.
+
 """
+import functools
 import math
 import random
-import seaborn as sns
+import numpy as np
+
+from geometry import Rect, pairwise_distances
+
+
+COLORMAPS = ("GnBu", "YlOrRd")
+N_COLORS = 256
+
+
+@functools.lru_cache(maxsize=None)
+def color_palette(colormap):
+    import seaborn as sns
+
+    return sns.color_palette(colormap, N_COLORS)
+
+
+def index_color(color_index):
+    """RGB color of `color_index`, i.e. palette * N_COLORS + color."""
+    palette, k = divmod(int(color_index), N_COLORS)
+    return color_palette(COLORMAPS[palette])[k]
+
 
-from geometry import Rect
+def common_levels(ancestors, a, b):
+    """Level of the closest common ancestor of leaves `a` and `b` (arrays of
+    leaf numbers), given `BSP_Tree.ancestors`. The level of the leaf itself
+    where a == b."""
+    # Both ancestor paths start at the root, so the number of shared entries
+    # is one more than the level of the closest common ancestor.
+    shared = (ancestors[a] == ancestors[b]) & (ancestors[a] >= 0)
+    return np.sum(shared, axis=1) - 1
 
 
 class BSP_Tree:
 
-    def __init__(self, width, height):
-        self.root = BSP_Node(0, 0, width, height)
-        self.root.split()
-        self.colormap1 = "GnBu"
-        self.colormap2 = "YlOrRd"
-        self.colors1 = sns.color_palette(self.colormap1, 256)
-        self.colors2 = sns.color_palette(self.colormap2, 256)
+    def __init__(self, width, height, split=True):
+        if split:
+            bounds, levels, children = self.split(width, height)
+        else:
+            bounds = np.array([(0, width - 1, 0, height - 1)], dtype=np.int32)
+            levels = np.zeros(1, dtype=np.int32)
+            children = np.full((1, 2), -1, dtype=np.int32)
+        self.set_arrays(bounds, levels, children)
+        if split:
+            self.assign_colors()
 
-    def leaves(self):
-        queue = [self.root]
-        leaves = []
+    @staticmethod
+    def split(width, height):
+        """Split the area into leaves, returning (bounds, levels, children).
+
+        Nodes are split in pre-order, i.e. in the same order (and with the same
+        draws from `random`) as splitting each node and then recursing into its
+        left and right child.
+        """
+        bounds = []
+        levels = []
+        children = []
+        # (xmin, ymin, width, height, level, parent, side)
+        stack = [(0, 0, width, height, 0, -1, 0)]
+        while stack:
+            x, y, w, h, level, parent, side = stack.pop()
+            i = len(bounds)
+            bounds.append((x, x + w - 1, y, y + h - 1))
+            levels.append(level)
+            children.append([-1, -1])
+            if parent >= 0:
+                children[parent][side] = i
+
+            halves = BSP_Node.split_rect(x, y, w, h)
+            if halves is not None:
+                left, right = halves
+                stack.append((*right, level + 1, i, 1))
+                stack.append((*left, level + 1, i, 0))
+        return (
+            np.array(bounds, dtype=np.int32),
+            np.array(levels, dtype=np.int32),
+            np.array(children, dtype=np.int32),
+        )
+
+    def set_arrays(self, bounds, levels, children):
+        self.bounds = np.asarray(bounds, dtype=np.int32)
+        self.levels = np.asarray(levels, dtype=np.int32)
+        self.children = np.asarray(children, dtype=np.int32)
+        n_nodes = len(self.bounds)
+
+        self.parent = np.full(n_nodes, -1, dtype=np.int32)
+        inner = np.flatnonzero(self.children[:, 0] >= 0)
+        self.parent[self.children[inner, 0]] = inner
+        self.parent[self.children[inner, 1]] = inner
+
+        xmin, xmax, ymin, ymax = self.bounds.T
+        self.centers = np.column_stack(
+            (xmin + (xmax - xmin + 1) // 2, ymin + (ymax - ymin + 1) // 2)
+        )
+
+        # Leaves in the order of a stack traversal pushing the left child
+        # before the right one, which is the order nodes are numbered in.
+        leaf_ids = []
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            if self.children[i, 0] < 0:
+                leaf_ids.append(i)
+            else:
+                stack.append(self.children[i, 0])
+                stack.append(self.children[i, 1])
+        self.leaf_ids = np.array(leaf_ids, dtype=np.int32)
+        self.leaf_mask = self.children[:, 0] < 0
+
+        self.width = int(self.bounds[0, 1] + 1)
+        self.height = int(self.bounds[0, 3] + 1)
+        self.raster = np.empty((self.height, self.width), dtype=np.int32)
+        for k, (xmin, xmax, ymin, ymax) in enumerate(self.bounds[self.leaf_ids]):
+            self.raster[ymin : ymax + 1, xmin : xmax + 1] = k
+
+        self.node_objects = [
+            BSP_Node(
+                int(xmin),
+                int(ymin),
+                int(xmax - xmin + 1),
+                int(ymax - ymin + 1),
+                level=int(level),
+                index=i,
+            )
+            for i, ((xmin, xmax, ymin, ymax), level) in enumerate(
+                zip(self.bounds, self.levels)
+            )
+        ]
+        for node, (left, right) in zip(self.node_objects, self.children):
+            if left >= 0:
+                node.left = self.node_objects[left]
+                node.right = self.node_objects[right]
+        self.root = self.node_objects[0]
+        self.set_color_index(np.full(n_nodes, -1, dtype=np.int32))
+
+    @property
+    def colors1(self):
+        return color_palette(COLORMAPS[0])
+
+    @property
+    def colors2(self):
+        return color_palette(COLORMAPS[1])
+
+    def set_color_index(self, color_index):
+        self.color_index = np.asarray(color_index, dtype=np.int32)
+        for node, k in zip(self.node_objects, self.color_index.tolist()):
+            node.color_index = k
+
+    def assign_colors(self):
+        """Give each leaf a random color, alternating between two colormaps
+        in traversal order."""
+        # The colormap alternates with the traversal counter of `leaves` as
+        # it was before the tree was stored as arrays, which counts inner
+        # nodes as well.
+        color_index = np.full(len(self.bounds), -1, dtype=np.int32)
         counter = 0
-        while queue:
-            node = queue.pop()
-            if node.is_leaf():
-                if counter % 2 == 0:
-                    color = self.colors1[random.randrange(256)]
-                else:
-                    color = self.colors2[random.randrange(256)]
-                node.color = color
-                leaves.append(node)
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            if self.leaf_mask[i]:
+                color_index[i] = (counter % 2) * N_COLORS + random.randrange(N_COLORS)
             else:
-                queue.append(node.left)
-                queue.append(node.right)
+                stack.append(self.children[i, 0])
+                stack.append(self.children[i, 1])
             counter += 1
-        return leaves
+        self.set_color_index(color_index)
+
+    def leaves(self):
+        return [self.node_objects[i] for i in self.leaf_ids]
+
+    def nodes(self):
+        """All tree nodes in pre-order."""
+        return list(self.node_objects)
+
+    @property
+    def n_leaves(self):
+        return len(self.leaf_ids)
+
+    def leaf_bounds(self):
+        return self.bounds[self.leaf_ids]
+
+    def leaf_sizes(self):
+        xmin, xmax, ymin, ymax = self.leaf_bounds().T.astype(np.int64)
+        return (xmax - xmin + 1) * (ymax - ymin + 1)
+
+    def leaf_centers(self):
+        return self.centers[self.leaf_ids]
+
+    def leaf_levels(self):
+        return self.levels[self.leaf_ids]
+
+    def leaf_at(self, x, y):
+        """Leaf number of the given pixel(s)."""
+        return self.raster[y, x]
+
+    def ancestors(self):
+        """(leaves, depth + 1) array of the ancestor of each leaf at every level
+        (the leaf itself at its own level), -1 below the leaf."""
+        depth = int(self.levels.max())
+        ancestors = np.full((self.n_leaves, depth + 1), -1, dtype=np.int32)
+        current = self.leaf_ids.copy()
+        levels = self.levels[current]
+        rows = np.arange(self.n_leaves)
+        while True:
+            valid = current >= 0
+            if not valid.any():
+                break
+            ancestors[rows[valid], levels[valid]] = current[valid]
+            current = np.where(valid, self.parent[np.maximum(current, 0)], -1)
+            levels = levels - 1
+        return ancestors
+
+    def groups(self, level):
+        """Group (node index) of each leaf at `level`: its ancestor at that
+        level, or the leaf itself if it is shallower."""
+        ancestors = self.ancestors()
+        level = min(level, ancestors.shape[1] - 1)
+        groups = ancestors[:, level]
+        return np.where(groups >= 0, groups, self.leaf_ids)
+
+    def to_arrays(self):
+        """Tree nodes as arrays in pre-order, e.g. for saving to disk.
+
+        `children` holds the indices of the left and right child (-1 for
+        leaves) and `color_index` the leaf colors (-1 for inner nodes), see
+        `index_color`.
+        """
+        return {
+            "bounds": self.bounds,
+            "levels": self.levels,
+            "children": self.children,
+            "color_index": self.color_index,
+        }
+
+    @classmethod
+    def from_arrays(cls, bounds, levels, children, color_index):
+        """Rebuild a tree saved with `to_arrays`. Returns the tree and its nodes."""
+        width = int(bounds[0][1] + 1)
+        height = int(bounds[0][3] + 1)
+        tree = cls(width, height, split=False)
+        tree.set_arrays(bounds, levels, children)
+        tree.set_color_index(color_index)
+        return tree, tree.nodes()
+
+    def leaf_distances(self, nodes=None):
+        """Matrix of relative distances (see `relative_distance`) between the
+        centres of all leaves, or of the tree nodes with indices `nodes`."""
+        nodes = self.leaf_ids if nodes is None else nodes
+        centers = self.centers[nodes]
+        max_d = math.sqrt(self.width ** 2 + self.height ** 2)
+        return pairwise_distances(centers) / max_d
 
     def relative_distance(self, n1, n2):
-        c1 = n1.center()
-        c2 = n2.center()
-        d = math.sqrt((c1.x - c2.x) ** 2 + (c1.y - c2.y) ** 2)
-        max_d = math.sqrt(self.root.rect.width ** 2 + self.root.rect.height ** 2)
-        return d / max_d
+        """Distance between the centres of two nodes, relative to the diagonal."""
+        dx, dy = (self.centers[n1.index] - self.centers[n2.index]).tolist()
+        max_d = math.sqrt(self.width ** 2 + self.height ** 2)
+        return math.sqrt(dx ** 2 + dy ** 2) / max_d
 
 
 class BSP_Node:
     MIN_SIZE = 2
 
-    def __init__(self, x, y, width, height, level=0):
+    def __init__(self, x, y, width, height, level=0, index=None):
         self.left = None
         self.right = None
         self.level = level
-        self.color = None
+        self.index = index
+        self.color_index = -1
+        self._color = None
         self.rect = Rect(x, x + width - 1, y, y + height - 1)
 
+    @property
+    def color(self):
+        if self._color is None and self.color_index >= 0:
+            self._color = index_color(self.color_index)
+        return self._color
+
+    @color.setter
+    def color(self, color):
+        self._color = color
+
     def is_leaf(self):
         return not self.left and not self.right
 
@@ -67,62 +314,40 @@ class BSP_Node:
     def get_points(self):
         return self.rect.get_points()
 
-    def split(self):
-        # Already split?
-        if not self.is_leaf():
-            return
+    @classmethod
+    def split_rect(cls, x, y, width, height):
+        """Randomly split a rectangle in two.
 
+        Returns ((x, y, width, height), (x, y, width, height)) for the two
+        halves, or None if the rectangle is too small to split.
+        """
         split_horizontally = random.choice([True, False])
-        if self.rect.ratio_wh >= 1.25:
+        if width / height >= 1.25:
             split_horizontally = False
-        elif self.rect.ratio_hw >= 1.25:
+        elif height / width >= 1.25:
             split_horizontally = True
 
         if split_horizontally:
-            max_size = self.rect.height
+            max_size = height
         else:
-            max_size = self.rect.width
+            max_size = width
 
-        if max_size <= 2 * self.MIN_SIZE:
-            return
+        if max_size <= 2 * cls.MIN_SIZE:
+            return None
 
-        split_at = random.randint(self.MIN_SIZE, max_size - self.MIN_SIZE)
+        split_at = random.randint(cls.MIN_SIZE, max_size - cls.MIN_SIZE)
         if split_horizontally:
             # |   |
             # -----
             # |   |
-            self.left = BSP_Node(
-                self.rect.xmin,
-                self.rect.ymin,
-                self.rect.width,
-                split_at,
-                level=self.level + 1,
-            )
-            self.right = BSP_Node(
-                self.rect.xmin,
-                self.rect.ymin + split_at,
-                self.rect.width,
-                self.rect.height - split_at,
-                level=self.level + 1,
-            )
-        else:
-            # -------
-            # |  |  |
-            # -------
-            self.left = BSP_Node(
-                self.rect.xmin,
-                self.rect.ymin,
-                split_at,
-                self.rect.height,
-                level=self.level + 1,
-            )
-            self.right = BSP_Node(
-                self.rect.xmin + split_at,
-                self.rect.ymin,
-                self.rect.width - split_at,
-                self.rect.height,
-                level=self.level + 1,
+            return (
+                (x, y, width, split_at),
+                (x, y + split_at, width, height - split_at),
             )
-
-        self.left.split()
-        self.right.split()
+        # -------
+        # |  |  |
+        # -------
+        return (
+            (x, y, split_at, height),
+            (x + split_at, y, width - split_at, height),
+        )
@@ -0,0 +1,217 @@
+"""
+Jonas Nockert (2020)
+
+On-disk cache of generated contact networks.
+
+Building the contact network for a large grid takes far longer than loading
+it, so a built network (BSP tree with its leaf partition and colors, node
+coordinates and the CSR contact graph) is written to one binary file keyed by
+grid size, seed and generation parameters. On load the arrays are memory-mapped
+straight from the file.
+
+File layout: an 8 byte magic string, the header length as a little-endian
+uint64, a JSON header describing each array (dtype, shape, offset) and then the
+raw arrays, each aligned to 64 bytes.
+
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+import random
+import struct
+import tempfile
+
+import numpy as np
+
+from bsp import BSP_Node, BSP_Tree
+from contacts import ContactGraph
+from graph import Graph, Node
+from instrumentation import instrument
+
+
+MAGIC = b"OBNET\x00\x00\x01"
+ALIGNMENT = 64
+# Bump when the network generation changes so that old entries are not reused.
+NETWORK_VERSION = 3
+
+
+def write_arrays(path, arrays, meta=None):
+    """Write a dict of arrays (and JSON-serializable `meta`) to `path`."""
+    header = {"meta": meta or {}, "arrays": {}}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        header["arrays"][name] = {
+            "dtype": array.dtype.str,
+            "shape": array.shape,
+            "offset": offset,
+        }
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+    header_bytes = header_bytes.ljust(data_start - len(MAGIC) - 8)
+
+    # Write to a temporary file first so that readers never see partial files.
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_arrays(path, mmap=True):
+    """Read a file written by `write_arrays`. Returns (arrays, meta)."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an array file")
+        (header_length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_length))
+    data_start = len(MAGIC) + 8 + header_length
+
+    arrays = {}
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"])
+        shape = tuple(info["shape"])
+        offset = data_start + info["offset"]
+        if mmap and np.prod(shape) > 0:
+            arrays[name] = np.memmap(path, dtype, "r", offset=offset, shape=shape)
+        else:
+            count = int(np.prod(shape))
+            with open(path, "rb") as f:
+                f.seek(offset)
+                arrays[name] = np.fromfile(f, dtype, count).reshape(shape)
+    return arrays, header["meta"]
+
+
+def network_arrays(graph):
+    tree = graph.tree.to_arrays()
+    arrays = {
+        "tree_bounds": tree["bounds"],
+        "tree_levels": tree["levels"],
+        "tree_children": tree["children"],
+        "tree_color_index": tree["color_index"],
+        "leaves": np.array([leaf.index for leaf in graph.leaves], np.int32),
+        "leaf_offsets": graph.leaf_offsets,
+        "x": graph.x,
+        "y": graph.y,
+        "indptr": graph.base_contacts.indptr,
+        "indices": graph.base_contacts.indices,
+    }
+    if graph.base_contacts.cliques is not None:
+        arrays["cliques"] = graph.base_contacts.cliques
+    return arrays
+
+
+def graph_from_arrays(n1, n2, arrays, nodes=True):
+    """The graph stored in `arrays`. With `nodes=False` no `Node` objects are
+    created, which is enough for the array-based engines."""
+    tree, tree_nodes = BSP_Tree.from_arrays(
+        arrays["tree_bounds"],
+        arrays["tree_levels"],
+        arrays["tree_children"],
+        arrays["tree_color_index"],
+    )
+    graph = Graph(n1, n2, tree=tree)
+    graph.leaves = [tree_nodes[i] for i in arrays["leaves"]]
+    graph.leaf_offsets = np.array(arrays["leaf_offsets"])
+
+    graph.x = np.array(arrays["x"])
+    graph.y = np.array(arrays["y"])
+    if nodes:
+        leaf_of = np.repeat(np.arange(len(graph.leaves)), np.diff(graph.leaf_offsets))
+        graph.nodes = [
+            Node(i, graph.leaves[leaf], x, y, graph.census)
+            for i, (leaf, x, y) in enumerate(
+                zip(leaf_of.tolist(), graph.x.tolist(), graph.y.tolist())
+            )
+        ]
+    graph.set_contacts(
+        ContactGraph(arrays["indptr"], arrays["indices"], cliques=arrays.get("cliques"))
+    )
+    return graph
+
+
+class NetworkCache:
+    def __init__(self, directory=".cache/networks", max_bytes=2 ** 30):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(n1, n2, seed, **params):
+        params = {
+            "n1": n1,
+            "n2": n2,
+            "seed": seed,
+            "min_size": BSP_Node.MIN_SIZE,
+            "version": NETWORK_VERSION,
+            **params,
+        }
+        encoded = json.dumps(params, sort_keys=True).encode("utf-8")
+        return hashlib.sha1(encoded).hexdigest()
+
+    def path(self, key):
+        return self.directory / f"{key}.net"
+
+    def load(self, n1, n2, seed, nodes=True, **params):
+        """Cached graph for the given parameters, or None on a cache miss.
+
+        With `nodes=False` no `Node` objects are created (see
+        `graph_from_arrays`), which makes loading a large network much faster.
+        """
+        path = self.path(self.key(n1, n2, seed, **params))
+        if not path.exists():
+            self.misses += 1
+            instrument.message(f"Network cache miss: {path}")
+            return None
+
+        self.hits += 1
+        instrument.message(f"Network cache hit: {path}")
+        # Mark as recently used for eviction.
+        os.utime(path)
+        arrays, meta = read_arrays(path)
+        return graph_from_arrays(meta["n1"], meta["n2"], arrays, nodes=nodes)
+
+    def save(self, graph, seed, **params):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(self.key(graph.n1, graph.n2, seed, **params))
+        meta = {"n1": graph.n1, "n2": graph.n2, "seed": seed, "params": params}
+        write_arrays(path, network_arrays(graph), meta)
+        self.evict()
+        return path
+
+    def get_or_build(self, n1, n2, seed, nodes=True, **params):
+        """Load the network from the cache, building and caching it on a miss.
+
+        The network is built with `random` and `np.random` seeded with `seed`
+        and `params` passed on to `Graph.adjacency_matrix`. `nodes` is passed
+        on to `load`; a freshly built graph always has its `Node` objects.
+        """
+        graph = self.load(n1, n2, seed, nodes=nodes, **params)
+        if graph is None:
+            random.seed(seed)
+            np.random.seed(seed)
+            graph = Graph(n1, n2)
+            graph.adjacency_matrix(**params)
+            self.save(graph, seed, **params)
+        return graph
+
+    def evict(self):
+        """Remove least recently used entries until below `max_bytes`."""
+        entries = sorted(self.directory.glob("*.net"), key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in entries)
+        # The newest entry is kept even if it alone exceeds the limit.
+        while len(entries) > 1 and total > self.max_bytes:
+            path = entries.pop(0)
+            total -= path.stat().st_size
+            instrument.message(f"Network cache evicting: {path}")
+            path.unlink()
@@ -0,0 +1,329 @@
+"""
+Jonas Nockert (2020)
+
+Checkpoints of a running simulation.
+
+`save_checkpoint` writes everything needed to continue a run to one binary
+file in the format of `cache.write_arrays`: the contact network (unless left
+out), the engine's per-node state and counters, the graph's time, state and
+active interventions, the stats so far and the state of `random`, `np.random`
+and the duration samplers (including values they have drawn ahead).
+`load_checkpoint` restores it, after which stepping continues exactly as the
+original run would have.
+
+Per-node state is stored in the smallest types that hold it (int8 states)
+while counters keep their full float64 precision, as rounding them would
+change when nodes move on. Interventions are stored by their parameters and
+reapplied to the network on load.
+
+Checkpoints hold a `CHECKPOINT_VERSION`; files of other versions are
+rejected.
+
+"""
+import random
+
+import numpy as np
+
+from cache import graph_from_arrays, network_arrays, read_arrays, write_arrays
+from cohort import CohortEngine
+from engine import ArrayEngine, FrontierEngine
+from events import EventEngine
+from graph import Graph, GraphState, Node, NodeState
+import interventions
+from timeseries import StatsBuffer
+
+
+CHECKPOINT_VERSION = 1
+
+# Engine classes by the name `ensemble.make_engine` knows them by.
+ENGINES = {
+    "graph": Graph,
+    "array": ArrayEngine,
+    "frontier": FrontierEngine,
+    "events": EventEngine,
+    "cohort": CohortEngine,
+}
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def engine_name(engine):
+    for name, cls in ENGINES.items():
+        if type(engine) is cls:
+            return name
+    raise CheckpointError(f"Cannot checkpoint a {type(engine).__name__}")
+
+
+def to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def intervention_params(intervention):
+    return {
+        "type": type(intervention).__name__,
+        "params": {key: to_json(value) for key, value in vars(intervention).items()},
+    }
+
+
+def intervention_from_params(params):
+    cls = getattr(interventions, params["type"], None)
+    if not (isinstance(cls, type) and issubclass(cls, interventions.Intervention)):
+        raise CheckpointError(f"Unknown intervention {params['type']}")
+    return cls(**params["params"])
+
+
+def sampler_state(sampler, arrays, name):
+    arrays[f"{name}_buffer"] = sampler.buffer
+    return {
+        "position": sampler.position,
+        "table_size": None if sampler.table is None else len(sampler.table),
+        "rng": None if sampler.rng is None else sampler.rng.bit_generator.state,
+    }
+
+
+def restore_sampler(sampler, state, arrays, name):
+    if state["table_size"] is None:
+        sampler.quantiles = None
+        sampler.table = None
+    elif sampler.table is None or len(sampler.table) != state["table_size"]:
+        sampler.use_table(state["table_size"])
+    if state["rng"] is None:
+        sampler.rng = None
+    else:
+        sampler.rng = np.random.Generator(
+            getattr(np.random, state["rng"]["bit_generator"])()
+        )
+        sampler.rng.bit_generator.state = state["rng"]
+    sampler.buffer = np.array(arrays[f"{name}_buffer"])
+    sampler.position = state["position"]
+
+
+def engine_state(engine, name):
+    """(arrays, meta) of the per-node state of `engine`."""
+    if name == "graph":
+        nodes = engine.nodes
+        arrays = {
+            "state": np.fromiter(
+                (node.state.value for node in nodes), np.int8, len(nodes)
+            ),
+            "counter": np.fromiter(
+                (float(np.squeeze(node.counter)) for node in nodes),
+                np.float64,
+                len(nodes),
+            ),
+            "infection_rate": np.fromiter(
+                (node.infection_rate for node in nodes), np.float64, len(nodes)
+            ),
+        }
+        return arrays, {"cumulative": engine.census.cumulative}
+
+    if name == "cohort":
+        arrays = {
+            "latent": engine.latent,
+            "infectious": engine.infectious,
+            "susceptible": engine.susceptible,
+            "recovered": engine.recovered,
+        }
+        meta = {
+            "cumulative": engine.cumulative,
+            "expected": engine.expected,
+            "contact_scale": engine.contact_scale,
+            "infection_rate": engine.infection_rate,
+        }
+        return arrays, meta
+
+    arrays = {"state": engine.state, "infection_rate": engine.infection_rate}
+    meta = {"cumulative": engine.cumulative}
+    if name == "events":
+        queue = engine.queue
+        arrays["next_transition"] = engine.next_transition
+        arrays["queue_time"] = np.array([event[0] for event in queue], np.float64)
+        arrays["queue_event"] = np.array(
+            [event[1:] for event in queue], np.int64
+        ).reshape(-1, 4)
+        meta["time"] = engine.time
+        meta["contacts_version"] = engine.contacts_version
+    else:
+        arrays["counter"] = engine.counter
+    if name == "frontier":
+        arrays["active"] = engine.active
+    return arrays, meta
+
+
+def restore_engine(graph, name, arrays, meta):
+    if name == "graph":
+        state = arrays["state"].tolist()
+        counter = arrays["counter"].tolist()
+        rate = arrays["infection_rate"].tolist()
+        for node, s, c, r in zip(graph.nodes, state, counter, rate):
+            node.state = NodeState(s)
+            node.counter = c
+            node.infection_rate = r
+        graph.census.counts = np.bincount(
+            arrays["state"], minlength=len(graph.census.counts)
+        ).tolist()
+        graph.census.cumulative = meta["cumulative"]
+        return graph
+
+    if name == "cohort":
+        engine = CohortEngine(
+            graph,
+            contacts="expected" if meta["expected"] else "graph",
+            infection_rate=meta["infection_rate"],
+        )
+        for key in ("latent", "infectious", "susceptible", "recovered"):
+            setattr(engine, key, np.array(arrays[key]))
+        engine.cumulative = meta["cumulative"]
+        if engine.contact_scale != meta["contact_scale"]:
+            engine.contact_scale = meta["contact_scale"]
+            engine.load_contacts()
+        return engine
+
+    engine = ENGINES[name](graph)
+    engine.state = np.array(arrays["state"])
+    engine.infection_rate = np.array(arrays["infection_rate"])
+    engine.counts = np.bincount(engine.state, minlength=len(engine.counts))
+    engine.cumulative = meta["cumulative"]
+    if name == "events":
+        engine.next_transition = np.array(arrays["next_transition"])
+        engine.queue = [
+            (time, *event)
+            for time, event in zip(
+                arrays["queue_time"].tolist(), arrays["queue_event"].tolist()
+            )
+        ]
+        # Stored in heap order, so no need to heapify.
+        engine.time = meta["time"]
+        engine.contacts_version = meta["contacts_version"]
+    else:
+        engine.counter = np.array(arrays["counter"])
+    if name == "frontier":
+        engine.active = np.array(arrays["active"])
+    return engine
+
+
+def save_checkpoint(path, engine, network=True):
+    """Write the state of a simulation run by `engine` (an engine or, for the
+    `Node`-based engine, the `Graph`) to `path`.
+
+    With `network=False` the contact network is left out, and the same
+    network must be passed to `load_checkpoint`. The graph's event log, if
+    any, is synced first so that it can be resumed along with the checkpoint.
+    """
+    name = engine_name(engine)
+    graph = engine if name == "graph" else engine.graph
+    # A log resumed with the checkpoint continues from what is on disk.
+    if graph.event_log is not None:
+        graph.event_log.sync()
+
+    arrays = {}
+    if network:
+        arrays.update(
+            {f"network_{key}": value for key, value in network_arrays(graph).items()}
+        )
+    state, engine_meta = engine_state(engine, name)
+    arrays.update({f"engine_{key}": value for key, value in state.items()})
+    arrays["stats"] = graph.stats.array()
+
+    np_state = np.random.get_state()
+    arrays["np_random_keys"] = np_state[1]
+    samplers = {
+        sampler_name: sampler_state(sampler, arrays, f"sampler_{sampler_name}")
+        for sampler_name, sampler in zip(
+            ("latent_period", "infectious_duration"), Node.distributions.samplers()
+        )
+    }
+
+    meta = {
+        "version": CHECKPOINT_VERSION,
+        "engine": name,
+        "n1": graph.n1,
+        "n2": graph.n2,
+        "n_nodes": int(graph.leaf_offsets[-1]),
+        "network": network,
+        "t": graph.t,
+        "graph_state": graph.state.value,
+        "physical_distancing_t": graph.physical_distancing_t,
+        "opening_up_t": graph.opening_up_t,
+        "interventions": [intervention_params(i) for i in graph.interventions],
+        "engine_meta": engine_meta,
+        "random_state": to_json(random.getstate()),
+        "np_random_state": [np_state[0], *np_state[2:]],
+        "samplers": samplers,
+    }
+    write_arrays(path, arrays, meta)
+
+
+def load_checkpoint(path, graph=None):
+    """Restore a simulation saved with `save_checkpoint`.
+
+    Returns the engine (the `Graph` for the `Node`-based engine) with its
+    graph in `engine.graph`. `graph` is a freshly built graph with the same
+    contact network, needed if the network was not saved and used instead
+    of the saved one otherwise.
+    """
+    arrays, meta = read_arrays(path)
+    if meta.get("version") != CHECKPOINT_VERSION:
+        raise CheckpointError(
+            f"{path} has checkpoint version {meta.get('version')}, "
+            f"expected {CHECKPOINT_VERSION}"
+        )
+
+    if graph is None:
+        if not meta["network"]:
+            raise CheckpointError(f"{path} holds no network, pass the graph")
+        graph = graph_from_arrays(
+            meta["n1"],
+            meta["n2"],
+            {
+                key[len("network_") :]: value
+                for key, value in arrays.items()
+                if key.startswith("network_")
+            },
+            nodes=meta["engine"] == "graph",
+        )
+    elif graph.leaf_offsets[-1] != meta["n_nodes"]:
+        raise CheckpointError(f"{path} is for a graph of {meta['n_nodes']} nodes")
+    elif meta["engine"] == "graph" and not graph.nodes:
+        raise CheckpointError(f"{path} needs a graph with `Node` objects")
+
+    graph.t = meta["t"]
+    graph.state = GraphState(meta["graph_state"])
+    graph.physical_distancing_t = meta["physical_distancing_t"]
+    graph.opening_up_t = meta["opening_up_t"]
+    graph.stats = StatsBuffer.from_array(arrays["stats"])
+    graph.interventions = [
+        intervention_from_params(params) for params in meta["interventions"]
+    ]
+    graph.set_contacts(graph.base_contacts)
+
+    state = {
+        key[len("engine_") :]: value
+        for key, value in arrays.items()
+        if key.startswith("engine_")
+    }
+    engine = restore_engine(graph, meta["engine"], state, meta["engine_meta"])
+
+    # Restored last, as setting up the engine may draw random numbers.
+    version, internal, gauss_next = meta["random_state"]
+    random.setstate((version, tuple(internal), gauss_next))
+    kind, pos, has_gauss, cached_gaussian = meta["np_random_state"]
+    np.random.set_state(
+        (kind, np.array(arrays["np_random_keys"]), pos, has_gauss, cached_gaussian)
+    )
+    for sampler_name, sampler in zip(
+        ("latent_period", "infectious_duration"), Node.distributions.samplers()
+    ):
+        restore_sampler(
+            sampler,
+            meta["samplers"][sampler_name],
+            arrays,
+            f"sampler_{sampler_name}",
+        )
+    return engine
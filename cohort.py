@@ -0,0 +1,267 @@
+"""
+Jonas Nockert (2020)
+
+Cohort (time-since-infection) SEIR engine.
+
+Instead of individuals, each BSP leaf is tracked as counts: susceptible,
+recovered, and latent and infectious cohorts by the number of days since they
+entered their state. The latent period and infectious duration distributions
+are discretised once into daily hazards, matching the fixed-step engines where
+a node stays in a state for ceil(D) + 1 steps for a drawn duration D, and each
+step moves a binomially drawn part of every cohort on to the next state.
+
+Transmission is mean-field within and between leaves. For a susceptible in
+leaf l, the log-probability of escaping infection is
+
+    sum_m A[l, m] / n_l * I_m / n_m
+
+where I_m is the number of infectious in leaf m and A[l, m] sums log(1 - p * w)
+over the contacts between members of l and m (for l == m, the denominator is
+n_l - 1). Within a leaf, where everyone is in contact with everyone else, this
+is exact. A is built from `graph.contacts`, so interventions are taken into
+account, or, with `contacts="expected"`, from the expected number of contacts
+between leaves implied by `Graph.adjacency_matrix` without building any
+contacts (or nodes) at all. The latter is a dense leaves x leaves float32
+matrix, as nearly every pair of leaves has some expected contact.
+
+The cost of a step scales with the number of leaves times the number of days
+in the hazard tables, not with the number of people or contacts, which makes
+the engine a fast approximate mode for scanning scenarios.
+
+"""
+import math
+
+import numpy as np
+from scipy import sparse
+
+from geometry import pairwise_distances
+from graph import GraphState, Node
+from instrumentation import instrument
+
+
+def duration_hazards(dist, tail=1e-6):
+    """Daily hazards h[k] of leaving a state at the k-th step after entering
+    it, given that it has not been left before.
+
+    A duration D drawn from `dist` is left at step K = ceil(D) + 1, i.e.
+    P(K <= k) = P(D <= k - 1). The last hazard is 1, cutting off the
+    distribution at its `1 - tail` quantile.
+    """
+    k_max = int(math.ceil(dist.ppf(1 - tail))) + 1
+    k = np.arange(k_max + 1)
+    cdf = np.where(k >= 1, dist.cdf(k - 1), 0.0)
+    pmf = np.diff(cdf, prepend=0.0)
+    # P(K >= k)
+    survival = 1 - np.concatenate(([0.0], cdf[:-1]))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        hazards = np.where(survival > 0, pmf / survival, 1.0)
+    hazards[-1] = 1.0
+    return np.clip(hazards, 0, 1)
+
+
+class CohortEngine:
+    distributions = Node.distributions
+
+    def __init__(self, graph, contacts="graph", infection_rate=0.01):
+        self.graph = graph
+        self.infection_rate = infection_rate
+        self.sizes = graph.tree.leaf_sizes()
+        self.N = int(self.sizes.sum())
+        n_leaves = len(self.sizes)
+
+        self.latent_hazards = duration_hazards(self.distributions.latent_period_dist)
+        self.infectious_hazards = duration_hazards(
+            self.distributions.infectious_duration_dist
+        )
+        # Column k holds those that entered the state k steps ago.
+        self.latent = np.zeros((n_leaves, len(self.latent_hazards) - 1), dtype=np.int64)
+        self.infectious = np.zeros(
+            (n_leaves, len(self.infectious_hazards) - 1), dtype=np.int64
+        )
+        self.susceptible = self.sizes.astype(np.int64)
+        self.recovered = np.zeros(n_leaves, dtype=np.int64)
+        self.cumulative = 0
+
+        self.expected = contacts == "expected"
+        if contacts not in ("graph", "expected"):
+            raise ValueError(f"Unknown contacts '{contacts}'")
+        # Scales the expected contacts for physical distancing.
+        self.contact_scale = 1.0
+        self.contacts = None
+        self.load_contacts()
+
+    @property
+    def t(self):
+        return self.graph.t
+
+    @property
+    def stats(self):
+        return self.graph.stats
+
+    def expected_leaf_contacts(self, block_size=1024):
+        """Dense (float32) matrix of the expected number of contacts between the
+        members of two leaves, as generated by `Graph.adjacency_matrix`.
+
+        Built in blocks of rows to keep temporaries small.
+        """
+        tree = self.graph.tree
+        sizes = self.sizes.astype(np.float64)
+        centers = tree.leaf_centers()
+        max_d = math.sqrt(tree.width ** 2 + tree.height ** 2)
+        n_leaves = len(sizes)
+        expected = np.empty((n_leaves, n_leaves), dtype=np.float32)
+        columns = np.arange(n_leaves)
+        for start in range(0, n_leaves, block_size):
+            rows = np.arange(start, min(start + block_size, n_leaves))
+            d = pairwise_distances(centers[rows], centers) / max_d
+            # The pair (i, j), i < j, gets int(n_j * 0.2 * X) contacts for X
+            # exponential with mean 2 * (1 - d) / 3, and
+            # E[int(Y)] = 1 / expm1(1 / mean) for exponential Y.
+            later = np.where(
+                columns[None, :] > rows[:, None], sizes[None, :], sizes[rows, None]
+            )
+            mean = later * 0.2 * 2 * (1 - d) / 3
+            with np.errstate(divide="ignore", over="ignore"):
+                expected[rows] = 1 / np.expm1(1 / mean)
+        # Everyone in a leaf has contact with everyone else in the leaf,
+        # counted once per direction as in the CSR matrix.
+        expected[np.diag_indices_from(expected)] = sizes * (sizes - 1)
+        return expected
+
+    def load_contacts(self):
+        """(Re)compute the leaf-to-leaf log-escape matrix as an off-diagonal
+        part, a diagonal and a common factor."""
+        if self.expected:
+            if self.contacts is None:
+                self.contacts = self.expected_leaf_contacts()
+                self.log_escape_diagonal = np.diag(self.contacts).astype(np.float64)
+                np.fill_diagonal(self.contacts, 0)
+                self.log_escape = self.contacts
+            self.log_escape_factor = math.log1p(
+                -self.infection_rate * self.contact_scale
+            )
+            return
+
+        contacts = self.graph.contacts
+        self.contacts = contacts
+        n_leaves = len(self.sizes)
+        leaf_of = np.repeat(np.arange(n_leaves), self.sizes)
+        rows = leaf_of[contacts.rows()]
+        cols = leaf_of[contacts.indices]
+        weights = 1.0 if contacts.weights is None else contacts.weights
+        values = np.broadcast_to(
+            np.log1p(-self.infection_rate * np.asarray(weights, dtype=np.float64)),
+            rows.shape,
+        )
+        # Duplicate entries are summed.
+        log_escape = sparse.coo_matrix(
+            (values, (rows, cols)), shape=(n_leaves, n_leaves)
+        ).tocsr()
+        diagonal = log_escape.diagonal()
+        if contacts.cliques is not None:
+            sizes = self.sizes.astype(np.float64)
+            diagonal = diagonal + sizes * (sizes - 1) * np.log1p(
+                -self.infection_rate * contacts.clique_weights
+            )
+        self.log_escape_diagonal = diagonal
+        log_escape.setdiag(0)
+        log_escape.eliminate_zeros()
+        self.log_escape = log_escape
+        self.log_escape_factor = 1.0
+
+    def infect_random(self, n=1):
+        """Make n uniformly drawn people infectious. Returns them as node
+        indices, which number people leaf by leaf as in the other engines."""
+        people = np.random.randint(self.N, size=n)
+        leaves = np.searchsorted(np.cumsum(self.sizes), people, side="right")
+        counts = np.bincount(leaves, minlength=len(self.sizes))
+        counts = np.minimum(counts, self.susceptible)
+        self.susceptible -= counts
+        self.infectious[:, 0] += counts
+        self.cumulative += int(counts.sum())
+        return list(people)
+
+    def physical_distancing(self, rate=0.5):
+        if self.expected:
+            self.graph.state = GraphState.PHYSICAL_DISTANCING
+            self.graph.physical_distancing_t = self.graph.t
+            self.contact_scale = rate
+            self.load_contacts()
+            return None
+        return self.graph.physical_distancing(rate=rate)
+
+    def opening_up(self, rate=None):
+        if self.expected:
+            self.graph.state = GraphState.OPENING_UP
+            self.graph.opening_up_t = self.graph.t
+            self.contact_scale = 1.0 if rate is None else rate
+            self.load_contacts()
+        else:
+            self.graph.opening_up(rate=rate)
+
+    @staticmethod
+    def advance_cohorts(cohorts, hazards):
+        """Age all cohorts by one step. Returns the number leaving per leaf."""
+        # Most cohorts are empty outside the peak; only draw for the others.
+        occupied = np.nonzero(cohorts)
+        leaving = np.zeros_like(cohorts)
+        leaving[occupied] = np.random.binomial(
+            cohorts[occupied], hazards[1:][occupied[1]]
+        )
+        remaining = cohorts - leaving
+        cohorts[:, 1:] = remaining[:, :-1]
+        cohorts[:, 0] = 0
+        return leaving.sum(axis=1)
+
+    def pre_step(self):
+        to_infectious = self.advance_cohorts(self.latent, self.latent_hazards)
+        to_recovered = self.advance_cohorts(self.infectious, self.infectious_hazards)
+        self.infectious[:, 0] = to_infectious
+        self.recovered += to_recovered
+        instrument.count("transitions", to_infectious.sum() + to_recovered.sum())
+
+    def transmit(self):
+        if not self.expected and self.contacts is not self.graph.contacts:
+            self.load_contacts()
+        infectious = self.infectious.sum(axis=1)
+        sizes = self.sizes.astype(np.float64)
+        log_escape = (
+            self.log_escape_factor
+            * (
+                self.log_escape @ (infectious / sizes).astype(self.log_escape.dtype)
+                + self.log_escape_diagonal * infectious / np.maximum(sizes - 1, 1)
+            )
+            / sizes
+        )
+        infected = np.zeros_like(self.susceptible)
+        exposed = np.flatnonzero((log_escape < 0) & (self.susceptible > 0))
+        infected[exposed] = np.random.binomial(
+            self.susceptible[exposed], -np.expm1(log_escape[exposed])
+        )
+        self.susceptible -= infected
+        self.latent[:, 0] = infected
+        self.cumulative += int(infected.sum())
+        instrument.count("infections", infected.sum())
+
+    def census(self):
+        """(S, E, I, R, cumulative infected), as `Census.totals`."""
+        totals = (
+            int(self.susceptible.sum()),
+            int(self.latent.sum()),
+            int(self.infectious.sum()),
+            int(self.recovered.sum()),
+            self.cumulative,
+        )
+        assert self.N == sum(totals[:4])
+        return totals
+
+    def step(self):
+        self.graph.t += 1
+        instrument.tick(self.graph.t)
+
+        with instrument.phase("pre_step"):
+            self.pre_step()
+        with instrument.phase("transmission"):
+            self.transmit()
+        with instrument.phase("census"):
+            self.graph.stats.append(self.graph.t, *self.census())
@@ -0,0 +1,286 @@
+"""
+Jonas Nockert (2020)
+
+Contact network stored in compressed sparse row (CSR) form.
+
+Nodes are identified by a dense integer index. Each undirected contact is
+stored once in each direction, i.e. row i of the matrix lists all contacts of
+node i in increasing order. `upper` gives the contacts with a higher index,
+which is the orientation `Node.step` uses so that every contact is tried once
+per step.
+
+Cliques (everyone in a BSP leaf has contact with everyone else in the leaf) can
+be kept implicit: nodes of a clique have consecutive indices, so the clique is
+stored as an offset array instead of as n * (n - 1) / 2 explicit pairs. The CSR
+arrays then only hold the contacts between cliques. `neighbors` and `upper`
+still return all contacts, while `edges` and `gather` only cover the explicit
+ones and the engines handle cliques in aggregate.
+
+Contacts are never removed once built. Interventions (see `interventions.py`)
+change the weights instead, with `with_weights` giving a graph that shares the
+CSR arrays.
+
+"""
+import copy
+
+import numpy as np
+
+
+class ContactGraph:
+    def __init__(
+        self, indptr, indices, weights=None, cliques=None, clique_weights=None
+    ):
+        assert len(indptr) >= 1
+        assert indptr[-1] == len(indices)
+        assert weights is None or len(weights) == len(indices)
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.cliques = cliques
+        self._upper_start = None
+        self.clique_of = None
+        self.clique_weights = None
+        if cliques is not None:
+            assert cliques[-1] == self.n_nodes
+            n_cliques = len(cliques) - 1
+            self.clique_of = np.repeat(
+                np.arange(n_cliques, dtype=self.index_dtype(self.n_nodes)),
+                np.diff(cliques),
+            )
+            if clique_weights is None:
+                clique_weights = np.ones(n_cliques, dtype=np.float32)
+            self.clique_weights = clique_weights
+
+    @staticmethod
+    def index_dtype(n_nodes):
+        return np.int32 if n_nodes < np.iinfo(np.int32).max else np.int64
+
+    @classmethod
+    def from_edges(cls, n_nodes, src, dst, weights=None, cliques=None):
+        """Build a symmetric graph from undirected edges (src[k], dst[k]).
+
+        Self-loops are dropped and duplicate edges are merged (keeping the first
+        weight given). `cliques` optionally gives the offsets of implicit
+        cliques.
+        """
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        lo = np.minimum(src, dst)
+        hi = np.maximum(src, dst)
+        keep = lo != hi
+        keys, first = np.unique(lo[keep] * n_nodes + hi[keep], return_index=True)
+        lo = keys // n_nodes
+        hi = keys % n_nodes
+
+        rows = np.concatenate((lo, hi))
+        cols = np.concatenate((hi, lo))
+        order = np.lexsort((cols, rows))
+        dtype = cls.index_dtype(n_nodes)
+        indices = cols[order].astype(dtype)
+        indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n_nodes), out=indptr[1:])
+
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float32)[keep][first]
+            weights = np.concatenate((weights, weights))[order]
+        return cls(indptr, indices, weights, cliques)
+
+    @property
+    def n_nodes(self):
+        return len(self.indptr) - 1
+
+    @property
+    def n_explicit_edges(self):
+        """Number of undirected contacts stored in the CSR arrays."""
+        return len(self.indices) // 2
+
+    @property
+    def n_edges(self):
+        """Number of undirected contacts, including implicit clique contacts."""
+        n = self.n_explicit_edges
+        if self.cliques is not None:
+            sizes = np.diff(self.cliques).astype(np.int64)
+            n += int(np.sum(sizes * (sizes - 1) // 2))
+        return n
+
+    @property
+    def weighted(self):
+        """Whether contacts may have weights other than 1."""
+        return self.weights is not None or self.cliques is not None
+
+    def degree(self):
+        degree = np.diff(self.indptr)
+        if self.cliques is not None:
+            degree = degree + np.diff(self.cliques)[self.clique_of] - 1
+        return degree
+
+    def neighbors(self, i, with_weights=False):
+        """All contacts of node i in increasing order.
+
+        With `with_weights`, a matching array of contact weights is returned as
+        well.
+        """
+        contacts = self.indices[self.indptr[i] : self.indptr[i + 1]]
+        if with_weights:
+            if self.weights is None:
+                weights = np.ones(len(contacts), dtype=np.float32)
+            else:
+                weights = self.weights[self.indptr[i] : self.indptr[i + 1]]
+
+        if self.cliques is not None:
+            c = self.clique_of[i]
+            members = np.arange(self.cliques[c], self.cliques[c + 1])
+            members = members[members != i]
+            # Contacts between cliques never connect two members of the same
+            # clique, so the two lists are disjoint.
+            contacts = np.concatenate((members, contacts))
+            order = np.argsort(contacts, kind="stable")
+            contacts = contacts[order]
+            if with_weights:
+                clique_weights = np.full(len(members), self.clique_weights[c])
+                weights = np.concatenate((clique_weights, weights))[order]
+
+        if with_weights:
+            return contacts, weights
+        return contacts
+
+    def upper(self, i, with_weights=False):
+        """Contacts of node i with a higher index than i."""
+        start, end = self.upper_start()[i], self.indptr[i + 1]
+        contacts = self.indices[start:end]
+        if with_weights:
+            if self.weights is None:
+                weights = np.ones(len(contacts), dtype=np.float32)
+            else:
+                weights = self.weights[start:end]
+        if self.cliques is not None:
+            # Contacts between cliques never connect two members of the same
+            # clique, and members have consecutive indices, so the clique
+            # members above i come before all explicit contacts above i.
+            c = self.clique_of[i]
+            members = np.arange(i + 1, self.cliques[c + 1])
+            contacts = np.concatenate((members, contacts))
+            if with_weights:
+                clique_weights = np.full(len(members), self.clique_weights[c])
+                weights = np.concatenate((clique_weights, weights))
+        if with_weights:
+            return contacts, weights
+        return contacts
+
+    def upper_start(self):
+        """Position in `indices` of the first explicit contact of each node
+        with a higher index, so that those contacts of node i are
+        indices[upper_start[i] : indptr[i + 1]]. Computed once and shared
+        with graphs from `with_weights`."""
+        if self._upper_start is None:
+            rows = self.rows()
+            below = np.bincount(rows[self.indices < rows], minlength=self.n_nodes)
+            self._upper_start = self.indptr[:-1] + below
+        return self._upper_start
+
+    def gather(self, nodes):
+        """All explicit contacts of the given nodes as (node, contact) pairs.
+
+        Returns the two arrays and the matching contact weights (None if the
+        explicit contacts are unweighted).
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        starts = self.indptr[nodes]
+        lengths = self.indptr[nodes + 1] - starts
+        total = int(lengths.sum())
+        # Position of each gathered entry in `indices`: the start of its row
+        # plus its offset within the row.
+        row_offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(total) + np.repeat(starts - row_offsets, lengths)
+        weights = None if self.weights is None else self.weights[positions]
+        return np.repeat(nodes, lengths), self.indices[positions], weights
+
+    def clique_members(self, cliques):
+        """Members of the given cliques and, for each member, the position of
+        its clique in `cliques`."""
+        starts = self.cliques[cliques]
+        lengths = self.cliques[np.asarray(cliques) + 1] - starts
+        row_offsets = np.cumsum(lengths) - lengths
+        members = np.arange(lengths.sum()) + np.repeat(starts - row_offsets, lengths)
+        return members, np.repeat(np.arange(len(lengths)), lengths)
+
+    def rows(self):
+        """Row index of every explicitly stored entry, i.e. the COO row array."""
+        return np.repeat(
+            np.arange(self.n_nodes, dtype=self.indices.dtype), np.diff(self.indptr)
+        )
+
+    def edges(self):
+        """Each explicit undirected contact once, as (src, dst) with src < dst."""
+        rows = self.rows()
+        mask = rows < self.indices
+        return rows[mask], self.indices[mask]
+
+    def edge_weights(self):
+        """Weights in the same order as `edges`, or None if unweighted."""
+        if self.weights is None:
+            return None
+        return self.weights[self.rows() < self.indices]
+
+    def with_weights(self, weights, clique_weights=None):
+        """Graph with the same contacts and new weights.
+
+        The CSR and clique arrays are shared, not copied, so this is cheap and
+        the original graph is left unchanged.
+        """
+        assert weights is None or len(weights) == len(self.indices)
+        graph = copy.copy(self)
+        graph.weights = weights
+        if self.cliques is not None and clique_weights is not None:
+            graph.clique_weights = np.asarray(clique_weights, dtype=np.float32)
+        return graph
+
+    @property
+    def nbytes(self):
+        n = self.indptr.nbytes + self.indices.nbytes
+        if self.weights is not None:
+            n += self.weights.nbytes
+        if self.cliques is not None:
+            n += self.cliques.nbytes + self.clique_of.nbytes
+            n += self.clique_weights.nbytes
+        return n
+
+    @staticmethod
+    def estimate_nbytes(n_nodes, n_edges, weighted=False, n_cliques=None):
+        """Memory needed for a graph of the given size, without building it.
+
+        `n_edges` is the number of explicit contacts and `n_cliques` the number
+        of implicit cliques, if any.
+        """
+        itemsize = np.dtype(ContactGraph.index_dtype(n_nodes)).itemsize
+        n = 8 * (n_nodes + 1) + 2 * n_edges * itemsize
+        if weighted:
+            n += 2 * n_edges * np.dtype(np.float32).itemsize
+        if n_cliques is not None:
+            n += 8 * (n_cliques + 1) + n_nodes * itemsize + 4 * n_cliques
+        return n
+
+    def memory_footprint(self):
+        footprint = {
+            "nodes": self.n_nodes,
+            "edges": self.n_edges,
+            "explicit_edges": self.n_explicit_edges,
+            "indptr": self.indptr.nbytes,
+            "indices": self.indices.nbytes,
+            "weights": 0 if self.weights is None else self.weights.nbytes,
+            "cliques": 0,
+            "total": self.nbytes,
+        }
+        if self.cliques is not None:
+            footprint["cliques"] = (
+                self.cliques.nbytes + self.clique_of.nbytes + self.clique_weights.nbytes
+            )
+        return footprint
+
+    def __repr__(self):
+        return "ContactGraph(%d nodes, %d edges, %d explicit, %.1f MB)" % (
+            self.n_nodes,
+            self.n_edges,
+            self.n_explicit_edges,
+            self.nbytes / 2 ** 20,
+        )
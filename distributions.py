@@ -8,13 +8,9 @@
     [https://www.researchgate.net/publication/339620050_Transmission_characteristics_of_the_COVID-19_outbreak_in_China_a_study_driven_by_data)
 
 """
-import matplotlib
 import numpy as np
 from scipy import stats
 
-matplotlib.use("MacOSX")
-import matplotlib.pyplot as plt
-
 
 class Error(Exception):
     """Base class for exceptions in this module."""
@@ -30,8 +26,76 @@ class UnknownDistribution(Error):
         self.message = message
 
 
+class Sampler:
+    """Draws from a frozen scipy distribution with little per-call overhead.
+
+    `sampler(n)` draws an array of n values in one call and `sampler()` a
+    single value from a buffer of `buffer_size` pre-drawn values, refilled when
+    empty. With `table_size`, values are drawn approximately by interpolating
+    a precomputed table of the inverse CDF at uniform draws. This costs the
+    same for every distribution, which helps for distributions scipy samples
+    slowly (for the gamma distributions here, NumPy's exact sampler is about
+    as fast). The distribution is truncated to the quantiles 0.5 / table_size
+    and 1 - 0.5 / table_size.
+
+    `rng` is a `np.random.Generator`, or None for the global NumPy state (as
+    seeded by `np.random.seed`).
+    """
+
+    def __init__(self, dist, rng=None, buffer_size=4096, table_size=None):
+        self.dist = dist
+        self.rng = rng
+        self.buffer_size = buffer_size
+        self.quantiles = None
+        self.table = None
+        if table_size:
+            self.use_table(table_size)
+        self.reset()
+
+    def use_table(self, table_size=65536):
+        self.quantiles = (np.arange(table_size) + 0.5) / table_size
+        self.table = self.dist.ppf(self.quantiles)
+        self.reset()
+
+    def reset(self):
+        """Drop pre-drawn values, e.g. after reseeding."""
+        self.buffer = np.zeros(0)
+        self.position = 0
+
+    def draw(self, size):
+        if self.table is None:
+            return self.dist.rvs(size, random_state=self.rng)
+        if self.rng is None:
+            u = np.random.random(size)
+        else:
+            u = self.rng.random(size)
+        # The table is evenly spaced in u, so the entries to interpolate
+        # between are found by scaling instead of searching.
+        x = u * len(self.table) - 0.5
+        k = np.clip(x.astype(np.intp), 0, len(self.table) - 2)
+        fraction = np.clip(x - k, 0, 1)
+        return self.table[k] + fraction * (self.table[k + 1] - self.table[k])
+
+    def __call__(self, size=None):
+        if size is not None:
+            return self.draw(size)
+        if self.position == len(self.buffer):
+            self.buffer = self.draw(self.buffer_size)
+            self.position = 0
+        value = self.buffer[self.position]
+        self.position += 1
+        return float(value)
+
+
 class Distributions:
-    def __init__(self, name=None):
+    """Named sets of latent period and infectious duration distributions.
+
+    The frozen scipy distributions are `latent_period_dist` and
+    `infectious_duration_dist`; draw from them through the `latent_period` and
+    `infectious_duration` samplers (see `Sampler`).
+    """
+
+    def __init__(self, name=None, rng=None, buffer_size=4096, table_size=None):
         if name == "covid-19":
             # Latent period distribution set to incubation time distribution given in
             # [2].
@@ -51,7 +115,38 @@ class Distributions:
         else:
             raise UnknownDistribution(name, "Only 'covid-19' is accepted for now.")
 
+        self.latent_period = Sampler(
+            self.latent_period_dist, rng, buffer_size, table_size
+        )
+        self.infectious_duration = Sampler(
+            self.infectious_duration_dist, rng, buffer_size, table_size
+        )
+
+    def samplers(self):
+        return (self.latent_period, self.infectious_duration)
+
+    def seed(self, rng=None):
+        """Draw from `rng` (a `np.random.Generator` or a seed for one), or
+        from the global NumPy state if None. Pre-drawn values are dropped."""
+        if rng is not None and not isinstance(rng, np.random.Generator):
+            rng = np.random.default_rng(rng)
+        for sampler in self.samplers():
+            sampler.rng = rng
+            sampler.reset()
+
+    def reset(self):
+        for sampler in self.samplers():
+            sampler.reset()
+
+    def use_table(self, table_size=65536):
+        """Draw approximately from inverse-CDF lookup tables."""
+        for sampler in self.samplers():
+            sampler.use_table(table_size)
+
     def plot(self):
+        from plotting import pyplot
+
+        plt = pyplot()
         N = 1000
         fig = plt.figure()
         plt.hist(self.latent_period_dist.rvs(N), density=True)
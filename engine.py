@@ -0,0 +1,323 @@
+"""
+Jonas Nockert (2020)
+
+Array-backed SEIR engine.
+
+Node state, counters and infection rates are kept in NumPy arrays indexed by a
+dense integer node index instead of in one `Node` object per individual. The
+latent -> infectious -> recovered transitions and the counter decrements are
+whole-array operations and transmission is evaluated for all contact edges at
+once.
+
+The engine sits next to `Graph`: it is built from a graph with a contact
+network (`graph.contacts`), advances `graph.t` and appends to `graph.stats` in
+the same format as `Graph.step`, so `Graph.plot` keeps working. Interventions
+applied to or lifted from the graph take effect on the next step. `sync_nodes`
+writes the array state back to the `Node` objects, e.g. before calling
+`Graph.image`.
+
+Each contact between an infectious and a susceptible node is a Bernoulli trial
+per step with the infection rate of its lower-indexed endpoint, i.e. the node
+whose `upper` contacts hold the edge (within implicit cliques, the rate of the
+infectious node). As in `Node.step`, an infectious node infects at most one of
+its `upper` contacts per step, the first one hit in index order, while any
+number of its lower-indexed contacts may be infected along their own contact
+lists. Within implicit cliques, the infectious members' force of infection is
+aggregated per susceptible member (see `clique_hits`) and a hit attributed to
+one of them before the cap is applied, which only differs from trying every
+pair when a member is hit by several at once. Also, `Graph.step` updates nodes
+one after the other, so a contact infected earlier in the same step is no
+longer tried. The engines agree statistically.
+
+"""
+import numpy as np
+
+from graph import Node, NodeState
+from instrumentation import instrument
+
+
+SUSCEPTIBLE = NodeState.SUSCEPTIBLE.value
+INFECTED_LATENT = NodeState.INFECTED_LATENT.value
+INFECTIOUS = NodeState.INFECTIOUS.value
+RECOVERED = NodeState.RECOVERED.value
+
+
+def node_arrays(graph):
+    """(state, counter, infection rate) arrays of the graph's `Node` objects.
+
+    A graph loaded without `Node` objects (see `cache.graph_from_arrays`)
+    starts with everyone susceptible at `Node.INFECTION_RATE`.
+    """
+    if not graph.nodes:
+        n = int(graph.leaf_offsets[-1])
+        return (
+            np.full(n, SUSCEPTIBLE, dtype=np.int8),
+            np.zeros(n, dtype=np.float64),
+            np.full(n, Node.INFECTION_RATE, dtype=np.float64),
+        )
+    state = np.array([node.state.value for node in graph.nodes], dtype=np.int8)
+    counter = np.array(
+        [float(np.squeeze(node.counter)) for node in graph.nodes], dtype=np.float64
+    )
+    infection_rate = np.array(
+        [node.infection_rate for node in graph.nodes], dtype=np.float64
+    )
+    return state, counter, infection_rate
+
+
+class ArrayEngine:
+    distributions = Node.distributions
+
+    def __init__(self, graph):
+        assert graph.contacts
+        self.graph = graph
+        self.state, self.counter, self.infection_rate = node_arrays(graph)
+        self.N = len(self.state)
+        # Number of nodes per state, indexed by state value and kept up to
+        # date by `set_state` so that no census pass is needed.
+        self.counts = np.bincount(self.state, minlength=RECOVERED + 1)
+        self.cumulative = graph.census.cumulative
+        self.load_edges()
+
+    @property
+    def t(self):
+        return self.graph.t
+
+    @property
+    def stats(self):
+        return self.graph.stats
+
+    @property
+    def event_log(self):
+        return self.graph.event_log
+
+    def load_edges(self):
+        """(Re)read the explicit contact edges from `graph.contacts`."""
+        self.contacts = self.graph.contacts
+        self.src, self.dst = self.contacts.edges()
+        self.edge_weights = self.contacts.edge_weights()
+
+    def infect_random(self, n=1):
+        indices = np.random.randint(self.N, size=n)
+        self.infectious(np.unique(indices))
+        return list(indices)
+
+    def set_state(self, indices, state, sources=None):
+        left = np.bincount(self.state[indices], minlength=RECOVERED + 1)
+        self.counts -= left
+        self.counts[state] += len(indices)
+        self.cumulative += int(left[SUSCEPTIBLE])
+        self.state[indices] = state
+        if self.event_log is not None:
+            self.event_log.append(self.graph.t, state, indices, sources)
+
+    def infect(self, indices, sources=None):
+        self.set_state(indices, INFECTED_LATENT, sources)
+        self.counter[indices] = self.distributions.latent_period(len(indices))
+
+    def infectious(self, indices):
+        self.set_state(indices, INFECTIOUS)
+        self.counter[indices] = self.distributions.infectious_duration(len(indices))
+
+    def recover(self, indices):
+        self.set_state(indices, RECOVERED)
+        self.counter[indices] = 0
+
+    def physical_distancing(self, rate=0.5):
+        return self.graph.physical_distancing(rate=rate)
+
+    def opening_up(self, rate=None):
+        self.graph.opening_up(rate=rate)
+
+    def pre_step(self):
+        # Same order of precedence as `Node.pre_step`: an expired counter moves
+        # the node to its next state, otherwise the counter is decremented.
+        expired = self.counter <= 0
+        to_infectious = np.flatnonzero((self.state == INFECTED_LATENT) & expired)
+        to_recovered = np.flatnonzero((self.state == INFECTIOUS) & expired)
+        decrement = (self.state != RECOVERED) & ~expired
+        self.counter[decrement] -= 1
+        self.infectious(to_infectious)
+        self.recover(to_recovered)
+        instrument.count("transitions", len(to_infectious) + len(to_recovered))
+
+    def clique_hits(self, infectious):
+        """Susceptible nodes hit within the implicit cliques of `infectious`,
+        as (sources, targets).
+
+        All infectious members of a clique are aggregated into one force of
+        infection, so that a susceptible member escapes with probability
+        prod(1 - p_j * w) over the infectious members j, where w is the clique
+        weight; for equal rates this is (1 - p * w)^k for k infectious
+        members. Each hit is attributed to one infectious member, drawn in
+        proportion to their infection hazards. The cost is linear in the
+        sizes of the cliques, however many of their members are infectious.
+        """
+        contacts = self.contacts
+        if contacts.cliques is None or len(infectious) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+
+        # Infectious nodes grouped by clique, with cumulative hazards.
+        cliques = contacts.clique_of[infectious]
+        order = np.argsort(cliques, kind="stable")
+        infectious = np.asarray(infectious)[order]
+        cliques = cliques[order]
+        hazards = -np.log1p(
+            -self.infection_rate[infectious] * contacts.clique_weights[cliques]
+        )
+        cumulative = np.cumsum(hazards)
+        unique_cliques, starts = np.unique(cliques, return_index=True)
+        ends = np.append(starts[1:], len(cliques))
+        low = np.where(starts > 0, cumulative[starts - 1], 0.0)
+        totals = cumulative[ends - 1] - low
+
+        members, position = contacts.clique_members(unique_cliques)
+        susceptible = self.state[members] == SUSCEPTIBLE
+        members = members[susceptible]
+        position = position[susceptible]
+        instrument.count("infection_attempts", len(members))
+        hit = np.random.random(len(members)) < -np.expm1(-totals[position])
+        members = members[hit]
+        position = position[hit]
+
+        draws = low[position] + np.random.random(len(members)) * totals[position]
+        picks = np.searchsorted(cumulative, draws, side="right")
+        sources = infectious[np.clip(picks, starts[position], ends[position] - 1)]
+        return sources, members
+
+    def first_hits(self, sources, targets):
+        """The (targets, sources) of hits that infect. Like `Node.step`, a
+        source stops after its first hit among its higher-indexed contacts,
+        so only the lowest such target counts."""
+        upper = np.flatnonzero(sources < targets)
+        upper = upper[np.lexsort((targets[upper], sources[upper]))]
+        first = np.ones(len(upper), dtype=bool)
+        first[1:] = sources[upper[1:]] != sources[upper[:-1]]
+        hits = np.concatenate((np.flatnonzero(sources > targets), upper[first]))
+        return targets[hits], sources[hits]
+
+    def infect_once(self, targets, sources):
+        """Infect `targets`, each once, attributed to the source of its first
+        hit. Returns the nodes infected."""
+        targets, first = np.unique(targets, return_index=True)
+        self.infect(targets, sources[first] if self.event_log is not None else None)
+        return targets
+
+    def transmit(self):
+        if self.contacts is not self.graph.contacts:
+            self.load_edges()
+        src_state = self.state[self.src]
+        dst_state = self.state[self.dst]
+        forward = (src_state == INFECTIOUS) & (dst_state == SUSCEPTIBLE)
+        backward = (src_state == SUSCEPTIBLE) & (dst_state == INFECTIOUS)
+        candidates = np.flatnonzero(forward | backward)
+        rate = self.infection_rate[self.src[candidates]]
+        if self.edge_weights is not None:
+            rate = rate * self.edge_weights[candidates]
+        hits = candidates[np.random.random(len(candidates)) < rate]
+        targets = np.where(forward[hits], self.dst[hits], self.src[hits])
+        sources = np.where(forward[hits], self.src[hits], self.dst[hits])
+        instrument.count("edges_examined", len(self.src))
+        instrument.count("infection_attempts", len(candidates))
+
+        infectious = np.flatnonzero(self.state == INFECTIOUS)
+        clique_sources, clique_targets = self.clique_hits(infectious)
+        targets = self.infect_once(
+            *self.first_hits(
+                np.concatenate((sources, clique_sources)),
+                np.concatenate((targets, clique_targets)),
+            )
+        )
+        instrument.count("infections", len(targets))
+
+    def census(self):
+        """(S, E, I, R, cumulative infected), as `Census.totals`."""
+        totals = (*self.counts[1:].tolist(), self.cumulative)
+        assert self.N == sum(totals[:4])
+        return totals
+
+    def step(self):
+        self.graph.t += 1
+        instrument.tick(self.graph.t)
+
+        with instrument.phase("pre_step"):
+            self.pre_step()
+        with instrument.phase("transmission"):
+            self.transmit()
+        with instrument.phase("census"):
+            self.graph.stats.append(self.graph.t, *self.census())
+
+    def sync_nodes(self):
+        """Write array state back to the graph's `Node` objects."""
+        for i, node in enumerate(self.graph.nodes):
+            node.state = NodeState(int(self.state[i]))
+            node.counter = self.counter[i]
+        self.graph.census.counts = self.counts.tolist()
+        self.graph.census.cumulative = self.cumulative
+
+
+class FrontierEngine(ArrayEngine):
+    """Array engine that only visits infected nodes and their contacts.
+
+    The infected (latent or infectious) nodes are kept as an active set. Only
+    those have running counters, and infection attempts are pushed out from
+    the infectious nodes along the symmetric contact graph, so the cost of a
+    step scales with the number of infectious nodes times their degree rather
+    than with the size of the population.
+    """
+
+    def __init__(self, graph):
+        super().__init__(graph)
+        self.active = np.flatnonzero(
+            (self.state == INFECTED_LATENT) | (self.state == INFECTIOUS)
+        )
+
+    def load_edges(self):
+        # Edges are gathered from the contact graph on every step.
+        self.contacts = self.graph.contacts
+
+    def infect_random(self, n=1):
+        indices = super().infect_random(n)
+        self.active = np.union1d(self.active, indices)
+        return indices
+
+    def pre_step(self):
+        active = self.active
+        state = self.state[active]
+        expired = self.counter[active] <= 0
+        self.counter[active[~expired]] -= 1
+        to_infectious = active[(state == INFECTED_LATENT) & expired]
+        to_recovered = active[(state == INFECTIOUS) & expired]
+        self.infectious(to_infectious)
+        self.recover(to_recovered)
+        self.active = active[self.state[active] != RECOVERED]
+        instrument.count("transitions", len(to_infectious) + len(to_recovered))
+
+    def transmit(self):
+        if self.contacts is not self.graph.contacts:
+            self.load_edges()
+        infectious = self.active[self.state[self.active] == INFECTIOUS]
+        if len(infectious) == 0:
+            return
+        src, dst, weights = self.contacts.gather(infectious)
+        susceptible = self.state[dst] == SUSCEPTIBLE
+        src = src[susceptible]
+        dst = dst[susceptible]
+        instrument.count("edges_examined", len(susceptible))
+        instrument.count("infection_attempts", len(dst))
+        # The edge uses the rate of its lower-indexed endpoint, as in
+        # `ArrayEngine.transmit`.
+        rate = self.infection_rate[np.minimum(src, dst)]
+        if weights is not None:
+            rate = rate * weights[susceptible]
+        hits = np.random.random(len(dst)) < rate
+        clique_sources, clique_targets = self.clique_hits(infectious)
+        targets = self.infect_once(
+            *self.first_hits(
+                np.concatenate((src[hits], clique_sources)),
+                np.concatenate((dst[hits], clique_targets)),
+            )
+        )
+        instrument.count("infections", len(targets))
+        self.active = np.concatenate((self.active, targets))
@@ -0,0 +1,215 @@
+"""
+Jonas Nockert (2020)
+
+Monte Carlo ensembles of independent simulation runs.
+
+A single run is one stochastic realisation and mostly noise. `run_ensemble` runs
+K replicates over a process pool, each seeded from its own `np.random.SeedSequence`
+child so that `random`, `np.random` and the duration samplers (which draw from
+the global NumPy state) get independent streams. Workers only send back their
+daily S/I/R/ICUM series, never per-node state, and the parent combines them into
+per-day mean and quantile bands and per-run summary statistics.
+
+"""
+from concurrent.futures import ProcessPoolExecutor
+import random
+
+import numpy as np
+
+
+# As in the rows of `Graph.stats`, I counts everyone infected.
+COLUMNS = ("S", "I", "R", "ICUM")
+
+
+def seed_streams(seed_sequence):
+    """Seed `random` and `np.random` from a `np.random.SeedSequence`."""
+    from graph import Node
+
+    random_seed, numpy_seed = seed_sequence.generate_state(2)
+    random.seed(int(random_seed))
+    np.random.seed(int(numpy_seed))
+    # Values pre-drawn by an earlier run in the same process must not leak
+    # into this one.
+    Node.distributions.reset()
+
+
+def network_seed(graph_seed_sequence):
+    """`NetworkCache` seed of the network generated from
+    `graph_seed_sequence`."""
+    return int(graph_seed_sequence.generate_state(1)[0])
+
+
+def build_network(n1, n2, seed, cache_dir):
+    from cache import NetworkCache
+
+    NetworkCache(cache_dir).get_or_build(n1, n2, seed)
+
+
+def make_engine(graph, engine):
+    # Imported here so that workers only pay for the engine they use.
+    if engine == "graph":
+        return graph
+    elif engine == "array":
+        from engine import ArrayEngine
+
+        return ArrayEngine(graph)
+    elif engine == "frontier":
+        from engine import FrontierEngine
+
+        return FrontierEngine(graph)
+    elif engine == "events":
+        from events import EventEngine
+
+        return EventEngine(graph)
+    elif engine == "parallel":
+        from parallel import ParallelEngine
+
+        return ParallelEngine(graph)
+    elif engine == "cohort":
+        from cohort import CohortEngine
+
+        return CohortEngine(graph)
+    raise ValueError(f"Unknown engine '{engine}'")
+
+
+def run_replicate(
+    seed_sequence,
+    n1,
+    n2,
+    steps=250,
+    engine="frontier",
+    n_infected=1,
+    distancing_threshold=None,
+    distancing_rate=0.1,
+    graph_seed_sequence=None,
+    cache_dir=".cache/networks",
+):
+    """Run one simulation and return its stats as a (days, 4) array.
+
+    If `graph_seed_sequence` is given, the contact network is generated from it
+    and loaded through the `NetworkCache` in `cache_dir`, so that all
+    replicates sharing it run on the same network, built only once.
+    """
+    from graph import Graph
+    from scenarios import ThresholdPolicy
+
+    if graph_seed_sequence:
+        from cache import NetworkCache
+
+        g = NetworkCache(cache_dir).get_or_build(
+            n1, n2, network_seed(graph_seed_sequence), nodes=engine == "graph"
+        )
+        seed_streams(seed_sequence)
+    else:
+        seed_streams(seed_sequence)
+        g = Graph(n1, n2)
+        g.adjacency_matrix()
+
+    sim = make_engine(g, engine)
+    sim.infect_random(n=n_infected)
+    policy = ThresholdPolicy(threshold=distancing_threshold, rate=distancing_rate)
+    for _ in range(steps):
+        sim.step()
+        if g.stats[-1]["I"] == 0:
+            break
+        policy(sim)
+
+    stats = g.stats
+    return np.column_stack(
+        (
+            stats.column("S"),
+            stats.column("E") + stats.column("I"),
+            stats.column("R"),
+            stats.column("ICUM"),
+        )
+    )
+
+
+class EnsembleResult:
+    def __init__(self, runs):
+        # Runs that ended early are padded with their last day, since nothing
+        # changes once no one is infected.
+        n_days = max(len(run) for run in runs)
+        self.series = np.stack(
+            [np.pad(run, ((0, n_days - len(run)), (0, 0)), mode="edge") for run in runs]
+        )
+        self.t = np.arange(1, n_days + 1)
+
+    @property
+    def n_runs(self):
+        return len(self.series)
+
+    def column(self, name):
+        """Per-run series of one compartment as a (runs, days) array."""
+        return self.series[:, :, COLUMNS.index(name)]
+
+    def mean(self):
+        return {c: self.column(c).mean(axis=0) for c in COLUMNS}
+
+    def quantiles(self, q=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        return {c: np.quantile(self.column(c), q, axis=0) for c in COLUMNS}
+
+    def final_size(self):
+        return self.column("ICUM")[:, -1]
+
+    def peak_infected(self):
+        return self.column("I").max(axis=1)
+
+    def peak_time(self):
+        return self.t[self.column("I").argmax(axis=1)]
+
+    def summary(self, q=(0.05, 0.5, 0.95)):
+        summary = {}
+        for name, values in (
+            ("final_size", self.final_size()),
+            ("peak_infected", self.peak_infected()),
+            ("peak_time", self.peak_time()),
+        ):
+            summary[name] = {
+                "mean": float(np.mean(values)),
+                "quantiles": dict(zip(q, np.quantile(values, q).tolist())),
+            }
+        return summary
+
+
+def run_ensemble(
+    n_runs,
+    n1,
+    n2,
+    seed=None,
+    same_graph=False,
+    max_workers=None,
+    cache_dir=".cache/networks",
+    **kwargs,
+):
+    """Run `n_runs` independent replicates in parallel.
+
+    With `same_graph`, all replicates use one contact network, kept in the
+    `NetworkCache` in `cache_dir`, and only the outbreak itself varies.
+    Remaining keyword arguments go to `run_replicate`.
+    """
+    root = np.random.SeedSequence(seed)
+    graph_seed_sequence, *seed_sequences = root.spawn(n_runs + 1)
+    if same_graph:
+        kwargs["graph_seed_sequence"] = graph_seed_sequence
+        kwargs["cache_dir"] = cache_dir
+        # Built up front in a process of its own, so that the replicates only
+        # load it and the workers do not start out with the memory used for
+        # building.
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            executor.submit(
+                build_network, n1, n2, network_seed(graph_seed_sequence), cache_dir
+            ).result()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(run_replicate, ss, n1, n2, **kwargs)
+            for ss in seed_sequences
+        ]
+        runs = [future.result() for future in futures]
+    return EnsembleResult(runs)
+
+
+if __name__ == "__main__":
+    result = run_ensemble(16, 50, 50, seed=1, distancing_threshold=0.1)
+    print(result.summary())
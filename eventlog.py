@@ -0,0 +1,258 @@
+"""
+Jonas Nockert (2020)
+
+Streaming log of infections and state transitions.
+
+With an `EventLog` in `graph.event_log`, the engines tracking individuals
+(`Graph.step`, `ArrayEngine`, `FrontierEngine` and `EventEngine`) append an
+event every time a node changes state. The cohort engine has no individuals
+and the parallel engine's workers do not log.
+
+Each event is a 14 byte record of
+
+- t: the day of the step (the exact time for `EventEngine`),
+- kind: the `NodeState` value the node enters,
+- node: the node changing state,
+- source: for infections, the infectious node it was infected by, else -1,
+- level: for infections, the BSP level of the closest common ancestor of the
+  two nodes' leaves, i.e. the level of the leaf for contacts within a leaf,
+  else -1.
+
+Initially infected nodes enter the infectious state without an infection
+event. A node infected along several contacts in the same step is attributed
+to one of them. Logging draws no random numbers, so a run is the same with
+and without a log.
+
+Events are collected in chunks of a fixed size and written by a background
+thread, which also fills in the levels. At most `max_pending` chunks wait
+for the writer, so memory stays flat however long the run is. Records follow
+a JSON header (see `read_header`) in the order they happened, which
+`EventLogReader` reads lazily chunk by chunk.
+
+"""
+import json
+import os
+import queue
+import struct
+import threading
+
+import numpy as np
+
+from bsp import common_levels
+
+
+MAGIC = b"OBLOG\x00\x00\x01"
+EVENT_LOG_VERSION = 1
+EVENT_DTYPE = np.dtype(
+    [
+        ("t", "<f4"),
+        ("kind", "i1"),
+        ("level", "i1"),
+        ("node", "<i4"),
+        ("source", "<i4"),
+    ]
+)
+
+
+def read_header(file):
+    """Header of an event log open for reading, leaving the file at the first
+    record."""
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{file.name} is not an event log")
+    (header_length,) = struct.unpack("<Q", file.read(8))
+    header = json.loads(file.read(header_length))
+    if header.get("version") != EVENT_LOG_VERSION:
+        raise ValueError(
+            f"{file.name} has event log version {header.get('version')}, "
+            f"expected {EVENT_LOG_VERSION}"
+        )
+    header["data_start"] = len(MAGIC) + 8 + header_length
+    return header
+
+
+class EventLog:
+    """Writes events of a simulation on `graph` to `path`.
+
+    With `resume`, an existing log is continued from `graph.t` (e.g. after
+    loading a checkpoint), dropping events logged after it, so call `sync`
+    whenever a checkpoint is saved (`save_checkpoint` does). Call `close`
+    (or use the log as a context manager) at the end of the run.
+    """
+
+    def __init__(self, path, graph, chunk_size=2 ** 16, max_pending=4, resume=False):
+        self.path = path
+        self.leaf_offsets = np.asarray(graph.leaf_offsets)
+        self.ancestors = graph.tree.ancestors()
+        self.chunk_size = chunk_size
+        self.chunk = np.empty(chunk_size, EVENT_DTYPE)
+        self.size = 0
+        self.n_events = 0
+        self.error = None
+
+        if resume:
+            self.file = open(path, "r+b")
+            data_start = read_header(self.file)["data_start"]
+            t = EventLogReader(path).read()["t"]
+            self.n_events = int(np.searchsorted(t, graph.t, side="right"))
+            del t
+            self.file.truncate(data_start + self.n_events * EVENT_DTYPE.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, "wb")
+            header = json.dumps(
+                {
+                    "version": EVENT_LOG_VERSION,
+                    "dtype": EVENT_DTYPE.descr,
+                    "n1": graph.n1,
+                    "n2": graph.n2,
+                    "n_nodes": int(self.leaf_offsets[-1]),
+                }
+            ).encode("utf-8")
+            self.file.write(MAGIC)
+            self.file.write(struct.pack("<Q", len(header)))
+            self.file.write(header)
+            # A checkpoint may be taken, and the run killed, before the first
+            # chunk is written; the log must still be resumable then.
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+        self.pending = queue.Queue(max_pending)
+        self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, t, kind, nodes, sources=None):
+        """Log that `nodes` (an array) entered state `kind` at time `t`,
+        infected by `sources` if given."""
+        nodes = np.asarray(nodes)
+        start = 0
+        while start < len(nodes):
+            n = min(len(nodes) - start, self.chunk_size - self.size)
+            rows = self.chunk[self.size : self.size + n]
+            rows["t"] = t
+            rows["kind"] = kind
+            rows["node"] = nodes[start : start + n]
+            rows["source"] = -1 if sources is None else sources[start : start + n]
+            self.size += n
+            start += n
+            if self.size == self.chunk_size:
+                self.flush()
+
+    def append_one(self, t, kind, node, source=-1):
+        """`append` for a single node, cheaper for engines that handle one
+        node at a time."""
+        self.chunk[self.size] = (t, kind, -1, node, source)
+        self.size += 1
+        if self.size == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Hand the events collected so far to the writer, waiting if it is
+        `max_pending` chunks behind."""
+        if self.error:
+            raise self.error
+        if self.size == 0:
+            return
+        chunk = self.chunk[: self.size]
+        self.n_events += self.size
+        self.chunk = np.empty(self.chunk_size, EVENT_DTYPE)
+        self.size = 0
+        self.pending.put(chunk)
+
+    def sync(self):
+        """Write all events so far to disk, waiting for the writer."""
+        self.flush()
+        self.pending.join()
+        if self.error:
+            raise self.error
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def write_chunks(self):
+        while True:
+            chunk = self.pending.get()
+            try:
+                if chunk is None:
+                    break
+                if self.error:
+                    continue
+                chunk["level"] = self.levels(chunk["node"], chunk["source"])
+                self.file.write(chunk.tobytes())
+            except Exception as e:
+                self.error = e
+            finally:
+                self.pending.task_done()
+
+    def levels(self, nodes, sources):
+        infections = sources >= 0
+        levels = np.full(len(nodes), -1, dtype=np.int8)
+        leaves = np.searchsorted(self.leaf_offsets, nodes[infections], side="right")
+        source_leaves = np.searchsorted(
+            self.leaf_offsets, sources[infections], side="right"
+        )
+        levels[infections] = common_levels(
+            self.ancestors, leaves - 1, source_leaves - 1
+        )
+        return levels
+
+    def close(self):
+        """Write all events and close the file."""
+        if self.file.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.pending.put(None)
+            self.writer.join()
+            self.file.close()
+        if self.error:
+            raise self.error
+
+
+class EventLogReader:
+    """Reads an event log lazily, `chunk_size` events at a time.
+
+    Iterating gives arrays of `EVENT_DTYPE` records. The log of a running
+    simulation can be read as far as it has been written.
+    """
+
+    def __init__(self, path, chunk_size=2 ** 16):
+        self.path = path
+        self.chunk_size = chunk_size
+        with open(path, "rb") as f:
+            self.header = read_header(f)
+
+    def __len__(self):
+        size = os.path.getsize(self.path) - self.header["data_start"]
+        return size // EVENT_DTYPE.itemsize
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            f.seek(self.header["data_start"])
+            while True:
+                chunk = np.fromfile(f, EVENT_DTYPE, self.chunk_size)
+                if len(chunk) == 0:
+                    break
+                yield chunk
+
+    def infections(self):
+        """Chunks of infection events only."""
+        for chunk in self:
+            yield chunk[chunk["source"] >= 0]
+
+    def read(self):
+        """All events at once, memory-mapped."""
+        if len(self) == 0:
+            return np.zeros(0, EVENT_DTYPE)
+        return np.memmap(
+            self.path,
+            EVENT_DTYPE,
+            "r",
+            offset=self.header["data_start"],
+            shape=(len(self),),
+        )
@@ -0,0 +1,211 @@
+"""
+Jonas Nockert (2020)
+
+Continuous-time (next-event) SEIR engine.
+
+Instead of decrementing every node's counter once per day, the engine keeps a
+priority queue of scheduled events and jumps directly from one to the next:
+
+- end of the latent period (drawn from `latent_period_dist`),
+- recovery (drawn from `infectious_duration_dist`),
+- transmission along a contact edge.
+
+The per-day infection probability p of a contact is turned into a constant
+hazard -log(1 - p), so when a node becomes infectious a transmission time is
+drawn for each of its susceptible contacts and only those falling within its
+infectious period are scheduled. A transmission that fires after the target has
+already been infected is dropped.
+
+When interventions change the contact weights, all pending transmissions are
+invalidated and new transmission times are drawn for every infectious node
+from the current time until its recovery. The hazards are memoryless, so this
+is exact.
+
+Note that the fixed-step engines keep a node infectious for ceil(D) + 1 daily
+steps for a drawn duration D (and similarly round up latent periods), while
+here it is infectious for exactly D days. Outbreaks are therefore somewhat
+smaller and slower than with `Graph.step` for the same parameters.
+
+Like `ArrayEngine`, the engine wraps a `Graph`, advances `graph.t` one day per
+`step` and appends daily snapshots to `graph.stats` in the same format as
+`Graph.step`.
+
+"""
+import heapq
+
+import numpy as np
+
+from engine import (
+    INFECTED_LATENT,
+    INFECTIOUS,
+    RECOVERED,
+    SUSCEPTIBLE,
+    node_arrays,
+)
+from graph import Node, NodeState
+from instrumentation import instrument
+
+
+END_OF_LATENCY = 1
+RECOVERY = 2
+TRANSMISSION = 3
+
+
+class EventEngine:
+    distributions = Node.distributions
+
+    def __init__(self, graph):
+        assert graph.contacts
+        self.graph = graph
+        self.state, counter, self.infection_rate = node_arrays(graph)
+        self.N = len(self.state)
+        self.time = float(graph.t)
+        self.queue = []
+        # Transmissions scheduled for an older `graph.contacts` are dropped.
+        self.contacts = graph.contacts
+        self.contacts_version = 0
+
+        self.counts = np.bincount(self.state, minlength=RECOVERED + 1)
+        self.cumulative = graph.census.cumulative
+        # Time of each node's next scheduled state transition.
+        self.next_transition = np.full(self.N, np.inf)
+
+        # Pick up nodes that are already infected, with their counter as the
+        # remaining time in their current state.
+        counter = counter.tolist()
+        for i in np.flatnonzero(self.state == INFECTED_LATENT).tolist():
+            self.schedule(self.time + counter[i], END_OF_LATENCY, i)
+        for i in np.flatnonzero(self.state == INFECTIOUS).tolist():
+            self.schedule(self.time + counter[i], RECOVERY, i)
+            self.schedule_transmissions(i, self.time + counter[i])
+
+    @property
+    def t(self):
+        return self.graph.t
+
+    @property
+    def stats(self):
+        return self.graph.stats
+
+    def schedule(self, time, kind, node, source=-1):
+        if kind != TRANSMISSION:
+            self.next_transition[node] = time
+        heapq.heappush(self.queue, (time, kind, node, source, self.contacts_version))
+
+    def schedule_transmissions(self, i, recovery_time):
+        contacts, weights = self.graph.contacts.neighbors(i, with_weights=True)
+        susceptible = self.state[contacts] == SUSCEPTIBLE
+        contacts = contacts[susceptible]
+        if len(contacts) == 0:
+            return
+        # The edge uses the rate of its lower-indexed endpoint, as in
+        # `ArrayEngine.transmit`.
+        rate = self.infection_rate[np.minimum(contacts, i)] * weights[susceptible]
+        hazard = -np.log1p(-rate)
+        with np.errstate(divide="ignore"):
+            times = self.time + np.random.exponential(1 / hazard)
+        for time, contact in zip(times, contacts):
+            if time < recovery_time:
+                self.schedule(time, TRANSMISSION, int(contact), i)
+
+    def set_state(self, i, state, source=-1):
+        if self.state[i] == SUSCEPTIBLE:
+            self.cumulative += 1
+        self.counts[self.state[i]] -= 1
+        self.counts[state] += 1
+        self.state[i] = state
+        if self.graph.event_log is not None:
+            self.graph.event_log.append_one(self.time, state, i, source)
+
+    def infect(self, i, source=-1):
+        self.set_state(i, INFECTED_LATENT, source)
+        latent_period = self.distributions.latent_period()
+        self.schedule(self.time + latent_period, END_OF_LATENCY, i)
+
+    def infectious(self, i):
+        self.set_state(i, INFECTIOUS)
+        recovery_time = self.time + self.distributions.infectious_duration()
+        self.schedule(recovery_time, RECOVERY, i)
+        self.schedule_transmissions(i, recovery_time)
+
+    def recover(self, i):
+        self.set_state(i, RECOVERED)
+        self.next_transition[i] = np.inf
+
+    def infect_random(self, n=1):
+        indices = np.random.randint(self.N, size=n)
+        for i in np.unique(indices):
+            self.infectious(int(i))
+        return list(indices)
+
+    def physical_distancing(self, rate=0.5):
+        return self.graph.physical_distancing(rate=rate)
+
+    def opening_up(self, rate=None):
+        self.graph.opening_up(rate=rate)
+
+    def reschedule_transmissions(self):
+        """Redraw the transmissions of all infectious nodes with the current
+        `graph.contacts`."""
+        self.contacts = self.graph.contacts
+        self.contacts_version += 1
+        for i in np.flatnonzero(self.state == INFECTIOUS):
+            self.schedule_transmissions(int(i), self.next_transition[i])
+
+    def process(self, time, kind, i, source, version):
+        if kind == END_OF_LATENCY:
+            if self.state[i] == INFECTED_LATENT and time == self.next_transition[i]:
+                self.infectious(i)
+        elif kind == RECOVERY:
+            if self.state[i] == INFECTIOUS and time == self.next_transition[i]:
+                self.recover(i)
+        elif kind == TRANSMISSION:
+            if self.state[i] == SUSCEPTIBLE and version == self.contacts_version:
+                self.infect(i, source)
+
+    def advance(self, until):
+        """Process all events up to and including time `until`."""
+        while self.queue and self.queue[0][0] <= until:
+            time, kind, i, source, version = heapq.heappop(self.queue)
+            self.time = time
+            self.process(time, kind, i, source, version)
+            instrument.count("events")
+        self.time = until
+
+    def census(self):
+        """(S, E, I, R, cumulative infected), as `Census.totals`."""
+        totals = (*self.counts[1:].tolist(), self.cumulative)
+        assert self.N == sum(totals[:4])
+        return totals
+
+    def step(self):
+        self.graph.t += 1
+        instrument.tick(self.graph.t)
+
+        if self.contacts is not self.graph.contacts:
+            with instrument.phase("reschedule"):
+                self.reschedule_transmissions()
+        cumulative = self.cumulative
+        with instrument.phase("events"):
+            self.advance(self.graph.t)
+        instrument.count("infections", self.cumulative - cumulative)
+        with instrument.phase("census"):
+            self.graph.stats.append(self.graph.t, *self.census())
+
+    def run(self, t_max):
+        """Step until day `t_max` or until no events remain."""
+        while self.graph.t < t_max and self.queue:
+            self.step()
+
+    def sync_nodes(self):
+        """Write state back to the graph's `Node` objects.
+
+        The counter of an infected node is set to the time remaining until its
+        next transition.
+        """
+        remaining = np.maximum(self.next_transition - self.time, 0)
+        for i, node in enumerate(self.graph.nodes):
+            node.state = NodeState(int(self.state[i]))
+            node.counter = remaining[i] if np.isfinite(remaining[i]) else 0
+        self.graph.census.counts = self.counts.tolist()
+        self.graph.census.cumulative = self.cumulative
@@ -4,11 +4,18 @@ Jonas Nockert (2020)
 Point and rectangle classes where a point represent an individual and
 a rectangle some sort of social grouping.
 
+For many points or rectangles at once, the functions below work on coordinate
+arrays instead: `rect_coordinates` gives the points of many rectangles and
+`pairwise_distances` the distance matrix between sets of points.
+
 """
 import math
 
+import numpy as np
+
 
 class Point:
+    __slots__ = ("_x", "_y")
 
     def __init__(self, x_0=0, y_0=0):
         self._x = x_0
@@ -38,6 +45,8 @@ class Point:
 
 
 class Rect:
+    __slots__ = ("_xmin", "_xmax", "_ymin", "_ymax")
+
     def __init__(self, xmin_0=0, xmax_0=0, ymin_0=0, ymax_0=0):
         self._xmin = xmin_0
         self._xmax = xmax_0
@@ -102,3 +111,33 @@ class Rect:
             for y in range(self._ymin, self._ymax + 1):
                 points.append(Point(x, y))
         return points
+
+    def coordinates(self):
+        """x and y arrays of the points, in the order of `get_points`."""
+        return rect_coordinates([(self._xmin, self._xmax, self._ymin, self._ymax)])
+
+
+def rect_coordinates(bounds):
+    """x and y arrays of all points of the rectangles (xmin, xmax, ymin, ymax),
+    rectangle by rectangle and within each in the order of `Rect.get_points`
+    (x major, y minor)."""
+    bounds = np.asarray(bounds, dtype=np.int64).reshape(-1, 4)
+    xmin, xmax, ymin, ymax = bounds.T
+    heights = ymax - ymin + 1
+    sizes = (xmax - xmin + 1) * heights
+    # Offset of each point within its rectangle.
+    offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    heights = np.repeat(heights, sizes)
+    x = np.repeat(xmin, sizes) + offsets // heights
+    y = np.repeat(ymin, sizes) + offsets % heights
+    return x, y
+
+
+def pairwise_distances(a, b=None):
+    """Euclidean distance matrix between the rows of the (n, 2) array `a` and
+    the rows of `b` (default `a`)."""
+    a = np.asarray(a, dtype=np.float64)
+    b = a if b is None else np.asarray(b, dtype=np.float64)
+    dx = a[:, 0, None] - b[None, :, 0]
+    dy = a[:, 1, None] - b[None, :, 1]
+    return np.sqrt(dx * dx + dy * dy)
@@ -25,18 +25,18 @@ TODO Estimate generation times.
 from enum import Enum
 import math
 import numpy as np
-from PIL import Image, ImageColor, ImageDraw
 import random
 from scipy import stats
-import time
-
-import matplotlib
-matplotlib.use("MacOSX")
-import matplotlib.pyplot as plt
 
 from bsp import BSP_Tree
+from contacts import ContactGraph
 from distributions import Distributions
-from geometry import Point, Rect
+from geometry import Point, Rect, rect_coordinates
+from instrumentation import instrument
+from interventions import PhysicalDistancing, combined_contacts
+from plotting import StatsPlot, is_interactive, pyplot
+from render import Renderer
+from timeseries import StatsBuffer
 
 
 class NodeState(Enum):
@@ -52,20 +52,63 @@ class GraphState(Enum):
     OPENING_UP = 3
 
 
+class Census:
+    """Number of nodes per state, updated on every state transition."""
+
+    def __init__(self):
+        # Indexed by `NodeState` value.
+        self.counts = [0] * (len(NodeState) + 1)
+        # Number of nodes that have ever left the susceptible state.
+        self.cumulative = 0
+
+    def add(self, state):
+        self.counts[state.value] += 1
+
+    def transition(self, old, new):
+        self.counts[old.value] -= 1
+        self.counts[new.value] += 1
+        if old == NodeState.SUSCEPTIBLE:
+            self.cumulative += 1
+
+    def totals(self):
+        """(S, E, I, R, cumulative infected)."""
+        return (*self.counts[1:], self.cumulative)
+
+
 class Node:
     distributions = Distributions("covid-19")
+    INFECTION_RATE = 0.01
     # TODO Use duration/period random distributions.
     # infectious_durations = stats.norm(loc=7, scale=2)
     # latent_periods = stats.norm(loc=4, scale=1)
     # infectious_durations = stats.norm(loc=7, scale=1.5)
 
-    def __init__(self, bsp_node, point):
+    __slots__ = (
+        "bsp_node",
+        "census",
+        "counter",
+        "id",
+        "infection_rate",
+        "x",
+        "y",
+        "state",
+    )
+
+    def __init__(self, node_id, bsp_node, x, y, census=None):
         self.bsp_node = bsp_node
+        self.census = census
         self.counter = 0
-        self.id = id(point)
-        self.infection_rate = 0.01
-        self.point = point
+        self.id = node_id
+        self.infection_rate = self.INFECTION_RATE
+        self.x = x
+        self.y = y
         self.state = NodeState.SUSCEPTIBLE
+        if census:
+            census.add(self.state)
+
+    @property
+    def point(self):
+        return Point(self.x, self.y)
 
     def is_infected(self):
         return (
@@ -85,16 +128,21 @@ class Node:
     def is_susceptible(self):
         return self.state == NodeState.SUSCEPTIBLE
 
+    def set_state(self, state):
+        if self.census:
+            self.census.transition(self.state, state)
+        self.state = state
+
     def infect(self):
-        self.state = NodeState.INFECTED_LATENT
-        self.counter = self.distributions.latent_period_dist.rvs(1)
+        self.set_state(NodeState.INFECTED_LATENT)
+        self.counter = self.distributions.latent_period()
 
     def infectious(self, infectious=False):
-        self.state = NodeState.INFECTIOUS
-        self.counter = self.distributions.infectious_duration_dist.rvs(1)
+        self.set_state(NodeState.INFECTIOUS)
+        self.counter = self.distributions.infectious_duration()
 
     def recover(self):
-        self.state = NodeState.RECOVERED
+        self.set_state(NodeState.RECOVERED)
         self.counter = 0
 
     def pre_step(self):
@@ -108,160 +156,225 @@ class Node:
         elif self.counter > 0:
             self.counter -= 1
 
-    def step(self, contact_ids, nodes):
+    def step(self, contact_ids, nodes, weights=None):
         if self.is_recovered():
             return
 
-        for cid in contact_ids:
+        for k, cid in enumerate(contact_ids):
             contact = nodes[cid]
             # Do nothing if both infected or neither infected.
             if (
                 (self.is_infectious() and contact.is_susceptible())
                 or (self.is_susceptible() and contact.is_infectious())
-            ) and random.random() < self.infection_rate:
+            ) and random.random() < (
+                self.infection_rate
+                if weights is None
+                else self.infection_rate * weights[k]
+            ):
                 if self.is_susceptible():
                     self.infect()
+                    return self.id, contact.id
                 else:
                     contact.infect()
-                    break
+                    return contact.id, self.id
 
     def post_step(self):
         pass
 
 
 class Graph:
-    def __init__(self, n1, n2):
+    def __init__(self, n1, n2, tree=None):
         self.N = n1 * n2
         self.n1 = n1
         self.n2 = n2
-        self.tree = BSP_Tree(n1, n2)
-        self.nodes = {}
-        self.adj = {}
-        self.stats = []
+        self.tree = tree or BSP_Tree(n1, n2)
+        self.nodes = []
+        self.census = Census()
+        self.leaves = []
+        self.leaf_offsets = None
+        # Coordinates of each node.
+        self.x = None
+        self.y = None
+        # The contacts as built, and as weighted by the active interventions.
+        self.base_contacts = None
+        self.contacts = None
+        self.interventions = []
+        self.renderer = None
+        self.plotter = None
+        self.stats = StatsBuffer()
+        # See `eventlog.py`.
+        self.event_log = None
         self.t = 0
         self.state = GraphState.NORMAL
         self.physical_distancing_t = None
+        self.opening_up_t = None
 
     def infect_random(self, n=1):
         assert self.nodes
-        node_ids = random.choices(list(self.nodes), k=n)
+        node_ids = random.choices(range(len(self.nodes)), k=n)
         for node_id in node_ids:
             self.nodes[node_id].infectious()
+            if self.event_log is not None:
+                self.event_log.append_one(self.t, NodeState.INFECTIOUS.value, node_id)
         return node_ids
 
+    def set_contacts(self, contacts):
+        """Use `contacts` as the built contact graph, keeping the active
+        interventions."""
+        self.base_contacts = contacts
+        self.contacts = combined_contacts(self, self.interventions)
+
+    def apply_intervention(self, intervention):
+        self.interventions.append(intervention)
+        self.contacts = combined_contacts(self, self.interventions)
+        return intervention
+
+    def lift_intervention(self, intervention):
+        self.interventions.remove(intervention)
+        self.contacts = combined_contacts(self, self.interventions)
+
     def physical_distancing(self, rate=0.5):
+        """Keep each contact with probability `rate`.
+
+        Returns the intervention, which can be lifted again with
+        `lift_intervention` or `opening_up`.
+        """
         self.state = GraphState.PHYSICAL_DISTANCING
         self.physical_distancing_t = self.t
-        for node_id in self.adj:
-            contact_ids = self.adj[node_id]
-            n_ids = len(contact_ids)
-            self.adj[node_id] = random.sample(contact_ids, int(n_ids * rate))
+        return self.apply_intervention(PhysicalDistancing(rate))
+
+    def opening_up(self, rate=None):
+        """Lift physical distancing, restoring all contacts it removed.
+
+        With `rate`, distancing is relaxed to keeping each contact with
+        probability `rate` instead of being lifted completely.
+        """
+        self.state = GraphState.OPENING_UP
+        self.opening_up_t = self.t
+        self.interventions = [
+            intervention
+            for intervention in self.interventions
+            if not isinstance(intervention, PhysicalDistancing)
+        ]
+        if rate is not None:
+            self.interventions.append(PhysicalDistancing(rate))
+        self.contacts = combined_contacts(self, self.interventions)
 
     def step(self):
         assert self.nodes
-        assert self.adj
+        assert self.contacts
         self.t += 1
-        print(f"Stepping to time t={self.t}")
-
-        for node_id in self.nodes:
-            self.nodes[node_id].pre_step()
-        for node_id in self.nodes:
-            self.nodes[node_id].step(self.adj[node_id], self.nodes)
-
-        n_susceptible = 0
-        n_infected = 0
-        n_recovered = 0
-        for node_id in self.nodes:
-            node = self.nodes[node_id]
-            if node.is_infected():
-                n_infected += 1
-            elif node.is_recovered():
-                n_recovered += 1
+        instrument.tick(self.t)
+
+        infectious = self.census.counts[NodeState.INFECTIOUS.value]
+        recovered = self.census.counts[NodeState.RECOVERED.value]
+        with instrument.phase("pre_step"):
+            if self.event_log is None:
+                for node in self.nodes:
+                    node.pre_step()
             else:
-                n_susceptible += 1
-        assert self.N == n_susceptible + n_infected + n_recovered
-
-        if self.t > 1:
-            # Note: the below assumes that S->I and I->R is always at least one
-            # time step each.
-
-            # S is a decreasing function (so delta is <= 0).
-            delta_susceptible = n_susceptible - self.stats[-1]["S"]
-            # R is an increasing function (so delta is >= 0).
-            delta_recovered = n_recovered - self.stats[-1]["R"]
-            delta_infected = n_infected - self.stats[-1]["I"]
-
-            new_infected = -delta_susceptible
-            n_infected_cumulative = self.stats[-1]["ICUM"] + new_infected
-        else:
-            n_infected_cumulative = n_infected
-
-        self.stats.append(
-            {
-                "t": self.t,
-                "S": n_susceptible,
-                "I": n_infected,
-                "R": n_recovered,
-                "ICUM": n_infected_cumulative,
-            }
+                for node in self.nodes:
+                    state = node.state
+                    node.pre_step()
+                    if node.state is not state:
+                        self.event_log.append_one(self.t, node.state.value, node.id)
+        if instrument.enabled:
+            to_recovered = self.census.counts[NodeState.RECOVERED.value] - recovered
+            to_infectious = (
+                self.census.counts[NodeState.INFECTIOUS.value]
+                - infectious
+                + to_recovered
+            )
+            instrument.count("transitions", to_infectious + to_recovered)
+
+        cumulative = self.census.cumulative
+        with instrument.phase("transmission"):
+            self.transmit()
+        if instrument.enabled:
+            # Every contact is tried once, from its lower-indexed node.
+            instrument.count("edges_examined", self.contacts.n_edges)
+        instrument.count("infections", self.census.cumulative - cumulative)
+
+        with instrument.phase("census"):
+            totals = self.census.totals()
+            assert self.N == sum(totals[:4])
+            self.stats.append(self.t, *totals)
+
+    def transmit(self):
+        """`Node.step` of every node with its `upper` contacts.
+
+        The contact lists are sliced straight out of the CSR arrays as Python
+        lists, and recovered nodes, which cannot infect or be infected, are
+        skipped.
+        """
+        contacts = self.contacts
+        nodes = self.nodes
+        log = self.event_log
+        indices = contacts.indices
+        weights = contacts.weights
+        starts = contacts.upper_start().tolist()
+        ends = contacts.indptr[1:].tolist()
+        cliques = contacts.cliques is not None
+        if cliques:
+            clique_ends = contacts.cliques[contacts.clique_of + 1].tolist()
+            clique_weights = contacts.clique_weights[contacts.clique_of].tolist()
+        for node in nodes:
+            if node.state is NodeState.RECOVERED:
+                continue
+            i = node.id
+            contact_ids = indices[starts[i] : ends[i]].tolist()
+            contact_weights = None
+            if contacts.weighted:
+                if weights is None:
+                    contact_weights = [1.0] * len(contact_ids)
+                else:
+                    contact_weights = weights[starts[i] : ends[i]].tolist()
+            if cliques:
+                # The clique members above i come before all explicit contacts
+                # above i, see `ContactGraph.upper`.
+                members = list(range(i + 1, clique_ends[i]))
+                contact_ids = members + contact_ids
+                contact_weights = [clique_weights[i]] * len(members) + contact_weights
+            infection = node.step(contact_ids, nodes, contact_weights)
+            if infection and log is not None:
+                log.append_one(self.t, NodeState.INFECTED_LATENT.value, *infection)
+
+    def plot(self, show=True, filename=None, every=1):
+        """Plot S, I, R and cumulative I over time.
+
+        The figure is kept between calls and only the newest days are added,
+        redrawing on every `every`-th call.
+        """
+        if self.plotter is None or len(self.stats) < self.plotter.size:
+            self.plotter = StatsPlot(self.N, every=every)
+        self.plotter.every = every
+        return self.plotter.update(
+            self.stats,
+            self.physical_distancing_t,
+            show=show,
+            filename=filename,
+            opening_up_t=self.opening_up_t,
         )
 
-    def plot(self, show=True, filename=None):
-        t = list(map(lambda x: x["t"], self.stats))
-        susceptible = list(map(lambda x: x["S"], self.stats))
-        infected = list(map(lambda x: x["I"], self.stats))
-        recovered = list(map(lambda x: x["R"], self.stats))
-        infected_cumulative = list(map(lambda x: x["ICUM"], self.stats))
-
-        fig = plt.figure(1, clear=True)
-        plt.plot(t, susceptible, color="blue", label="S")
-        plt.plot(t, infected_cumulative, color="orange", label="I (cumul.)")
-        plt.plot(t, recovered, color="green", label="R")
-        plt.plot(t, infected, color="red", label="I")
-        if self.physical_distancing_t:
-            plt.axvline(
-                x=self.physical_distancing_t,
-                linestyle=":",
-                color="gray",
-                label="physical dist.",
-            )
-        fig.legend()
-        if show:
-            plt.pause(0.1)
-        if filename:
-            plt.savefig(filename)
+    def image(self, adj_id=None, show=True, filename=None, modal=False, state=None):
+        """Draw the population colored by state.
+
+        `state` is an optional state vector (e.g. an engine's `state`) to draw
+        instead of the state of the `Node` objects.
+        """
+        from PIL import Image, ImageDraw
 
-    def image(self, adj_id=None, show=True, filename=None, modal=False):
         assert self.nodes
-        image = Image.new("RGB", (self.n1, self.n2))
-        for node in self.nodes.values():
-            if node.is_latent():
-                color = (255, 255, 0)
-            elif node.is_infectious():
-                color = (255, 0, 0)
-            elif node.is_recovered():
-                color = (0, 255, 0)
-            else:
-                color = (
-                    int(node.bsp_node.color[0] * 255),
-                    int(node.bsp_node.color[1] * 255),
-                    int(node.bsp_node.color[2] * 255),
-                )
-            image.putpixel((node.point.x, node.point.y), color)
+        if self.renderer is None:
+            self.renderer = Renderer(self)
+        if state is None:
+            state = [node.state.value for node in self.nodes]
+        image = Image.fromarray(self.renderer.frame(state))
 
-        if adj_id:
+        if adj_id is not None:
             node = self.nodes[adj_id]
             draw = ImageDraw.Draw(image)
-            for node_id in self.adj[adj_id]:
-                contact = self.nodes[node_id]
-                draw.line(
-                    [
-                        node.bsp_node.rect.center.as_tuple(),
-                        contact.bsp_node.rect.center.as_tuple(),
-                    ],
-                    (255, 255, 255, 128),
-                )
-            for node_id in self.back_adj[adj_id]:
+            for node_id in self.contacts.neighbors(adj_id):
                 contact = self.nodes[node_id]
                 draw.line(
                     [
@@ -270,7 +383,8 @@ class Graph:
                     ],
                     (255, 255, 255, 128),
                 )
-        if show:
+        if show and is_interactive():
+            plt = pyplot()
             plt.figure(2)
             plt.imshow(image)
             if modal:
@@ -280,68 +394,222 @@ class Graph:
         if filename:
             image.save(filename)
 
-    def adjacency_matrix(self):
-        self.nodes = {}
-        self.adj = {}
-        self.back_adj = {}
-        leaf_points = {}
-        leaves = self.tree.leaves()
-        n_leaves = len(leaves)
+    def expected_n_edges(self, implicit_cliques=False):
+        """Expected number of contacts, computed from the BSP tree alone.
+
+        With `implicit_cliques`, only the contacts between leaves are counted.
+        """
+        sizes = self.tree.leaf_sizes().astype(np.float64)
+        n_internal = 0 if implicit_cliques else np.sum(sizes * (sizes - 1) / 2)
+
+        centers = self.tree.leaf_centers()
+        max_d = math.sqrt(self.tree.width ** 2 + self.tree.height ** 2)
+        n_external = 0.0
+        for i in range(len(sizes) - 1):
+            d = np.sqrt(np.sum((centers[i + 1 :] - centers[i]) ** 2, axis=1)) / max_d
+            # Mean of the exponential before it is truncated to an int, for
+            # which E[floor(X)] = 1 / (exp(1 / mean) - 1).
+            mean = sizes[i + 1 :] * 0.2 * 2 * (1 - d) / 3
+            with np.errstate(divide="ignore"):
+                n_external += np.sum(1 / np.expm1(1 / mean))
+        return int(n_internal + n_external)
+
+    def estimate_nbytes(self, implicit_cliques=False):
+        """Estimated size of the contact graph before it is built."""
+        n_cliques = self.tree.n_leaves if implicit_cliques else None
+        return ContactGraph.estimate_nbytes(
+            self.N, self.expected_n_edges(implicit_cliques), n_cliques=n_cliques
+        )
 
-        print("Creating internal leaf connections")
-        prev_percent = 0
-        for i in range(n_leaves):
-            percent = int(100 * i / (n_leaves - 1))
-            if percent > prev_percent:
-                print("{:.2f} %".format(percent))
-                prev_percent = percent
-            points = leaves[i].get_points()
-            leaf_points[i] = points
-            n_points = len(points)
-
-            for p in points:
-                node = Node(leaves[i], p)
-                self.nodes[node.id] = node
-                self.adj[node.id] = set()
-                self.back_adj[node.id] = set()
-
-            for pi in range(n_points - 1):
-                for pj in range(pi + 1, n_points):
-                    id1 = id(points[pi])
-                    id2 = id(points[pj])
-                    self.adj[id1].add(id2)
-                    self.back_adj[id2].add(id1)
-
-        print("Creating external leaf connections")
-        prev_percent_int = 0
-        start_timestamp = time.time()
-        for i in range(n_leaves - 1):
-            percent = i / (n_leaves - 2)
-            percent_int = int(100 * percent)
-            if percent_int > prev_percent_int:
-                ts = time.time()
-                delta_t = ts - start_timestamp
-                print(
-                    "{:d} % ({:.0f} s, {:.0f}s remaining)".format(
-                        percent_int,
-                        round(delta_t),
-                        round((delta_t / percent - delta_t) / 2),
-                    )
-                )
-                prev_percent_int = percent_int
-            points = leaf_points[i]
+    def external_contacts_pairwise(self, leaves, leaf_offsets):
+        """Contacts between leaves, visiting every pair of leaves (i, j), i < j.
 
+        The number of contacts between a pair is int(n_j * 0.2 * X), where n_j
+        is the size of leaf j and X is exponentially distributed with mean
+        2 * (1 - d) / 3 for the relative distance d between the leaves. The
+        contacts connect uniformly drawn members of the two leaves.
+        """
+        n_leaves = len(leaves)
+        distances = self.tree.leaf_distances([leaf.index for leaf in leaves])
+        src = [np.zeros(0, dtype=np.int64)]
+        dst = [np.zeros(0, dtype=np.int64)]
+        n_pairs = n_leaves * (n_leaves - 1) // 2
+        for i in range(n_leaves - 1):
+            # Leaf i has n_leaves - 1 - i pairs left, so report progress in pairs.
+            done = i * (2 * n_leaves - i - 1) // 2
+            instrument.progress("external contacts", done, n_pairs)
             for j in range(i + 1, n_leaves):
-                other_points = leaf_points[j]
-                n_other_points = len(other_points)
-                d = self.tree.relative_distance(leaves[i], leaves[j])
+                n_other_points = leaf_offsets[j + 1] - leaf_offsets[j]
+                d = distances[i, j]
                 # n_connections = int(np.random.exponential(1 / d))
                 n_connections = int(
                     n_other_points * 0.2 * np.random.exponential(2 * (1 - d) / 3)
                 )
-                p1s = random.choices(points, k=n_connections)
-                p2s = random.choices(other_points, k=n_connections)
+                src.append(
+                    np.random.randint(
+                        leaf_offsets[i], leaf_offsets[i + 1], n_connections
+                    )
+                )
+                dst.append(
+                    np.random.randint(
+                        leaf_offsets[j], leaf_offsets[j + 1], n_connections
+                    )
+                )
+        instrument.progress("external contacts", n_pairs, n_pairs)
+        return np.concatenate(src), np.concatenate(dst)
+
+    def external_contacts_grid(self, leaves, leaf_offsets, cells_per_axis=None):
+        """Contacts between leaves with the same distribution as
+        `external_contacts_pairwise`, at a cost proportional to the number of
+        contacts created.
+
+        int(c * X) for exponential X is geometric: a pair has any contacts at
+        all with probability q = exp(-1 / mu), mu = n_j * 0.2 * 2 * (1 - d) / 3,
+        and given that, 1 + int(X') contacts for X' exponential with mean mu.
+        Leaf centres are binned into a coarse grid, and for each pair of cells an
+        upper bound on q is computed from the smallest distance between the cells
+        and the largest leaf in them. Candidate leaf pairs are drawn with the
+        bound using geometric skips and then accepted with probability
+        q / bound, so pairs without contacts are never visited.
+        """
+        n_leaves = len(leaves)
+        sizes = np.diff(leaf_offsets)
+        centers = self.tree.centers[[leaf.index for leaf in leaves]].astype(float)
+        root = self.tree.root.rect
+        max_d = math.sqrt(root.width ** 2 + root.height ** 2)
+        if cells_per_axis is None:
+            # Keeps the number of cell pairs linear in the number of leaves.
+            cells_per_axis = max(1, int(round(n_leaves ** 0.25)))
+
+        cx = np.minimum(
+            centers[:, 0] * cells_per_axis // root.width, cells_per_axis - 1
+        )
+        cy = np.minimum(
+            centers[:, 1] * cells_per_axis // root.height, cells_per_axis - 1
+        )
+        cell_of = (cx * cells_per_axis + cy).astype(np.int64)
+        order = np.argsort(cell_of, kind="stable")
+        cells = [
+            members
+            for members in np.split(order, np.flatnonzero(np.diff(cell_of[order])) + 1)
+            if len(members)
+        ]
+        lo = np.array([centers[members].min(axis=0) for members in cells])
+        hi = np.array([centers[members].max(axis=0) for members in cells])
+        largest = np.array([sizes[members].max() for members in cells])
+
+        candidates = []
+        for a in range(len(cells)):
+            for b in range(a, len(cells)):
+                gap = np.maximum(0, np.maximum(lo[b] - hi[a], lo[a] - hi[b]))
+                d_min = math.sqrt(gap[0] ** 2 + gap[1] ** 2) / max_d
+                mu_max = max(largest[a], largest[b]) * 0.2 * 2 * (1 - d_min) / 3
+                if mu_max <= 0:
+                    continue
+                q_max = math.exp(-1 / mu_max)
+
+                # Bernoulli(q_max) candidates among all len(A) * len(B) ordered
+                # pairs, drawn as geometric gaps between successive candidates.
+                n_pairs = len(cells[a]) * len(cells[b])
+                positions = np.zeros(0, dtype=np.int64)
+                while True:
+                    n_draw = int(n_pairs * q_max * 1.2) + 16
+                    gaps = np.random.geometric(q_max, n_draw)
+                    start = positions[-1] + 1 if len(positions) else 0
+                    positions = np.concatenate((positions, start + np.cumsum(gaps) - 1))
+                    if positions[-1] >= n_pairs:
+                        break
+                positions = positions[positions < n_pairs]
+
+                i = cells[a][positions // len(cells[b])]
+                j = cells[b][positions % len(cells[b])]
+                if a == b:
+                    # Each unordered pair once.
+                    keep = i < j
+                    i = i[keep]
+                    j = j[keep]
+                candidates.append((np.minimum(i, j), np.maximum(i, j), q_max))
+
+        src = [np.zeros(0, dtype=np.int64)]
+        dst = [np.zeros(0, dtype=np.int64)]
+        for i, j, q_max in candidates:
+            d = np.sqrt(np.sum((centers[i] - centers[j]) ** 2, axis=1)) / max_d
+            mu = sizes[j] * 0.2 * 2 * (1 - d) / 3
+            with np.errstate(divide="ignore"):
+                q = np.exp(-1 / mu)
+            accept = np.random.random(len(i)) < q / q_max
+            i = i[accept]
+            j = j[accept]
+            n_connections = 1 + np.floor(np.random.exponential(mu[accept])).astype(
+                np.int64
+            )
+            i = np.repeat(i, n_connections)
+            j = np.repeat(j, n_connections)
+            src.append(leaf_offsets[i] + np.floor(np.random.random(len(i)) * sizes[i]))
+            dst.append(leaf_offsets[j] + np.floor(np.random.random(len(j)) * sizes[j]))
+        return (
+            np.concatenate(src).astype(np.int64),
+            np.concatenate(dst).astype(np.int64),
+        )
 
-                for z1, z2 in zip(p1s, p2s):
-                    self.adj[id(z1)].add(id(z2))
-                    self.back_adj[id(z2)].add(id(z1))
+    def adjacency_matrix(self, implicit_cliques=False, external="grid"):
+        """Create nodes and the contact graph from the BSP tree.
+
+        Everyone in a leaf has contact with everyone else in the leaf. With
+        `implicit_cliques`, these contacts are kept as leaf membership instead
+        of as explicit pairs, making memory linear in the leaf sizes.
+
+        Contacts between leaves are generated by `external_contacts_grid`, or
+        by the original `external_contacts_pairwise` with
+        `external="pairwise"`.
+        """
+        self.nodes = []
+        self.census = Census()
+        src = [np.zeros(0, dtype=np.int64)]
+        dst = [np.zeros(0, dtype=np.int64)]
+        leaves = self.tree.leaves()
+        n_leaves = len(leaves)
+        sizes = self.tree.leaf_sizes()
+        leaf_offsets = np.zeros(n_leaves + 1, dtype=np.int64)
+        np.cumsum(sizes, out=leaf_offsets[1:])
+
+        # All points of all leaves at once, leaf by leaf.
+        x, y = rect_coordinates(self.tree.leaf_bounds())
+        self.x = x.astype(np.int32)
+        self.y = y.astype(np.int32)
+        leaf_of = np.repeat(np.arange(n_leaves), sizes)
+        self.nodes = [
+            Node(i, leaves[leaf], xi, yi, self.census)
+            for i, (leaf, xi, yi) in enumerate(
+                zip(leaf_of.tolist(), x.tolist(), y.tolist())
+            )
+        ]
+
+        if not implicit_cliques:
+            for i in range(n_leaves):
+                instrument.progress("internal contacts", i + 1, n_leaves)
+                pi, pj = np.triu_indices(sizes[i], 1)
+                src.append(pi + leaf_offsets[i])
+                dst.append(pj + leaf_offsets[i])
+
+        instrument.message("Creating external leaf connections")
+        if external == "grid":
+            contacts = self.external_contacts_grid(leaves, leaf_offsets)
+        elif external == "pairwise":
+            contacts = self.external_contacts_pairwise(leaves, leaf_offsets)
+        else:
+            raise ValueError(f"Unknown external contact generator '{external}'")
+        src.append(contacts[0])
+        dst.append(contacts[1])
+
+        self.leaves = leaves
+        self.leaf_offsets = leaf_offsets
+        self.set_contacts(
+            ContactGraph.from_edges(
+                len(self.nodes),
+                np.concatenate(src),
+                np.concatenate(dst),
+                cliques=leaf_offsets if implicit_cliques else None,
+            )
+        )
+        instrument.message(self.contacts)
@@ -0,0 +1,201 @@
+"""
+Jonas Nockert (2020)
+
+Instrumentation of simulation steps and graph building.
+
+Code reports to the module-level `instrument`:
+
+- `instrument.tick(t)` when a step starts,
+- `with instrument.phase("transmission"):` around the parts of a step,
+- `instrument.count("infections", n)` for work counters,
+- `instrument.progress(task, done, total)` for long-running builds,
+- `instrument.message(text)` for anything else worth telling.
+
+Subscribers are callables receiving each event as a dict. A "tick" event is
+emitted for step t when step t + 1 starts (or on `flush`), so that it also
+covers work done between steps, such as rendering the state after the step.
+It holds the time spent in each phase and the counters.
+
+Without subscribers, every call returns immediately, so instrumented code runs
+at nearly full speed when nobody listens. Included sinks write JSON lines
+(`JsonLinesSink`), keep events in memory (`MemorySink`) or print them
+(`ConsoleSink`).
+
+"""
+import contextlib
+import json
+import sys
+import time
+
+
+class Instrument:
+    def __init__(self):
+        self.subscribers = []
+        self.enabled = False
+        self.t = None
+        self.phases = {}
+        self.counters = {}
+        # Task -> (start time, last reported percentage).
+        self.tasks = {}
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+        self.enabled = True
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.remove(subscriber)
+        self.enabled = bool(self.subscribers)
+
+    @contextlib.contextmanager
+    def subscribed(self, subscriber):
+        self.subscribe(subscriber)
+        try:
+            yield subscriber
+        finally:
+            self.flush()
+            self.unsubscribe(subscriber)
+
+    def emit(self, event):
+        for subscriber in self.subscribers:
+            subscriber(event)
+
+    def tick(self, t):
+        """Start step t, emitting the previous step's tick event."""
+        if not self.enabled:
+            return
+        self.flush()
+        self.t = t
+
+    def flush(self):
+        """Emit the tick event of the current step, if any."""
+        if self.t is None:
+            return
+        event = {
+            "event": "tick",
+            "t": self.t,
+            "phases": self.phases,
+            "counters": self.counters,
+        }
+        self.t = None
+        self.phases = {}
+        self.counters = {}
+        self.emit(event)
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL_PHASE
+        return self.timed_phase(name)
+
+    @contextlib.contextmanager
+    def timed_phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def progress(self, task, done, total):
+        """Report `done` out of `total` units of `task`, at most once per
+        percent."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if task not in self.tasks or done == 0:
+            self.tasks[task] = (now, -1)
+        start, reported = self.tasks[task]
+        fraction = done / total if total else 1.0
+        percent = int(100 * fraction)
+        if percent <= reported:
+            return
+        self.tasks[task] = (start, percent)
+        elapsed = now - start
+        eta = elapsed / fraction - elapsed if fraction > 0 else None
+        self.emit(
+            {
+                "event": "progress",
+                "task": task,
+                "done": done,
+                "total": total,
+                "fraction": fraction,
+                "elapsed": elapsed,
+                "eta": eta,
+            }
+        )
+        if done >= total:
+            del self.tasks[task]
+
+    def message(self, text):
+        if self.enabled:
+            self.emit({"event": "message", "text": str(text)})
+
+
+NULL_PHASE = contextlib.nullcontext()
+
+instrument = Instrument()
+
+
+class MemorySink:
+    """Keeps all events in `events`."""
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def ticks(self):
+        return [event for event in self.events if event["event"] == "tick"]
+
+
+class JsonLinesSink:
+    """Writes each event as one line of JSON to a file or path."""
+
+    def __init__(self, file):
+        self.owned = isinstance(file, str)
+        self.file = open(file, "w") if self.owned else file
+
+    def __call__(self, event):
+        self.file.write(json.dumps(event) + "\n")
+
+    def close(self):
+        if self.owned:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+class ConsoleSink:
+    """Prints events in a human-readable form."""
+
+    def __init__(self, file=None):
+        self.file = file or sys.stdout
+
+    def __call__(self, event):
+        kind = event["event"]
+        if kind == "tick":
+            phases = ", ".join(
+                f"{name} {1000 * seconds:.1f} ms"
+                for name, seconds in event["phases"].items()
+            )
+            counters = ", ".join(
+                f"{name} {value}" for name, value in event["counters"].items()
+            )
+            line = f"t={event['t']}: {phases}"
+            if counters:
+                line += f" ({counters})"
+        elif kind == "progress":
+            line = "{}: {:.0f} % ({:.0f} s".format(
+                event["task"], 100 * event["fraction"], event["elapsed"]
+            )
+            if event["eta"] is not None and event["fraction"] < 1:
+                line += ", {:.0f} s remaining".format(event["eta"])
+            line += ")"
+        else:
+            line = event.get("text", str(event))
+        print(line, file=self.file)
@@ -0,0 +1,156 @@
+"""
+Jonas Nockert (2020)
+
+Reversible interventions on the contact graph.
+
+The contact graph built by `Graph.adjacency_matrix` is never modified.
+Instead, each intervention gives a weight multiplier for every stored contact
+(and for every implicit leaf clique), and the contacts the engines see carry
+the product of the multipliers of all active interventions. A multiplier of 0
+drops a contact, and lifting an intervention restores the previous weights
+without losing or rebuilding anything.
+
+Random masks (as for physical distancing) are derived from a hash of the
+contact's two node ids and a seed, so they are symmetric, reproducible and
+the same every time the intervention is applied.
+
+"""
+import math
+
+import numpy as np
+
+from bsp import common_levels
+
+
+def splitmix64(x):
+    """SplitMix64 finalizer, a well-mixed 64-bit hash of each element."""
+    # Wraparound is intended.
+    with np.errstate(over="ignore"):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def contact_uniforms(contacts, seed):
+    """A uniform [0, 1) number per stored contact, equal for both directions."""
+    rows = contacts.rows().astype(np.uint64)
+    cols = contacts.indices.astype(np.uint64)
+    keys = np.minimum(rows, cols) * np.uint64(contacts.n_nodes) + np.maximum(rows, cols)
+    hashed = splitmix64(keys ^ splitmix64(np.uint64(seed)))
+    return (hashed >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+def leaf_of_nodes(graph):
+    return np.repeat(np.arange(len(graph.leaves)), np.diff(graph.leaf_offsets))
+
+
+def contact_leaves(graph, contacts):
+    """Leaf of both endpoints of every stored contact."""
+    leaf_of = leaf_of_nodes(graph)
+    return leaf_of[contacts.rows()], leaf_of[contacts.indices]
+
+
+class Intervention:
+    """Base class. Subclasses return multipliers for the stored contacts
+    (`contact_multipliers`) and for the implicit cliques
+    (`clique_multipliers`), or None where they have no effect."""
+
+    def contact_multipliers(self, graph, contacts):
+        return None
+
+    def clique_multipliers(self, graph, contacts):
+        return None
+
+
+class PhysicalDistancing(Intervention):
+    """Everyone keeps each of their contacts with probability `rate`.
+
+    Implicit cliques cannot drop individual contacts, so their weight is
+    scaled by `rate` instead, giving the same expected number of
+    transmissions.
+    """
+
+    def __init__(self, rate=0.5, seed=None):
+        self.rate = rate
+        self.seed = np.random.randint(2 ** 63) if seed is None else seed
+
+    def contact_multipliers(self, graph, contacts):
+        keep = contact_uniforms(contacts, self.seed) < self.rate
+        return keep.astype(np.float32)
+
+    def clique_multipliers(self, graph, contacts):
+        n_cliques = len(contacts.cliques) - 1
+        return np.full(n_cliques, self.rate, dtype=np.float32)
+
+
+class LeafIntervention(Intervention):
+    """Scale all contacts of the members of the given leaves by `factor`,
+    e.g. closing a set of work places or neighborhoods."""
+
+    def __init__(self, leaves, factor=0.0):
+        self.leaves = np.asarray(leaves)
+        self.factor = factor
+
+    def contact_multipliers(self, graph, contacts):
+        a, b = contact_leaves(graph, contacts)
+        hit = np.isin(a, self.leaves) | np.isin(b, self.leaves)
+        return np.where(hit, self.factor, 1).astype(np.float32)
+
+    def clique_multipliers(self, graph, contacts):
+        multipliers = np.ones(len(contacts.cliques) - 1, dtype=np.float32)
+        multipliers[self.leaves] = self.factor
+        return multipliers
+
+
+class LevelIntervention(Intervention):
+    """Scale contacts between leaves whose closest common BSP ancestor is
+    above (has a lower level than) `level` by `factor`.
+
+    With level 1, only contacts within the two halves of the population are
+    kept; higher levels restrict contacts to smaller and smaller groups.
+    Contacts within a leaf are not affected.
+    """
+
+    def __init__(self, level, factor=0.0):
+        self.level = level
+        self.factor = factor
+
+    def contact_multipliers(self, graph, contacts):
+        ancestors = graph.tree.ancestors()
+        a, b = contact_leaves(graph, contacts)
+        common_level = common_levels(ancestors, a, b)
+        far = (common_level < self.level) & (a != b)
+        return np.where(far, self.factor, 1).astype(np.float32)
+
+
+class DistanceIntervention(Intervention):
+    """Scale contacts between leaves further apart than `max_distance`
+    (relative to the grid diagonal) by `factor`, e.g. travel restrictions."""
+
+    def __init__(self, max_distance, factor=0.0):
+        self.max_distance = max_distance
+        self.factor = factor
+
+    def contact_multipliers(self, graph, contacts):
+        centers = graph.tree.leaf_centers().astype(np.float64)
+        max_d = math.sqrt(graph.n1 ** 2 + graph.n2 ** 2)
+        a, b = contact_leaves(graph, contacts)
+        d = np.sqrt(np.sum((centers[a] - centers[b]) ** 2, axis=1)) / max_d
+        return np.where(d > self.max_distance, self.factor, 1).astype(np.float32)
+
+
+def combined_contacts(graph, interventions):
+    """`graph.base_contacts` weighted by all `interventions`."""
+    contacts = graph.base_contacts
+    weights = contacts.weights
+    clique_weights = contacts.clique_weights
+    for intervention in interventions:
+        multipliers = intervention.contact_multipliers(graph, contacts)
+        if multipliers is not None:
+            weights = multipliers if weights is None else weights * multipliers
+        if contacts.cliques is not None:
+            multipliers = intervention.clique_multipliers(graph, contacts)
+            if multipliers is not None:
+                clique_weights = clique_weights * multipliers
+    return contacts.with_weights(weights, clique_weights)
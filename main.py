@@ -7,48 +7,264 @@ at Stockholm University, Summer 2020.
 
 Probably not very interesting or useful.
 
+Usage:
+    python main.py [--size 100] [--steps 250] [--seed 1] [--engine frontier]
+        [--stats stats.csv] [--events events.jsonl] [--transmission-log run.log]
+        [--frames images/image-{:03d}.png] [--plots images/plot-{:03d}.png]
+        [--checkpoint run.ckpt [--checkpoint-every 10]] [--resume run.ckpt]
+
+Without --frames, --video or --plots nothing is drawn and matplotlib, seaborn
+and PIL are never imported, which keeps short batch runs cheap to start.
+
 """
+import argparse
 import glob
-from pathlib import Path
+import os
+import random
+import re
 import sys
 
-from graph import Graph
+import numpy as np
+
+from instrumentation import ConsoleSink, JsonLinesSink, instrument
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--size", type=int, default=100, help="grid width")
+    parser.add_argument("--height", type=int, help="grid height (default --size)")
+    parser.add_argument("--steps", type=int, default=250)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--engine",
+        default="frontier",
+        help="graph, array, frontier, events, parallel or cohort "
+        "(see ensemble.make_engine)",
+    )
+    parser.add_argument("--initially-infected", type=int, default=1)
+    # Distancing starts when the ratio of infected to susceptible exceeds the
+    # threshold and is lifted again when it falls below the opening up
+    # threshold. The contact graph is kept intact, so opening up restores
+    # every contact.
+    parser.add_argument(
+        "--distancing-threshold",
+        type=float,
+        default=0.1,
+        help="start physical distancing above this ratio of infected to "
+        "susceptible (negative to never distance)",
+    )
+    parser.add_argument(
+        "--distancing-rate",
+        type=float,
+        default=0.1,
+        help="fraction of contacts kept during physical distancing",
+    )
+    parser.add_argument(
+        "--opening-up-threshold",
+        type=float,
+        default=-1,
+        help="lift physical distancing below this ratio (negative, the default, "
+        "to never lift)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="always build the contact network"
+    )
+    parser.add_argument("--cache-dir", default=".cache/networks")
+    parser.add_argument(
+        "--checkpoint", help="save the simulation state to this file while running"
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=10,
+        help="steps between checkpoints",
+    )
+    parser.add_argument(
+        "--resume",
+        help="continue from a checkpoint up to --steps, with the network, "
+        "engine and state from the checkpoint (pass the same distancing "
+        "options as the original run)",
+    )
+    parser.add_argument(
+        "--estimate-r0",
+        action="store_true",
+        help="print R0 and the growth rate estimated from the contact graph "
+        "before running (see reproduction.py), e.g. with --steps 0",
+    )
+    parser.add_argument("--stats", help="write daily counts to a .csv or .npz file")
+    parser.add_argument("--events", help="write instrumentation events as JSON lines")
+    parser.add_argument(
+        "--transmission-log",
+        help="log who infected whom and every state transition to this file "
+        "(see eventlog.py), continued on --resume",
+    )
+    parser.add_argument(
+        "--quiet", action="store_true", help="do not print progress and timings"
+    )
+    parser.add_argument("--frames", help="PNG frame pattern, e.g. image-{:03d}.png")
+    parser.add_argument("--video", help="encode frames to this file with ffmpeg")
+    parser.add_argument("--video-scale", type=int, default=8)
+    parser.add_argument("--plots", help="plot pattern, e.g. plot-{:03d}.png")
+    return parser.parse_args(argv)
+
+
+def build_graph(args):
+    """The contact network, from the on-disk cache unless --no-cache."""
+    height = args.height or args.size
+    if args.no_cache:
+        from graph import Graph
+
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        graph = Graph(args.size, height)
+        graph.adjacency_matrix(implicit_cliques=True)
+        return graph
+
+    from cache import NetworkCache
+
+    # Only the `Node`-based engine needs `Node` objects.
+    return NetworkCache(args.cache_dir).get_or_build(
+        args.size,
+        height,
+        seed=args.seed,
+        nodes=args.engine == "graph",
+        implicit_cliques=True,
+    )
+
+
+def prepare_pattern(pattern):
+    """Create the directory of a file pattern and remove files left in it by
+    an earlier run writing to the same pattern."""
+    os.makedirs(os.path.dirname(pattern) or ".", exist_ok=True)
+    for path in glob.glob(re.sub(r"\{[^}]*\}", "*", glob.escape(pattern))):
+        os.unlink(path)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.quiet:
+        instrument.subscribe(ConsoleSink())
+    events = instrument.subscribe(JsonLinesSink(args.events)) if args.events else None
+
+    from ensemble import make_engine, seed_streams
+
+    from checkpoint import (
+        ENGINES as CHECKPOINT_ENGINES,
+        engine_name,
+        load_checkpoint,
+        save_checkpoint,
+    )
+    from eventlog import EventLog
+    from scenarios import ThresholdPolicy
+
+    if args.checkpoint and args.engine not in CHECKPOINT_ENGINES:
+        sys.exit(f"The {args.engine} engine cannot be checkpointed")
+    if args.resume:
+        engine = load_checkpoint(args.resume)
+        g = getattr(engine, "graph", engine)
+        args.engine = engine_name(engine)
+    else:
+        g = build_graph(args)
+        # The simulation is seeded on its own so that it runs the same whether
+        # the network was built or loaded from the cache.
+        seed_streams(np.random.SeedSequence(args.seed))
+        engine = make_engine(g, args.engine)
+
+    if args.transmission_log:
+        if args.engine in ("cohort", "parallel"):
+            sys.exit("The transmission log needs an engine logging individuals")
+        g.event_log = EventLog(args.transmission_log, g, resume=bool(args.resume))
+    if args.estimate_r0:
+        from reproduction import estimate_r0
+
+        estimate = estimate_r0(engine)
+        print(
+            "Estimated R0={:.2f} (mean secondary cases {:.2f}), growth rate "
+            "{:.3f}/day, doubling time {:.1f} days".format(
+                estimate["R0"],
+                estimate["mean_secondary_cases"],
+                estimate["growth_rate"],
+                estimate["doubling_time"],
+            )
+        )
+    initially_infected = None
+    if not args.resume:
+        initially_infected = engine.infect_random(n=args.initially_infected)
 
+    if args.stats and args.stats.endswith(".csv"):
+        g.stats.stream_csv(args.stats)
 
-g = Graph(100, 100)
-g.adjacency_matrix()
-initially_infected = g.infect_random(n=1)
-physical_distancing = False
+    drawing = args.frames or args.video
+    if drawing:
+        from render import FfmpegSink, FrameWriter, PngSink, Renderer
 
-for p in Path("./images").glob("image-*.png"):
-    p.unlink()
-for p in Path("./images").glob("plot-*.png"):
-    p.unlink()
+        if args.engine == "cohort":
+            sys.exit("Frames need an engine tracking individuals")
+        renderer = Renderer(g)
+        if args.video:
+            frames = FrameWriter(
+                FfmpegSink(args.video, g.n1, g.n2, scale=args.video_scale)
+            )
+        else:
+            if not args.resume:
+                prepare_pattern(args.frames)
+            sink = PngSink(args.frames)
+            # Resumed runs continue the numbering.
+            sink.index = g.t
+            frames = FrameWriter(sink)
+    if args.plots and not args.resume:
+        prepare_pattern(args.plots)
 
-for i in range(250):
-    g.step()
+    policy = ThresholdPolicy(
+        threshold=args.distancing_threshold if args.distancing_threshold >= 0 else None,
+        rate=args.distancing_rate,
+        opening_up_threshold=(
+            args.opening_up_threshold if args.opening_up_threshold >= 0 else None
+        ),
+    )
+    while g.t < args.steps:
+        engine.step()
+        i = g.t - 1
 
-    n_susceptible = g.stats[-1]["S"]
-    n_infected = g.stats[-1]["I"]
-    # n_recovered = g.stats[-1]["R"]
+        # Stop early if epidemic is over.
+        if g.stats[-1]["I"] == 0:
+            break
+        policy(engine)
 
-    # Stop early if epidemic is over.
-    if n_infected == 0:
-        break
+        if args.plots:
+            g.plot(show=False, filename=args.plots.format(i))
+        if drawing:
+            if args.engine == "graph":
+                state = [node.state.value for node in g.nodes]
+            else:
+                state = engine.state
+            frames.write(renderer.frame(state))
+        if args.checkpoint and g.t % args.checkpoint_every == 0:
+            save_checkpoint(args.checkpoint, engine)
 
-    # TODO Physical distancing only when we have a large amount of
-    # simultaneous infections? The number of cumulative infections would
-    # not count into the decision, right?
-    if not physical_distancing and (n_infected / n_susceptible) > 0.1:
-        physical_distancing = True
-        g.physical_distancing(rate=0.1)
-    # elif physical_distancing and (n_infected / n_susceptible) > 0.1:
-    # simulate opening up.
+    if drawing:
+        frames.close()
+    if g.event_log is not None:
+        g.event_log.close()
+    instrument.flush()
+    if events:
+        events.close()
 
-    g.plot(filename=f"images/plot-{i:03d}.png")
-    g.image(filename=f"images/image-{i:03d}.png")
+    if args.stats:
+        if args.stats.endswith(".npz"):
+            g.stats.save_npz(args.stats)
+        g.stats.close()
+    if not len(g.stats):
+        return 0
+    last = g.stats[-1]
+    print(
+        f"t={last['t']}: S={last['S']} I={last['I']} R={last['R']} "
+        f"cumulative infected={last['ICUM']}"
+    )
+    if initially_infected is not None:
+        print(f"Initially infected: {[int(i) for i in initially_infected]}")
+    return 0
 
-print(g.stats)
 
-# Uncomment to show connection graph of the first initially infected person.
-# g.image(adj_id=initially_infected[0], modal=True)
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,391 @@
+"""
+Jonas Nockert (2020)
+
+Multi-process stepping over BSP subtrees.
+
+The population is split into partitions of whole BSP subtrees (see
+`subtree_partitions`). Since nodes are numbered leaf by leaf and the leaves of
+a subtree are consecutive, each partition is a contiguous range of node
+indices, and since cliques are leaves, clique infections never cross a
+partition boundary.
+
+Each partition is stepped by its own worker process. Node state, counters,
+infection rates and the CSR contact arrays are kept in shared memory, so
+workers read the state of any node but only ever write their own. A step has
+three phases with all workers waiting for each other in between:
+
+1. latent -> infectious -> recovered transitions of the partition's nodes,
+2. infection attempts from the partition's infectious nodes, which only read
+   state; hits on the partition's own nodes are kept, hits on other
+   partitions' nodes are sent back to the engine,
+3. infection of the kept hits and of the hits sent by other partitions.
+
+Only the cross-partition hits are exchanged between processes. Every worker
+draws from its own stream, seeded from `np.random.SeedSequence(seed)` and the
+partition number, so a run is reproducible for a given seed and number of
+partitions (but not across different numbers of partitions). The results
+follow `FrontierEngine`, which the workers use for their part of the step.
+
+"""
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import weakref
+
+import numpy as np
+
+from contacts import ContactGraph
+from engine import (
+    INFECTED_LATENT,
+    INFECTIOUS,
+    RECOVERED,
+    SUSCEPTIBLE,
+    ArrayEngine,
+    FrontierEngine,
+)
+from instrumentation import instrument
+
+
+CONTACT_ARRAYS = ("indptr", "indices", "weights", "cliques", "clique_weights")
+
+
+def subtree_partitions(graph, n_partitions, tolerance=0.05):
+    """Node index boundaries of `n_partitions` partitions of about equal size
+    made of whole BSP subtrees.
+
+    The tree is cut at the shallowest level where joining runs of consecutive
+    subtrees gives partitions within `tolerance` of an equal share of the
+    nodes, falling back to the leaves. Returns an array [0, ..., N] of at most
+    n_partitions + 1 offsets.
+    """
+    tree = graph.tree
+    leaf_offsets = np.asarray(graph.leaf_offsets)
+    n_nodes = int(leaf_offsets[-1])
+    share = n_nodes / n_partitions
+    targets = np.arange(1, n_partitions) * share
+    for level in range(int(tree.levels.max()) + 1):
+        groups = tree.groups(level)
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        # Cut at the subtree boundaries closest to equal shares of the nodes.
+        offsets = np.append(leaf_offsets[starts], n_nodes)
+        closest = np.clip(np.searchsorted(offsets, targets), 1, len(offsets) - 1)
+        below = offsets[closest - 1]
+        above = offsets[closest]
+        cuts = np.where(targets - below < above - targets, below, above)
+        boundaries = np.unique(np.concatenate(([0], cuts, [n_nodes])))
+        if np.all(np.abs(np.diff(boundaries) - share) <= tolerance * share):
+            break
+    return boundaries.astype(np.int64)
+
+
+class SharedArrays:
+    """NumPy arrays in named shared memory blocks.
+
+    The creating process owns the blocks and unlinks them on `close`; other
+    processes `attach` to them by their `specs`.
+    """
+
+    def __init__(self, owner=True):
+        self.owner = owner
+        self.blocks = {}
+        self.arrays = {}
+
+    def share(self, name, array):
+        """Copy `array` into a new block, replacing any block named `name`."""
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = np.ndarray(array.shape, array.dtype, buffer=block.buf)
+        shared[...] = array
+        self.release(name)
+        self.blocks[name] = block
+        self.arrays[name] = shared
+        return shared
+
+    def specs(self):
+        return {
+            name: (self.blocks[name].name, array.dtype.str, array.shape)
+            for name, array in self.arrays.items()
+        }
+
+    @classmethod
+    def attach(cls, specs):
+        shared = cls(owner=False)
+        shared.update(specs)
+        return shared
+
+    def update(self, specs):
+        """Attach to the blocks in `specs` not already attached to."""
+        for name, (block_name, dtype, shape) in specs.items():
+            if name in self.blocks and self.blocks[name].name == block_name:
+                continue
+            self.release(name)
+            block = shared_memory.SharedMemory(name=block_name)
+            self.blocks[name] = block
+            self.arrays[name] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+
+    def release(self, name):
+        if name not in self.blocks:
+            return
+        del self.arrays[name]
+        block = self.blocks.pop(name)
+        block.close()
+        if self.owner:
+            block.unlink()
+
+    def close(self):
+        for name in list(self.blocks):
+            self.release(name)
+
+
+class Partition(FrontierEngine):
+    """The nodes lo, ..., hi - 1 of a `ParallelEngine`, stepped in a worker.
+
+    State arrays are shared with the engine and the other partitions; `counts`
+    and `cumulative` only count the partition's own nodes.
+    """
+
+    # Workers do not log events (see `eventlog.py`).
+    event_log = None
+
+    def __init__(self, shared, boundaries, k):
+        self.graph = None
+        self.shared = shared
+        self.boundaries = boundaries
+        self.k = k
+        self.lo = int(boundaries[k])
+        self.hi = int(boundaries[k + 1])
+        self.state = shared.arrays["state"]
+        self.counter = shared.arrays["counter"]
+        self.infection_rate = shared.arrays["infection_rate"]
+        self.N = len(self.state)
+        own = self.state[self.lo : self.hi]
+        self.counts = np.bincount(own, minlength=RECOVERED + 1)
+        self.cumulative = 0
+        self.active = self.lo + np.flatnonzero(
+            (own == INFECTED_LATENT) | (own == INFECTIOUS)
+        )
+        self.hits = np.zeros(0, dtype=np.int64)
+        self.load_edges()
+
+    def load_edges(self, specs=None):
+        if specs is not None:
+            # Drop the old contact graph before its blocks are released.
+            self.contacts = None
+            self.shared.update(specs)
+        arrays = {
+            name: self.shared.arrays.get(f"contacts_{name}") for name in CONTACT_ARRAYS
+        }
+        self.contacts = ContactGraph(**arrays)
+
+    def infect_nodes(self, indices):
+        """Make the given (own) nodes infectious, as `infect_random`."""
+        self.infectious(indices)
+        self.active = np.union1d(self.active, indices)
+
+    def transmit(self):
+        """Draw the infection attempts of the partition's infectious nodes.
+
+        Hits on own nodes are kept for `infect_hits`. Returns the hits on other
+        partitions' nodes, per partition, and work counters.
+        """
+        infectious = self.active[self.state[self.active] == INFECTIOUS]
+        counters = {"edges_examined": 0, "infection_attempts": 0}
+        if len(infectious) == 0:
+            self.hits = np.zeros(0, dtype=np.int64)
+            return [np.zeros(0, dtype=np.int64)] * (len(self.boundaries) - 1), counters
+        src, dst, weights = self.contacts.gather(infectious)
+        susceptible = self.state[dst] == SUSCEPTIBLE
+        src = src[susceptible]
+        dst = dst[susceptible]
+        counters["edges_examined"] = len(susceptible)
+        counters["infection_attempts"] = len(dst)
+        rate = self.infection_rate[np.minimum(src, dst)]
+        if weights is not None:
+            rate = rate * weights[susceptible]
+        hits = np.random.random(len(dst)) < rate
+        clique_sources, clique_targets = self.clique_hits(infectious)
+        targets, _ = self.first_hits(
+            np.concatenate((src[hits], clique_sources)),
+            np.concatenate((dst[hits], clique_targets)),
+        )
+        targets = np.unique(targets).astype(np.int64)
+
+        owners = np.searchsorted(self.boundaries, targets, side="right") - 1
+        self.hits = targets[owners == self.k]
+        remote = [targets[owners == k] for k in range(len(self.boundaries) - 1)]
+        remote[self.k] = np.zeros(0, dtype=np.int64)
+        return remote, counters
+
+    def infect_hits(self, incoming):
+        """Infect the kept hits and those sent by other partitions. Returns the
+        number infected."""
+        targets = np.unique(np.concatenate([self.hits, *incoming]))
+        self.infect(targets)
+        self.active = np.concatenate((self.active, targets))
+        self.hits = np.zeros(0, dtype=np.int64)
+        return len(targets)
+
+    def pre_step(self):
+        infectious = self.counts[INFECTIOUS]
+        recovered = self.counts[RECOVERED]
+        super().pre_step()
+        to_recovered = self.counts[RECOVERED] - recovered
+        return int(self.counts[INFECTIOUS] - infectious + 2 * to_recovered)
+
+    def tally(self):
+        return self.counts.tolist(), self.cumulative
+
+
+def run_partition(connection, specs, boundaries, k, seed_sequence):
+    """Worker process: run commands from the engine on partition k."""
+    from ensemble import seed_streams
+
+    seed_streams(seed_sequence)
+    shared = SharedArrays.attach(specs)
+    partition = Partition(shared, boundaries, k)
+    while True:
+        command, args = connection.recv()
+        if command == "stop":
+            break
+        connection.send(getattr(partition, command)(*args))
+    # Views into the blocks must be gone before the blocks are closed.
+    del partition
+    shared.close()
+    connection.close()
+
+
+class ParallelEngine(ArrayEngine):
+    """Array engine stepping BSP subtree partitions in worker processes.
+
+    `n_workers` defaults to the number of CPUs. Call `close` (or use the
+    engine as a context manager) to stop the workers and free the shared
+    memory; the state stays readable afterwards.
+    """
+
+    def __init__(self, graph, n_workers=None, seed=None):
+        self.workers = []
+        self.shared = SharedArrays()
+        super().__init__(graph)
+        # Partitions count infections from here on.
+        self.initial_cumulative = self.cumulative
+        self.n_workers = n_workers or os.cpu_count() or 1
+        if seed is None:
+            seed = int(np.random.randint(2 ** 63))
+        self.seed = seed
+
+        self.state = self.shared.share("state", self.state)
+        self.counter = self.shared.share("counter", self.counter)
+        self.infection_rate = self.shared.share("infection_rate", self.infection_rate)
+        self.share_contacts()
+        self.boundaries = subtree_partitions(graph, self.n_workers)
+
+        context = multiprocessing.get_context()
+        seed_sequences = np.random.SeedSequence(seed).spawn(len(self.boundaries) - 1)
+        for k, seed_sequence in enumerate(seed_sequences):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=run_partition,
+                args=(
+                    worker_connection,
+                    self.shared.specs(),
+                    self.boundaries,
+                    k,
+                    seed_sequence,
+                ),
+                daemon=True,
+            )
+            process.start()
+            worker_connection.close()
+            self.workers.append((process, connection))
+        self.finalizer = weakref.finalize(self, stop_workers, self.workers, self.shared)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop the workers and release the shared memory."""
+        if not self.finalizer.alive:
+            return
+        self.state = self.state.copy()
+        self.counter = self.counter.copy()
+        self.infection_rate = self.infection_rate.copy()
+        self.finalizer()
+
+    def share_contacts(self):
+        """Copy contact arrays that changed since they were last shared into
+        shared memory."""
+        for name in CONTACT_ARRAYS:
+            array = getattr(self.contacts, name)
+            key = f"contacts_{name}"
+            if array is None:
+                self.shared.release(key)
+            elif getattr(self, f"shared_{key}", None) is not array:
+                self.shared.share(key, array)
+                setattr(self, f"shared_{key}", array)
+
+    def load_edges(self):
+        self.contacts = self.graph.contacts
+        if self.workers:
+            self.share_contacts()
+            self.run("load_edges", self.shared.specs())
+
+    def run(self, command, *args, per_worker=None):
+        """Run a command on all partitions, returning their results.
+        `per_worker` gives a separate argument tuple for each."""
+        for k, (_, connection) in enumerate(self.workers):
+            connection.send((command, per_worker[k] if per_worker else args))
+        return [connection.recv() for _, connection in self.workers]
+
+    def owners(self, indices):
+        return np.searchsorted(self.boundaries, indices, side="right") - 1
+
+    def infect_random(self, n=1):
+        indices = np.random.randint(self.N, size=n)
+        unique = np.unique(indices)
+        owners = self.owners(unique)
+        self.run(
+            "infect_nodes",
+            per_worker=[(unique[owners == k],) for k in range(len(self.workers))],
+        )
+        self.update_counts()
+        return list(indices)
+
+    def update_counts(self):
+        counts = self.run("tally")
+        self.counts = np.sum([c for c, _ in counts], axis=0)
+        self.cumulative = self.initial_cumulative + sum(c for _, c in counts)
+
+    def pre_step(self):
+        instrument.count("transitions", sum(self.run("pre_step")))
+
+    def transmit(self):
+        if self.contacts is not self.graph.contacts:
+            self.load_edges()
+        results = self.run("transmit")
+        incoming = [
+            [remote[k] for remote, _ in results] for k in range(len(self.workers))
+        ]
+        for _, counters in results:
+            for name, n in counters.items():
+                instrument.count(name, n)
+        instrument.count(
+            "exchanged", sum(sum(len(hits) for hits in remote) for remote, _ in results)
+        )
+        infected = self.run("infect_hits", per_worker=[(hits,) for hits in incoming])
+        instrument.count("infections", sum(infected))
+        self.update_counts()
+
+
+def stop_workers(workers, shared):
+    for process, connection in workers:
+        try:
+            connection.send(("stop", ()))
+        except (BrokenPipeError, OSError):
+            pass
+    for process, connection in workers:
+        process.join()
+        connection.close()
+    shared.close()
@@ -0,0 +1,139 @@
+"""
+Jonas Nockert (2020)
+
+Matplotlib backend selection and incremental time-series plotting.
+
+`pyplot` picks the backend on first use: MacOSX on macOS, the matplotlib
+default where a display is available and the non-interactive Agg backend
+otherwise (e.g. on batch nodes without X11/Wayland).
+
+`StatsPlot` keeps one figure with persistent line artists. Every update only
+appends the newest days to preallocated buffers and the figure is only
+redrawn every `every`-th update, so the cost of a frame does not grow with the
+length of the run.
+
+"""
+import os
+import sys
+
+import numpy as np
+
+from instrumentation import instrument
+
+
+def has_display():
+    if sys.platform in ("darwin", "win32"):
+        return True
+    return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+
+def pyplot():
+    """Import and return `matplotlib.pyplot` with a suitable backend."""
+    if "matplotlib.pyplot" not in sys.modules:
+        import matplotlib
+
+        if "MPLBACKEND" not in os.environ:
+            if sys.platform == "darwin":
+                matplotlib.use("MacOSX")
+            elif not has_display():
+                matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def is_interactive():
+    import matplotlib
+
+    return matplotlib.get_backend().lower() not in ("agg", "pdf", "ps", "svg", "cairo")
+
+
+class StatsPlot:
+    # (stats key, color, label), drawn in this order.
+    LINES = (
+        ("S", "blue", "S"),
+        ("ICUM", "orange", "I (cumul.)"),
+        ("R", "green", "R"),
+        ("I", "red", "I"),
+    )
+
+    def __init__(self, N, every=1, num=1):
+        plt = pyplot()
+        self.N = N
+        self.every = every
+        self.n_updates = 0
+        self.size = 0
+        self.t = np.zeros(256)
+        self.values = {key: np.zeros(256) for key, _, _ in self.LINES}
+
+        self.fig = plt.figure(num, clear=True)
+        self.ax = self.fig.gca()
+        self.lines = {
+            key: self.ax.plot([], [], color=color, label=label)[0]
+            for key, color, label in self.LINES
+        }
+        self.physical_distancing_line = None
+        self.opening_up_line = None
+        self.ax.set_ylim(0, N * 1.05)
+        self.ax.set_xlim(0, 16)
+        self.fig.legend()
+
+    def append(self, entry):
+        if self.size == len(self.t):
+            self.t = np.resize(self.t, 2 * self.size)
+            for key in self.values:
+                self.values[key] = np.resize(self.values[key], 2 * self.size)
+        self.t[self.size] = entry["t"]
+        for key in self.values:
+            self.values[key][self.size] = entry[key]
+        self.size += 1
+
+    def mark_physical_distancing(self, t):
+        if self.physical_distancing_line is None:
+            self.physical_distancing_line = self.ax.axvline(
+                x=t, linestyle=":", color="gray", label="physical dist."
+            )
+            self.fig.legends[0].remove()
+            self.fig.legend()
+
+    def mark_opening_up(self, t):
+        if self.opening_up_line is None:
+            self.opening_up_line = self.ax.axvline(
+                x=t, linestyle="--", color="gray", label="opening up"
+            )
+            self.fig.legends[0].remove()
+            self.fig.legend()
+
+    def update(
+        self,
+        stats,
+        physical_distancing_t=None,
+        show=True,
+        filename=None,
+        opening_up_t=None,
+    ):
+        """Append the days in `stats` not yet plotted and, on every `every`-th
+        call, redraw. Returns whether the figure was drawn."""
+        for entry in stats[self.size :]:
+            self.append(entry)
+        if physical_distancing_t:
+            self.mark_physical_distancing(physical_distancing_t)
+        if opening_up_t:
+            self.mark_opening_up(opening_up_t)
+
+        self.n_updates += 1
+        if (self.n_updates - 1) % self.every != 0:
+            return False
+
+        with instrument.phase("plot"):
+            n = self.size
+            for key, line in self.lines.items():
+                line.set_data(self.t[:n], self.values[key][:n])
+            if n and self.t[n - 1] >= self.ax.get_xlim()[1]:
+                self.ax.set_xlim(0, 2 * self.t[n - 1])
+
+            if show and is_interactive():
+                pyplot().pause(0.001)
+            if filename:
+                self.fig.savefig(filename)
+        return True
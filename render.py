@@ -0,0 +1,166 @@
+"""
+Jonas Nockert (2020)
+
+Vectorized rendering of simulation state and background frame output.
+
+`Renderer` precomputes the pixel of every node and a raster of susceptible
+(leaf) colors once, so a frame is a single array operation on the state
+vector. `FrameWriter` encodes frames on a background thread into either
+numbered PNG files (`PngSink`) or a running ffmpeg process fed raw RGB frames
+over a pipe (`FfmpegSink`).
+
+"""
+import queue
+import shutil
+import subprocess
+import threading
+
+import numpy as np
+
+from instrumentation import instrument
+
+
+LATENT_COLOR = (255, 255, 0)
+INFECTIOUS_COLOR = (255, 0, 0)
+RECOVERED_COLOR = (0, 255, 0)
+
+
+class Renderer:
+    def __init__(self, graph):
+        assert graph.x is not None
+        self.width = graph.n1
+        self.height = graph.n2
+        x = graph.x.astype(np.int64)
+        y = graph.y.astype(np.int64)
+        self.pixels = y * self.width + x
+
+        # Leaf of each node from the tree's pixel raster.
+        palette = np.array(
+            [[int(c * 255) for c in leaf.color] for leaf in graph.tree.leaves()],
+            dtype=np.uint8,
+        )
+        self.leaf_colors = palette[graph.tree.leaf_at(x, y)]
+        # One row per state value (see `NodeState`); susceptible nodes get
+        # their leaf color instead.
+        self.state_colors = np.array(
+            [(0, 0, 0), (0, 0, 0), LATENT_COLOR, INFECTIOUS_COLOR, RECOVERED_COLOR],
+            dtype=np.uint8,
+        )
+
+    def frame(self, state):
+        """RGB frame of shape (height, width, 3) for a state vector."""
+        with instrument.phase("render"):
+            state = np.asarray(state)
+            colors = self.state_colors[state]
+            susceptible = state == 1
+            colors[susceptible] = self.leaf_colors[susceptible]
+            frame = np.zeros((self.height * self.width, 3), dtype=np.uint8)
+            frame[self.pixels] = colors
+            return frame.reshape(self.height, self.width, 3)
+
+
+class PngSink:
+    """Writes each frame to `pattern.format(index)`."""
+
+    def __init__(self, pattern="images/image-{:03d}.png", scale=1):
+        self.pattern = pattern
+        self.scale = scale
+        self.index = 0
+
+    def write(self, frame):
+        from PIL import Image
+
+        if self.scale != 1:
+            frame = frame.repeat(self.scale, axis=0).repeat(self.scale, axis=1)
+        Image.fromarray(frame).save(self.pattern.format(self.index))
+        self.index += 1
+
+    def close(self):
+        pass
+
+
+class FfmpegSink:
+    """Pipes raw RGB frames into a local ffmpeg process encoding `filename`."""
+
+    def __init__(self, filename, width, height, framerate=8, scale=1):
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise RuntimeError("ffmpeg not found")
+        self.process = subprocess.Popen(
+            [
+                ffmpeg,
+                "-y",
+                "-loglevel",
+                "error",
+                "-f",
+                "rawvideo",
+                "-pix_fmt",
+                "rgb24",
+                "-s",
+                f"{width}x{height}",
+                "-framerate",
+                str(framerate),
+                "-i",
+                "-",
+                "-vf",
+                f"scale={width * scale}:{height * scale}:flags=neighbor",
+                "-vcodec",
+                "libx264",
+                "-pix_fmt",
+                "yuv420p",
+                filename,
+            ],
+            stdin=subprocess.PIPE,
+        )
+
+    def write(self, frame):
+        self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class FrameWriter:
+    """Passes frames to a sink on a background thread.
+
+    At most `max_pending` frames are queued; `write` blocks beyond that so a
+    slow sink cannot grow memory without bound.
+    """
+
+    def __init__(self, sink, max_pending=32):
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            # After an error, frames are still consumed so `write` never blocks.
+            if self.error is None:
+                try:
+                    self.sink.write(frame)
+                except Exception as e:
+                    self.error = e
+        self.sink.close()
+
+    def write(self, frame):
+        if self.error:
+            raise self.error
+        self.queue.put(frame)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
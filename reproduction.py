@@ -0,0 +1,285 @@
+"""
+Jonas Nockert (2020)
+
+Estimates of R0 and the growth rate from the contact graph, without
+simulating.
+
+The next-generation operator K holds in K[j, i] the probability that node i,
+infectious for the mean infectious period d, infects node j, 1 - (1 - p * w)^d
+for a contact of weight w at daily infection rate p. The period depends on the
+engine: `EventEngine` keeps a node infectious for exactly the duration D drawn
+from `infectious_duration_dist`, while the fixed-step engines keep it
+infectious for ceil(D) + 1 daily steps (see `step_distribution`), which is
+about one and a half days longer on average. The rate is taken as the
+engines take it: that of the lower-indexed node for explicit contacts and
+that of the infectious node within implicit cliques. K is built from
+`graph.contacts`, so it reflects physical distancing and other active
+interventions.
+
+K treats every contact independently and ignores that the fixed-step engines
+let an infectious node infect at most one of its higher-indexed contacts per
+step (see `engine.py`). Where a node is likely to hit several of those in
+one step, i.e. at high infection rates and contact weights, the eigenvalue
+overstates R0 for those engines.
+
+R0 is estimated as the dominant eigenvalue of K, found with ARPACK (`eigs`)
+or by power iteration. It is the number of infections per generation early
+in an outbreak once it has settled into the network's most connected parts,
+not counting that contacts may already have been infected, and an outbreak
+can only take off if it is above 1. `mean_secondary_cases` is the simpler
+average number of infections caused by a randomly chosen node in a fully
+susceptible population.
+
+Explicit contacts are kept as a float32 sparse matrix sharing the index
+arrays of the contact graph, and implicit cliques are applied in aggregate,
+so an estimate on a large grid takes seconds and little more memory than
+the graph itself.
+
+"""
+import math
+import warnings
+
+import numpy as np
+from scipy import optimize, sparse
+from scipy.sparse import linalg
+
+
+def transmission_probability(p, period):
+    """Probability of at least one transmission in `period` days at daily
+    probability `p`."""
+    with np.errstate(divide="ignore"):
+        return -np.expm1(period * np.log1p(-np.asarray(p, dtype=np.float64)))
+
+
+def step_distribution(dist, tail=1e-9):
+    """Number of daily steps K = ceil(D) + 1 for which the fixed-step engines
+    keep a node in a state of duration D drawn from `dist`, as arrays of k
+    and P(K = k)."""
+    k = np.arange(1, int(math.ceil(dist.ppf(1 - tail))) + 2)
+    pmf = np.diff(dist.cdf(k - 1), prepend=0.0)
+    return k, pmf / pmf.sum()
+
+
+def fixed_step(engine):
+    """Whether `engine` (an engine or the `Graph`) advances nodes in daily
+    steps, i.e. is not the `EventEngine`."""
+    from events import EventEngine
+
+    return not isinstance(engine, EventEngine)
+
+
+def infectious_period(engine, distributions=None):
+    """Mean number of days a node of `engine` is infectious."""
+    from graph import Node
+
+    dist = (distributions or Node.distributions).infectious_duration_dist
+    if not fixed_step(engine):
+        return float(dist.mean())
+    k, pmf = step_distribution(dist)
+    return float(np.dot(k, pmf))
+
+
+def node_rates(engine):
+    """Daily infection rate of every node of an engine (or `Graph`)."""
+    from engine import node_arrays
+
+    graph = getattr(engine, "graph", engine)
+    rate = getattr(engine, "infection_rate", None)
+    if rate is None:
+        return node_arrays(graph)[2]
+    n_nodes = graph.contacts.n_nodes
+    return np.broadcast_to(np.asarray(rate, dtype=np.float64), (n_nodes,))
+
+
+class NextGeneration:
+    """Next-generation operator of the contacts of `engine` (an engine or the
+    `Graph`), see above.
+
+    `infection_rate` (a number or one per node) defaults to the rates of the
+    engine's nodes and `period` to the engine's mean infectious period.
+    """
+
+    def __init__(self, engine, infection_rate=None, period=None):
+        graph = getattr(engine, "graph", engine)
+        contacts = graph.contacts
+        if period is None:
+            period = infectious_period(engine)
+        if infection_rate is None:
+            rates = node_rates(engine)
+        else:
+            rates = np.broadcast_to(
+                np.asarray(infection_rate, dtype=np.float64), (contacts.n_nodes,)
+            )
+        self.period = float(period)
+        self.n_nodes = contacts.n_nodes
+
+        if np.all(rates == rates[0]):
+            edge_rates = rates[0]
+        else:
+            edge_rates = rates[np.minimum(contacts.rows(), contacts.indices)]
+        if contacts.weights is None:
+            p = edge_rates
+        else:
+            p = edge_rates * contacts.weights
+        data = np.broadcast_to(
+            transmission_probability(p, self.period), contacts.indices.shape
+        ).astype(np.float32)
+        # Matching index types keep scipy from copying the indices.
+        indptr = np.asarray(contacts.indptr).astype(contacts.indices.dtype)
+        self.explicit = sparse.csr_matrix(
+            (data, contacts.indices, indptr),
+            shape=(self.n_nodes, self.n_nodes),
+            copy=False,
+        )
+
+        self.clique_of = contacts.clique_of
+        self.clique_p = None
+        if contacts.cliques is not None:
+            weights = contacts.clique_weights[contacts.clique_of]
+            self.clique_p = transmission_probability(rates * weights, self.period)
+            self.clique_sizes = np.diff(contacts.cliques)
+
+    def matvec(self, x):
+        """K x, the expected infections caused by x[i] infectious node i."""
+        y = self.explicit @ x
+        if self.clique_p is not None:
+            # Everyone in the clique but the infectious node itself.
+            px = self.clique_p * x
+            totals = np.bincount(
+                self.clique_of, weights=px, minlength=len(self.clique_sizes)
+            )
+            y = y + (totals[self.clique_of] - px).astype(y.dtype)
+        return y
+
+    def operator(self):
+        return linalg.LinearOperator(
+            (self.n_nodes, self.n_nodes), matvec=self.matvec, dtype=np.float32
+        )
+
+    def secondary_cases(self):
+        """Expected number of infections caused by each node in a fully
+        susceptible population, the column sums of K."""
+        # Explicit contacts are symmetric, so row sums are column sums.
+        cases = np.asarray(self.explicit.sum(axis=1), dtype=np.float64).ravel()
+        if self.clique_p is not None:
+            cases += self.clique_p * (self.clique_sizes[self.clique_of] - 1)
+        return cases
+
+    def dominant_eigenvalue(self, method="arnoldi", tol=1e-4, maxiter=None):
+        """Dominant eigenvalue of K, by Arnoldi iteration ("arnoldi") or power
+        iteration ("power")."""
+        if method == "arnoldi":
+            value = linalg.eigs(
+                self.operator(), k=1, which="LM", tol=tol, maxiter=maxiter
+            )[0][0]
+            return float(abs(value))
+        elif method == "power":
+            return self.power_iteration(tol, maxiter or 10000)
+        raise ValueError(f"Unknown method '{method}'")
+
+    def power_iteration(self, tol, maxiter):
+        # K is non-negative, so starting from a positive vector converges to
+        # its Perron vector. Shifting by the identity (adding x) damps
+        # oscillation between parts of the graph without moving the
+        # eigenvector.
+        x = np.full(self.n_nodes, 1 / math.sqrt(self.n_nodes), dtype=np.float32)
+        value = 0.0
+        for _ in range(maxiter):
+            y = self.matvec(x) + x
+            norm = float(np.linalg.norm(y))
+            if norm == 0:
+                return 0.0
+            x = y / norm
+            if abs(norm - value) <= tol * norm:
+                break
+            value = norm
+        return norm - 1
+
+
+def growth_rate(r0, distributions=None, fixed_step=False):
+    """Daily exponential growth rate r of an outbreak with reproduction number
+    `r0`, solving the Euler-Lotka equation r0 * G(r) = 1 for the Laplace
+    transform G of the generation interval.
+
+    A generation interval is a latent period followed by a time uniformly
+    within the infectious period, weighted by the length of the infectious
+    period. With `fixed_step`, both periods are whole numbers of steps as in
+    the fixed-step engines (see `step_distribution`) and infections happen
+    on one of the steps of the infectious period.
+    """
+    from graph import Node
+
+    distributions = distributions or Node.distributions
+    latent = distributions.latent_period_dist
+    infectious = distributions.infectious_duration_dist
+    if fixed_step:
+        latent_steps, latent_pmf = step_distribution(latent)
+        infectious_steps, infectious_pmf = step_distribution(infectious)
+        mean_infectious = np.dot(infectious_steps, infectious_pmf)
+    else:
+        mean_infectious = infectious.mean()
+
+    def log_transform(r):
+        if r == 0:
+            return 0.0
+        if fixed_step:
+            latent_part = np.dot(latent_pmf, np.exp(-r * latent_steps))
+            # Infections on steps 0, ..., k - 1 of an infectious period of k.
+            infectious_part = np.dot(
+                infectious_pmf,
+                np.expm1(-r * infectious_steps) / math.expm1(-r),
+            )
+        else:
+            latent_part = latent.expect(lambda t: math.exp(-r * t))
+            infectious_part = infectious.expect(lambda t: -math.expm1(-r * t) / r)
+        return math.log(latent_part * infectious_part / mean_infectious)
+
+    def f(r):
+        # Non-finite where the transform does not exist.
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            try:
+                return math.log(r0) + log_transform(r)
+            except (OverflowError, ValueError, ZeroDivisionError):
+                return math.inf
+
+    if r0 <= 0:
+        return -math.inf
+    if r0 == 1:
+        return 0.0
+    # f decreases with r and f(0) = log(r0).
+    if r0 > 1:
+        hi = 0.01
+        while f(hi) > 0:
+            hi *= 2
+        return optimize.brentq(f, 0.0, hi, xtol=1e-8)
+    # For r0 < 1, f grows without bound towards the most negative r for which
+    # the transform exists. Search outwards, then bisect back from where it
+    # does not exist, for an r with 0 < f(r) < inf.
+    inside, outside = 0.0, None
+    lo = -0.01
+    for _ in range(200):
+        value = f(lo)
+        if math.isfinite(value) and value > 0:
+            return optimize.brentq(f, lo, inside, xtol=1e-8)
+        if math.isfinite(value):
+            inside = lo
+        else:
+            outside = lo
+        lo = 2 * lo if outside is None else (inside + outside) / 2
+    return math.nan
+
+
+def estimate_r0(engine, infection_rate=None, period=None, method="arnoldi", tol=1e-4):
+    """R0 and growth rate for the current contacts of `engine` (an engine or
+    the `Graph`). Returns a dict."""
+    ngm = NextGeneration(engine, infection_rate=infection_rate, period=period)
+    r0 = ngm.dominant_eigenvalue(method=method, tol=tol)
+    r = growth_rate(r0, fixed_step=fixed_step(engine))
+    return {
+        "R0": r0,
+        "mean_secondary_cases": float(np.mean(ngm.secondary_cases())),
+        "growth_rate": r,
+        "doubling_time": math.log(2) / r if r > 0 else math.inf,
+        "infectious_period": ngm.period,
+    }
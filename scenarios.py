@@ -0,0 +1,210 @@
+"""
+Jonas Nockert (2020)
+
+Forking a running simulation into scenarios with different policies.
+
+A policy is a callable taking the engine, called when the branch starts and
+after every step, that applies or lifts interventions. `ThresholdPolicy` is
+the rule `main.py` uses and `InterventionPolicy` applies fixed interventions
+from the fork on. For example, comparing distancing rates from day 30 on:
+
+    for _ in range(30):
+        engine.step()
+    stats = fork(engine, [ThresholdPolicy(rate=r) for r in (0.1, 0.3, 0.5)], 100)
+
+`fork` runs every branch in a forked process, so the branches share the
+memory of the graph, its contacts and the `Node` objects copy-on-write and
+only pay for what they change. Where processes cannot be forked, branches
+run one after the other in this process instead, each restored from a
+checkpoint of the fork point (see `checkpoint.py`) that shares the graph.
+
+By default every branch continues with the same random state, so that
+differences between branches come from the policies and not from chance; a
+branch whose policy never acts follows the original run exactly. With `seed`,
+each branch draws from its own stream instead.
+
+"""
+import multiprocessing
+import os
+import random
+import tempfile
+
+import numpy as np
+
+from graph import GraphState
+from instrumentation import instrument
+from timeseries import StatsBuffer
+
+
+class ThresholdPolicy:
+    """Physical distancing keeping each contact with probability `rate` once
+    the ratio of infected to susceptible exceeds `threshold` (None to never
+    distance), lifted again when it falls below `opening_up_threshold` (None
+    to never lift)."""
+
+    def __init__(self, threshold=0.1, rate=0.1, opening_up_threshold=None):
+        self.threshold = threshold
+        self.rate = rate
+        self.opening_up_threshold = opening_up_threshold
+
+    def __call__(self, engine):
+        graph = getattr(engine, "graph", engine)
+        if not len(graph.stats):
+            return
+        ratio = graph.stats[-1]["I"] / max(graph.stats[-1]["S"], 1)
+        distancing = graph.state == GraphState.PHYSICAL_DISTANCING
+        if not distancing and self.threshold is not None and ratio > self.threshold:
+            engine.physical_distancing(rate=self.rate)
+        elif (
+            distancing
+            and self.opening_up_threshold is not None
+            and ratio < self.opening_up_threshold
+        ):
+            engine.opening_up()
+
+
+class InterventionPolicy:
+    """Apply `interventions` (see `interventions.py`) at the start of the
+    branch."""
+
+    def __init__(self, *interventions):
+        self.interventions = interventions
+        self.applied = False
+
+    def __call__(self, engine):
+        if self.applied:
+            return
+        graph = getattr(engine, "graph", engine)
+        for intervention in self.interventions:
+            graph.apply_intervention(intervention)
+        self.applied = True
+
+
+def run_branch(engine, policy, steps, seed_sequence=None):
+    """Step `engine` under `policy`. Returns the stats rows of the branch."""
+    if seed_sequence is not None:
+        from ensemble import seed_streams
+
+        seed_streams(seed_sequence)
+    graph = getattr(engine, "graph", engine)
+    start = len(graph.stats)
+    policy(engine)
+    for _ in range(steps):
+        engine.step()
+        policy(engine)
+    return graph.stats.array()[start:].copy()
+
+
+def forked_branch(connection, engine, policy, steps, seed_sequence, random_state):
+    # `random` reseeds itself in forked processes.
+    random.setstate(random_state)
+    # Sinks belong to the parent, e.g. several processes must not write to the
+    # same file.
+    for subscriber in list(instrument.subscribers):
+        instrument.unsubscribe(subscriber)
+    # Nor may they append to the parent's stats file, if it streams one, or
+    # to its event log, whose writer thread only runs in the parent.
+    graph = getattr(engine, "graph", engine)
+    graph.stats = StatsBuffer.from_array(graph.stats.array())
+    graph.event_log = None
+    try:
+        connection.send(run_branch(engine, policy, steps, seed_sequence))
+    finally:
+        connection.close()
+
+
+def can_fork():
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def fork(engine, policies, steps, seed=None, processes=None, max_workers=None):
+    """Run `steps` steps from the current state of `engine` (an engine or the
+    `Graph`) once per policy. Returns the stats of each branch, including
+    the shared history up to the fork, as a list of `StatsBuffer`.
+
+    `engine` itself is left as it was. `processes` (default: if possible)
+    runs branches in forked processes, at most `max_workers` (default the
+    number of CPUs) at a time.
+    """
+    from parallel import ParallelEngine
+
+    if isinstance(engine, ParallelEngine):
+        raise ValueError("A ParallelEngine cannot be forked")
+    graph = getattr(engine, "graph", engine)
+    prefix = graph.stats.array().copy()
+    seed_sequences = [None] * len(policies)
+    if seed is not None:
+        seed_sequences = np.random.SeedSequence(seed).spawn(len(policies))
+    if processes is None:
+        processes = can_fork()
+
+    if processes:
+        branches = run_forked(engine, policies, steps, seed_sequences, max_workers)
+    else:
+        branches = run_restored(engine, policies, steps, seed_sequences)
+    return [StatsBuffer.from_array(np.vstack((prefix, rows))) for rows in branches]
+
+
+def run_forked(engine, policies, steps, seed_sequences, max_workers=None):
+    context = multiprocessing.get_context("fork")
+    max_workers = max_workers or os.cpu_count() or 1
+    results = [None] * len(policies)
+    pending = list(enumerate(zip(policies, seed_sequences)))
+    running = []
+    while pending or running:
+        while pending and len(running) < max_workers:
+            k, (policy, seed_sequence) = pending.pop(0)
+            connection, child_connection = context.Pipe(duplex=False)
+            process = context.Process(
+                target=forked_branch,
+                args=(
+                    child_connection,
+                    engine,
+                    policy,
+                    steps,
+                    seed_sequence,
+                    random.getstate(),
+                ),
+            )
+            process.start()
+            child_connection.close()
+            running.append((k, process, connection))
+        k, process, connection = running.pop(0)
+        try:
+            results[k] = connection.recv()
+        except EOFError:
+            raise RuntimeError(f"Branch {k} failed") from None
+        finally:
+            process.join()
+            connection.close()
+    return results
+
+
+def run_restored(engine, policies, steps, seed_sequences):
+    from checkpoint import load_checkpoint, save_checkpoint
+
+    graph = getattr(engine, "graph", engine)
+    contacts = graph.contacts
+    interventions = graph.interventions
+    stats = graph.stats
+    event_log = graph.event_log
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot = os.path.join(directory, "fork.ckpt")
+        save_checkpoint(snapshot, engine, network=False)
+        # Branches are not part of the run the event log records.
+        graph.event_log = None
+        try:
+            for policy, seed_sequence in zip(policies, seed_sequences):
+                branch = load_checkpoint(snapshot, graph=graph)
+                results.append(run_branch(branch, policy, steps, seed_sequence))
+        finally:
+            graph.event_log = event_log
+        # Back to the fork point for `engine`, whose own arrays the branches
+        # did not touch. The original contacts are put back as well, so that
+        # the engine does not see them as changed.
+        load_checkpoint(snapshot, graph=graph)
+        graph.contacts = contacts
+        graph.interventions = interventions
+        graph.stats = stats
+    return results
@@ -0,0 +1,283 @@
+"""
+Jonas Nockert (2020)
+
+Parameter sweeps over one shared contact network.
+
+`run_sweep` runs one simulation per parameter point (see `parameter_grid`)
+over a process pool and writes one row of outcomes per point (final size,
+peak number of infected, peak day) to a CSV file as the points finish.
+
+The contact network is built once, or loaded, through the `NetworkCache`.
+Every worker memory-maps the same cache file read-only and skips creating
+`Node` objects, which the array-based engines do not need. The contact
+arrays, the bulk of the graph, therefore sit in the page cache once however
+many workers run, and each worker only adds its per-node state. Interventions
+do not modify the shared arrays (see `interventions.py`); while physical
+distancing is active, a worker holds its own contact weights.
+
+Points with the same replicate number use the same random streams, so that
+differences between them come from the parameters and not from chance.
+
+Usage:
+    python sweep.py --size 100 --infection-rate 0.005 0.01 0.02
+        --distancing-rate 0.1 0.5 --replicates 4 --output sweep.csv
+
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import csv
+import itertools
+import sys
+import time
+
+import numpy as np
+
+from instrumentation import ConsoleSink, instrument
+
+
+# Parameters of a point and their defaults. Thresholds of None never start or
+# lift physical distancing.
+PARAMETERS = {
+    "infection_rate": 0.01,
+    "distancing_threshold": 0.1,
+    "distancing_rate": 0.1,
+    "opening_up_threshold": None,
+    "n_infected": 1,
+    "replicate": 0,
+}
+OUTCOMES = ("final_size", "peak_infected", "peak_day", "days", "seconds")
+# The `Node`-based engine needs `Node` objects, the parallel engine its own
+# processes and `ArrayEngine` a private edge list about the size of the shared
+# contact arrays, while the frontier engine reads those directly.
+ENGINES = ("frontier", "events", "cohort")
+
+# The graph of a worker process, set by `load_network`.
+worker_graph = None
+
+
+def parameter_grid(replicates=1, **axes):
+    """All combinations of the values given for each parameter, e.g.
+    parameter_grid(infection_rate=[0.005, 0.01], distancing_rate=[0.1, 0.5]),
+    each repeated with replicate numbers 0, ..., replicates - 1."""
+    unknown = set(axes) - set(PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown parameters {sorted(unknown)}")
+    names = list(axes)
+    return [
+        {**dict(zip(names, values)), "replicate": replicate}
+        for values in itertools.product(*axes.values())
+        for replicate in range(replicates)
+    ]
+
+
+def load_network(path, n1, n2):
+    """Worker initializer: memory-map the network in `path`."""
+    global worker_graph
+    from cache import graph_from_arrays, read_arrays
+
+    # Sinks inherited from the parent report progress of the sweep, not of
+    # single points.
+    for subscriber in list(instrument.subscribers):
+        instrument.unsubscribe(subscriber)
+    arrays, _ = read_arrays(path)
+    worker_graph = graph_from_arrays(n1, n2, arrays, nodes=False)
+
+
+def reset_graph(graph):
+    """Back to day 0 with no interventions."""
+    from graph import GraphState
+    from timeseries import StatsBuffer
+
+    graph.t = 0
+    graph.stats = StatsBuffer()
+    graph.state = GraphState.NORMAL
+    graph.physical_distancing_t = None
+    graph.opening_up_t = None
+    graph.interventions = []
+    graph.set_contacts(graph.base_contacts)
+
+
+def set_infection_rate(engine, rate):
+    if isinstance(engine.infection_rate, np.ndarray):
+        engine.infection_rate[:] = rate
+    else:
+        # The cohort engine folds the rate into its contacts.
+        engine.infection_rate = rate
+        engine.load_contacts()
+
+
+def run_point(point, steps, engine, seed_sequence):
+    """Run the simulation of one point on the worker's graph. Returns its
+    outcomes."""
+    from ensemble import make_engine, seed_streams
+    from scenarios import ThresholdPolicy
+
+    start = time.perf_counter()
+    params = {**PARAMETERS, **point}
+    graph = worker_graph
+    reset_graph(graph)
+    seed_streams(seed_sequence)
+    sim = make_engine(graph, engine)
+    set_infection_rate(sim, params["infection_rate"])
+    sim.infect_random(n=params["n_infected"])
+    policy = ThresholdPolicy(
+        threshold=params["distancing_threshold"],
+        rate=params["distancing_rate"],
+        opening_up_threshold=params["opening_up_threshold"],
+    )
+    for _ in range(steps):
+        sim.step()
+        if graph.stats[-1]["I"] == 0:
+            break
+        policy(sim)
+
+    stats = graph.stats
+    infected = stats.column("E") + stats.column("I")
+    peak = int(infected.argmax())
+    return {
+        "final_size": int(stats.column("ICUM")[-1]),
+        "peak_infected": int(infected[peak]),
+        "peak_day": int(stats.column("t")[peak]),
+        "days": len(stats),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def build_network(n1, n2, seed, cache_dir, params):
+    from cache import NetworkCache
+
+    NetworkCache(cache_dir).get_or_build(n1, n2, seed, **params)
+
+
+def network_path(n1, n2, seed, cache_dir):
+    """Path of the cached network, building it on a cache miss."""
+    from cache import NetworkCache
+
+    cache = NetworkCache(cache_dir)
+    params = {"implicit_cliques": True}
+    path = cache.path(cache.key(n1, n2, seed, **params))
+    if not path.exists():
+        # Built in a process of its own, so that workers forked from this one
+        # do not start out with the memory used for building.
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            executor.submit(build_network, n1, n2, seed, cache_dir, params).result()
+    return path
+
+
+def run_sweep(
+    points,
+    n1,
+    n2=None,
+    steps=250,
+    engine="frontier",
+    seed=1,
+    output=None,
+    max_workers=None,
+    cache_dir=".cache/networks",
+):
+    """Run one simulation per point (a dict of `PARAMETERS`, missing ones at
+    their defaults) on an `n1` x `n2` network built from `seed`.
+
+    Rows of the point's parameters and outcomes are written to the CSV file
+    `output` as they come in and returned in the order of `points`.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Engine '{engine}' cannot be swept, use one of {ENGINES}")
+    n2 = n2 or n1
+    path = network_path(n1, n2, seed, cache_dir)
+    n_replicates = max((point.get("replicate", 0) for point in points), default=0) + 1
+    seed_sequences = np.random.SeedSequence(seed).spawn(n_replicates)
+    names = list(PARAMETERS)
+
+    rows = [None] * len(points)
+    output_file = open(output, "w", newline="") if output else None
+    try:
+        if output_file:
+            writer = csv.DictWriter(output_file, ["point", *names, *OUTCOMES])
+            writer.writeheader()
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=load_network,
+            initargs=(str(path), n1, n2),
+        ) as executor:
+            futures = {
+                executor.submit(
+                    run_point,
+                    point,
+                    steps,
+                    engine,
+                    seed_sequences[point.get("replicate", 0)],
+                ): k
+                for k, point in enumerate(points)
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                k = futures[future]
+                rows[k] = {"point": k, **PARAMETERS, **points[k], **future.result()}
+                if output_file:
+                    writer.writerow(rows[k])
+                    output_file.flush()
+                instrument.progress("sweep", done, len(points))
+    finally:
+        if output_file:
+            output_file.close()
+    return rows
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--size", type=int, default=100, help="grid width")
+    parser.add_argument("--height", type=int, help="grid height (default --size)")
+    parser.add_argument("--steps", type=int, default=250)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--engine", default="frontier", help=", ".join(ENGINES))
+    parser.add_argument("--replicates", type=int, default=1)
+    for name, default in PARAMETERS.items():
+        if name == "replicate":
+            continue
+        help = f"values to sweep (default {default})"
+        if name.endswith("threshold"):
+            help += ", negative for never"
+        parser.add_argument(
+            "--" + name.replace("_", "-"),
+            nargs="+",
+            type=int if name == "n_infected" else float,
+            help=help,
+        )
+    parser.add_argument("--workers", type=int, help="default the number of CPUs")
+    parser.add_argument("--cache-dir", default=".cache/networks")
+    parser.add_argument("--output", default="sweep.csv")
+    parser.add_argument("--quiet", action="store_true", help="do not print progress")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.quiet:
+        instrument.subscribe(ConsoleSink())
+    axes = {}
+    for name in PARAMETERS:
+        values = getattr(args, name, None)
+        if values is None:
+            continue
+        if name.endswith("threshold"):
+            values = [None if value < 0 else value for value in values]
+        axes[name] = values
+    points = parameter_grid(replicates=args.replicates, **axes)
+    run_sweep(
+        points,
+        args.size,
+        args.height,
+        steps=args.steps,
+        engine=args.engine,
+        seed=args.seed,
+        output=args.output,
+        max_workers=args.workers,
+        cache_dir=args.cache_dir,
+    )
+    instrument.flush()
+    print(f"Wrote {len(points)} points to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
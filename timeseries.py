@@ -0,0 +1,98 @@
+"""
+Jonas Nockert (2020)
+
+Columnar buffer for the daily compartment counts.
+
+Rows are kept in a preallocated int64 array that doubles in size when full, one
+column per compartment with latent (E) and infectious (I) kept separate. For
+compatibility with code written against the old list of dicts, indexing a row
+(`stats[-1]`) gives a dict in the old format, where "I" counts everyone
+infected (latent or infectious) and "E" is added. Use `column` for the
+separate compartments.
+
+Rows can be streamed to a CSV file as they are appended and the whole buffer
+saved to an NPZ file at any time, e.g. every k steps of a long run.
+
+"""
+import os
+
+import numpy as np
+
+
+COLUMNS = ("t", "S", "E", "I", "R", "ICUM")
+
+
+class StatsBuffer:
+    def __init__(self, capacity=256, csv=None):
+        self.data = np.zeros((capacity, len(COLUMNS)), dtype=np.int64)
+        self.size = 0
+        self.csv = None
+        if csv:
+            self.stream_csv(csv)
+
+    def append(self, t, susceptible, latent, infectious, recovered, cumulative):
+        if self.size == len(self.data):
+            self.data = np.resize(self.data, (2 * len(self.data), len(COLUMNS)))
+        row = (t, susceptible, latent, infectious, recovered, cumulative)
+        self.data[self.size] = row
+        self.size += 1
+        if self.csv:
+            self.csv.write(",".join(map(str, row)) + "\n")
+            self.csv.flush()
+
+    @classmethod
+    def from_array(cls, rows):
+        """Buffer holding a copy of `rows`, e.g. as returned by `array`."""
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1, len(COLUMNS))
+        buffer = cls(capacity=max(len(rows), 256))
+        buffer.data[: len(rows)] = rows
+        buffer.size = len(rows)
+        return buffer
+
+    def __repr__(self):
+        return "StatsBuffer(%d rows)" % self.size
+
+    def __len__(self):
+        return self.size
+
+    def row(self, k):
+        t, s, e, i, r, icum = self.data[k].tolist()
+        return {"t": t, "S": s, "E": e, "I": e + i, "R": r, "ICUM": icum}
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self.row(j) for j in range(*k.indices(self.size))]
+        if k < 0:
+            k += self.size
+        if not 0 <= k < self.size:
+            raise IndexError("stats index out of range")
+        return self.row(k)
+
+    def __iter__(self):
+        for k in range(self.size):
+            yield self.row(k)
+
+    def column(self, name):
+        """One column as an array (a view, valid until the next append)."""
+        return self.data[: self.size, COLUMNS.index(name)]
+
+    def array(self):
+        return self.data[: self.size]
+
+    def stream_csv(self, path):
+        """Write all rows so far to `path` and every later row as appended."""
+        self.csv = open(path, "w")
+        self.csv.write(",".join(COLUMNS) + "\n")
+        for row in self.array().tolist():
+            self.csv.write(",".join(map(str, row)) + "\n")
+        self.csv.flush()
+
+    def save_npz(self, path):
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, **{name: self.column(name) for name in COLUMNS})
+        os.replace(tmp_path, path)
+
+    def close(self):
+        if self.csv:
+            self.csv.close()
+            self.csv = None